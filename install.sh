@@ -18,9 +18,21 @@ pip3 install -r ./requirements.txt
 echo "Copying files"
 cp LICENSE /opt/pulley/LICENSE
 cp pulley.py /opt/pulley/pulley.py
+cp pulleylog.py /opt/pulley/pulleylog.py
+cp pulleymetrics.py /opt/pulley/pulleymetrics.py
+cp pulleymon.py /opt/pulley/pulleymon.py
+cp pulleyshm.py /opt/pulley/pulleyshm.py
+cp pulleysim.py /opt/pulley/pulleysim.py
+cp pulleyprof.py /opt/pulley/pulleyprof.py
 cp pulley.js /opt/pulley/pulley.js
 cp pulley@mjjw/icon.png /opt/pulley/pulley.png
 
+if [ -d /etc/dbus-1/system.d ]; then
+	echo "Installing D-Bus policy"
+	cp net.mjjw.KrakenController.conf /etc/dbus-1/system.d/net.mjjw.KrakenController.conf
+	systemctl reload dbus
+fi
+
 if [ -d $HOME/.local/share/cinnamon ]; then
 	echo "Installing cinnamon applet"
 	cp -r mjjw@pulley $HOME/.local/share/cinnamon/mjjw@pulley
@@ -890,6 +890,12 @@ function connectToDBus() {
         onProps: null,
         disconnectProxy: null,
         disconnectDBus: null,
+        // the config as pulley last reported it or was sent, so only what changed needs sending
+        lastConfig: null,
+        // the version of the last GetSnapshot, so the next one only returns what changed since, -1 for a pulley
+        // without GetSnapshot
+        version: 0,
+        snapshot: null,
         lastInfo: {
             KrakenDevice: null,
             LiquidTemp: null,
@@ -923,9 +929,35 @@ function connectToDBus() {
         }    
         priv.kcProxy = null;
         priv.kcProxyPropertiesID = null;
+        priv.version = 0;
+        priv.lastConfig = null;
         priv.onProps(null);
     };
 
+    // Fetches the live values and the config that changed since the last call in one round trip, returns false if
+    // pulley is too old to have GetSnapshot
+    priv.snapshot = () => {
+        if (priv.version < 0) {
+            return false;
+        }
+        try {
+            let [version, values, config] = priv.kcProxy.GetSnapshotSync(priv.version);
+            priv.version = version;
+            Object.keys(values).forEach((key) => {
+                if (key in priv.lastInfo) {
+                    priv.lastInfo[key] = values[key].deep_unpack();
+                }
+            });
+            if (config != "") {
+                priv.lastConfig = JSON.parse(config);
+            }
+            return true;
+        } catch (e) {
+            priv.version = -1;
+            return false;
+        }
+    };
+
     priv.disconnectDBus = () => {
         priv.disconnectProxy();
         if (priv.busWatchId !== null) {
@@ -935,7 +967,7 @@ function connectToDBus() {
     };
 
     result.setConfig = (config) => {
-        priv.kcProxy.UpdateConfigSync(JSON.stringify({
+        let raw = {
                 mode: config.mode == "fixed" ? "fixed" : "custom",
                 use_liquid_temp: config.mode == "cpu+liquid" ? true : false,
                 cpu_critical: config.cpuCriticalTemp,
@@ -952,11 +984,50 @@ function connectToDBus() {
                 liquid_pump_speed: config.curves.liquid.pump.speed,
                 liquid_fan_temp: config.curves.liquid.fan.temp,
                 liquid_fan_speed: config.curves.liquid.fan.speed
-        }));
+        };
+        if (priv.lastConfig == null) {
+            priv.kcProxy.UpdateConfigSync(JSON.stringify(raw));
+            priv.lastConfig = JSON.parse(JSON.stringify(raw));
+            return;
+        }
+
+        let patch = {};
+        var changed = false;
+        Object.keys(raw).forEach((key) => {
+            if (JSON.stringify(raw[key]) != JSON.stringify(priv.lastConfig[key])) {
+                patch[key] = raw[key];
+                changed = true;
+            }
+        });
+        if (changed) {
+            try {
+                try {
+                    priv.kcProxy.PatchConfigSync(JSON.stringify(patch));
+                } catch (e) {
+                    if (!(e instanceof GLib.Error) || !e.matches(Gio.DBusError, Gio.DBusError.UNKNOWN_METHOD)) {
+                        throw e;
+                    }
+                    // an older pulley without PatchConfig
+                    priv.kcProxy.UpdateConfigSync(JSON.stringify(raw));
+                }
+            } catch (e) {
+                // pulley turned it down, go back to what it has so the editor shows that and the next patch is worked
+                // out against it
+                print("Error: " + e.message);
+                priv.lastConfig = JSON.parse(priv.kcProxy.GetConfigSync());
+                return;
+            }
+            // the editor changes the curves in place, keep a copy to compare against
+            priv.lastConfig = JSON.parse(JSON.stringify(raw));
+        }
     };
 
     result.getConfig = () => {
-        let raw = JSON.parse(priv.kcProxy.GetConfigSync());
+        if (!priv.snapshot()) {
+            priv.lastConfig = JSON.parse(priv.kcProxy.GetConfigSync());
+        }
+        // the editor changes the curves in place, hand it a copy
+        let raw = JSON.parse(JSON.stringify(priv.lastConfig));
         if (raw == null) {
             return {
                 mode: "",
@@ -1039,6 +1110,15 @@ function connectToDBus() {
             <method name=\'UpdateConfig\'> \
                 <arg type="s" name="config" direction="in" /> \
             </method> \
+            <method name=\'PatchConfig\'> \
+                <arg type="s" name="patch" direction="in" /> \
+            </method> \
+            <method name=\'GetSnapshot\'> \
+                <arg type="t" name="since_version" direction="in" /> \
+                <arg type="t" name="version" direction="out" /> \
+                <arg type="a{sv}" name="values" direction="out" /> \
+                <arg type="s" name="config" direction="out" /> \
+            </method> \
             <property name="KrakenDevice" type="s" access="read"> \
                 <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/> \
             </property> \
@@ -1065,7 +1145,11 @@ function connectToDBus() {
         }
 
         priv.kcProxyPropertiesID = priv.kcProxy.connect('g-properties-changed', priv.onProps);
-        priv.onProps(priv.kcProxy);
+        if (priv.snapshot()) {
+            result.onProps(priv.lastInfo);
+        } else {
+            priv.onProps(priv.kcProxy);
+        }
     }, () => {
         priv.disconnectProxy();
     });
@@ -1,20 +1,200 @@
+import argparse
 import json
+from io import StringIO
+import re
+from array import array
 from configparser import ConfigParser
-from liquidctl.driver.kraken2 import KrakenTwoDriver
-from liquidctl.driver.kraken3 import KrakenZ3, KrakenX3
-from time import sleep, monotonic
-from elevate import elevate
+from time import sleep, monotonic, time, perf_counter_ns
+from math import exp, nan
+import os
+import socket
+import sys
+import traceback
 from os import path
-from numpy import interp
-from pydbus import SystemBus
-from gi.repository import GLib
+from glob import glob
+from signal import SIGINT, SIGTERM
+from threading import Event, Lock, RLock, Thread
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, wait
+from pulleylog import HistoryLog
+from pulleymetrics import LatencyHistogram, MetricsExporter, MetricsSnapshot
+
+# pydbus and GLib take a while to import and are not needed before the first speed write, see import_dbus()
+GLib = None
+Gio = None
+SessionBus = None
+SystemBus = None
+
+class CurveTable:
+    """
+    A fan/pump curve compiled into per degree lookup tables over the allowed 0-150C range
+
+    Every whole degree stores the curve segment it falls on (start temperature, start speed and slope) so a lookup is
+    a single index and the same linear interpolation numpy.interp does, giving identical results for fractional
+    temperatures too.
+    """
+
+    MAX_TEMP = 150
+
+    def __init__(self, temps, speeds):
+        size = self.MAX_TEMP + 1
+        self.base_temp = array('B', bytes(size))
+        self.base_speed = array('B', bytes(size))
+        self.slope = array('d', bytes(8 * size))
+
+        valid = len(temps) > 0 and len(temps) == len(speeds)
+        prev = 0
+        for idx in range(len(temps) if valid else 0):
+            valid = valid and prev <= temps[idx] <= self.MAX_TEMP and 0 <= speeds[idx] <= 100
+            prev = temps[idx]
+
+        if not valid:
+            # if we get a borked curve default to 100
+            self.first_temp = self.MAX_TEMP + 1
+            self.first_speed = 100
+            self.last_temp = 0
+            self.last_speed = 100
+            return
+
+        # off either end of the curve we clamp to the first/last values
+        self.first_temp = temps[0]
+        self.first_speed = int(speeds[0])
+        self.last_temp = temps[-1]
+        self.last_speed = int(speeds[-1])
+
+        segment = 0
+        for temp in range(temps[0], temps[-1]):
+            while temps[segment + 1] <= temp:
+                segment += 1
+            self.base_temp[temp] = temps[segment]
+            self.base_speed[temp] = speeds[segment]
+            self.slope[temp] = (speeds[segment + 1] - speeds[segment]) / (temps[segment + 1] - temps[segment])
+
+    def speed(self, temp):
+        if temp >= self.last_temp:
+            return self.last_speed
+        if temp < self.first_temp:
+            return self.first_speed
+        idx = int(temp)
+        return int(self.slope[idx] * (temp - self.base_temp[idx]) + self.base_speed[idx])
+
+
+class CurveBank:
+    """
+    Every curve of a config packed into one set of flat lookup tables, so a tick evaluates all of them in a single pass
+
+    Curve n takes entries n * STRIDE up to (n + 1) * STRIDE of the tables, its source and target are kept as indices.
+    The pass takes the temperature of each source and gives the highest speed any curve asks for on each target, the
+    cost per curve is a few array reads whatever the sources are.
+    """
+
+    STRIDE = CurveTable.MAX_TEMP + 1
+
+    # curves is a dictionary of CurveTable by curve name (<source>_<target>)
+    def __init__(self, curves):
+        self.curves = curves
+        # the order evaluate() takes the temperatures and gives the speeds in
+        self.sources = []
+        self.targets = []
+        self.source_idx = array('B')
+        self.target_idx = array('B')
+        self.first_temp = array('H')
+        self.first_speed = array('B')
+        self.last_temp = array('H')
+        self.last_speed = array('B')
+        self.base_temp = array('B')
+        self.base_speed = array('B')
+        self.slope = array('d')
+
+        for curve_name, table in curves.items():
+            source, target = curve_name.rsplit('_', 1)
+            if source not in self.sources:
+                self.sources.append(source)
+            if target not in self.targets:
+                self.targets.append(target)
+            self.source_idx.append(self.sources.index(source))
+            self.target_idx.append(self.targets.index(target))
+            self.first_temp.append(table.first_temp)
+            self.first_speed.append(table.first_speed)
+            self.last_temp.append(table.last_temp)
+            self.last_speed.append(table.last_speed)
+            self.base_temp.extend(table.base_temp)
+            self.base_speed.extend(table.base_speed)
+            self.slope.extend(table.slope)
+
+    # temps has the temperature of each of self.sources, None for a source whose curves are not to be used. Returns the
+    # speed for each of self.targets, -1 for a target none of the curves used are for.
+    def evaluate(self, temps):
+        speeds = [-1] * len(self.targets)
+        offset = 0
+        for n in range(len(self.source_idx)):
+            temp = temps[self.source_idx[n]]
+            if temp is not None:
+                if temp >= self.last_temp[n]:
+                    speed = self.last_speed[n]
+                elif temp < self.first_temp[n]:
+                    speed = self.first_speed[n]
+                else:
+                    idx = offset + int(temp)
+                    speed = int(self.slope[idx] * (temp - self.base_temp[idx]) + self.base_speed[idx])
+                if speed > speeds[self.target_idx[n]]:
+                    speeds[self.target_idx[n]] = speed
+            offset += self.STRIDE
+        return speeds
 
-from pydbus.generic import signal
 
 class KrakenControllerConfig:
-    def __init__(self):
+    CURVE_NAMES = [ 'cpu_fan', 'cpu_pump', 'liquid_fan', 'liquid_pump' ]
+
+    # a curve for one of the SENSORS in a [custom] section
+    SENSOR_CURVE = re.compile(r'^([a-z0-9]+)_(fan|pump)_curve$')
+
+    PULLEY_KEYS = ['mode', 'enable_dbus', 'use_liquid_temp', 'boost_duration', 'cpu_critical', 'liquid_critical', 'boost_after_critical', 'min_interval', 'max_interval', 'min_signal_interval', 'history_size', 'log_history', 'log_dir', 'metrics_listen', 'status_file', 'firmware_offload', 'offload_interval', 'feed_forward', 'feed_forward_gain', 'feed_forward_horizon', 'cpu_tdp']
+
+    # The settings clients can change and what a valid value is for each: one of a list of strings, a bool, an int in a
+    # range, or a curve axis (a non decreasing list of ints up to a maximum)
+    VALID_VALUES = {
+        'mode': ['choice', ["fixed", "custom"]],
+        'use_liquid_temp': ['bool'],
+        'boost_duration': ['int', 0, 1800],
+        'cpu_critical': ['int', 0, 150],
+        'liquid_critical': ['int', 0, 150],
+        'boost_after_critical': ['bool'],
+        'fixed_fan_speed': ['int', 0, 100],
+        'fixed_pump_speed': ['int', 0, 100],
+        'cpu_pump_temp': ['axis', 150],
+        'cpu_pump_speed': ['axis', 100],
+        'cpu_fan_temp': ['axis', 150],
+        'cpu_fan_speed': ['axis', 100],
+        'liquid_pump_temp': ['axis', 150],
+        'liquid_pump_speed': ['axis', 100],
+        'liquid_fan_temp': ['axis', 150],
+        'liquid_fan_speed': ['axis', 100]}
+
+    # The settings only the config file can change that are kept within a range, as [min, max]. An interval of 0 or less
+    # would have the worker poll the device flat out.
+    FILE_RANGES = {
+        'min_interval': [0.05, 60.0],
+        'max_interval': [0.05, 600.0],
+        'offload_interval': [0.05, 600.0],
+        'min_signal_interval': [0.0, 60.0],
+        'cpu_tdp': [0.0, 1000.0]}
+
+    # settings of the daemon that are only used at startup, changing them in the config file needs a restart
+    RESTART_KEYS = ['enable_dbus', 'history_size', 'log_history', 'log_dir', 'metrics_listen', 'status_file']
+
+    def __init__(self, device=0):
         self.configFile = "/etc/pulley.conf"
-        self.config = {
+        # the first device is configured by the [pulley], [fixed] and [custom] sections, any other device N has its
+        # own [pulley.N], [fixed.N] and [custom.N] sections which default to the first device's settings
+        self.sectionSuffix = "" if device == 0 else "." + str(device)
+        self.config = self.defaultConfig_()
+        self.compileCurves()
+        # the config toJSON() was last built from and the JSON
+        self.jsonCache = None
+
+    def defaultConfig_(self):
+        return {
             'mode': "custom",
             'enable_dbus': True,
             'use_liquid_temp': False,
@@ -22,6 +202,20 @@ class KrakenControllerConfig:
             'cpu_critical': 80,
             'liquid_critical': 40,
             'boost_after_critical': True,
+            'min_interval': 0.25,
+            'max_interval': 5.0,
+            'min_signal_interval': 0.0,
+            'history_size': 14400,
+            'log_history': False,
+            'log_dir': "/var/lib/pulley",
+            'metrics_listen': "",
+            'status_file': "/run/pulley/status",
+            'firmware_offload': False,
+            'offload_interval': 10.0,
+            'feed_forward': False,
+            'feed_forward_gain': 15.0,
+            'feed_forward_horizon': 5.0,
+            'cpu_tdp': 0.0,
             'fixed_fan_speed': 75,
             'fixed_pump_speed': 75,
             'cpu_fan_temp': [0, 30, 40, 50, 60, 70, 75],
@@ -59,42 +253,134 @@ class KrakenControllerConfig:
                 config_out[value] = config[value]
         return config_out
 
-    def readConfig(self):
-        config = ConfigParser();
-        config.read(self.configFile)
+    def readSections_(self, config, config_out, suffix):
+        if 'pulley' + suffix in config:
+            self.readValues(config_out, config['pulley' + suffix], self.PULLEY_KEYS)
 
-        if 'pulley' in config:
-            self.readValues(self.config, config['pulley'], ['mode', 'enable_dbus', 'use_liquid_temp', 'boost_duration', 'cpu_critical', 'liquid_critical', 'boost_after_critical'])
+        if 'fixed' + suffix in config:
+            self.readValues(config_out, config['fixed' + suffix], [['fan', 'fixed_fan_speed'], ['pump', 'fixed_pump_speed' ]])
 
-        if 'fixed' in config:
-            self.readValues(self.config, config['fixed'], [['fan', 'fixed_fan_speed'], ['pump', 'fixed_pump_speed' ]])
-
-        if 'custom' in config:
-            curve_names = [ 'cpu_fan', 'cpu_pump', 'liquid_fan', 'liquid_pump' ];
+        if 'custom' + suffix in config:
             curves = {}
             curve_keys = []
-            for curve_name in curve_names:
-                curves[curve_name + "_curve"] = self.join_curve(self.config[curve_name + "_temp"], self.config[curve_name + "_speed"])
+            for curve_name in self.CURVE_NAMES:
+                curves[curve_name + "_curve"] = self.join_curve(config_out[curve_name + "_temp"], config_out[curve_name + "_speed"])
                 curve_keys.append(curve_name + "_curve")
 
-            self.readValues(curves, config['custom'], curve_keys)
-            for curve_name in curve_names:
+            for key in config['custom' + suffix]:
+                match = self.SENSOR_CURVE.match(key)
+                if match is not None and match.group(1) in SENSORS:
+                    curves[key] = []
+                    curve_keys.append(key)
+
+            self.readValues(curves, config['custom' + suffix], curve_keys)
+            for curve_name in [key[:-6] for key in curve_keys]:
                 curve = self.split_curve(curves[curve_name + "_curve"])
-                self.config[curve_name + "_temp"] = curve['x']
-                self.config[curve_name + "_speed"] = curve['y']
+                config_out[curve_name + "_temp"] = curve['x']
+                config_out[curve_name + "_speed"] = curve['y']
+
+    # Reads the config file into a new dictionary, anything not in the file gets its default value. Raises an Exception
+    # if a setting clients can change (VALID_VALUES) or a curve is invalid.
+    def readFile_(self):
+        config = ConfigParser();
+        config.read(self.configFile)
+
+        config_out = self.defaultConfig_()
+        self.readSections_(config, config_out, "")
+        if self.sectionSuffix != "":
+            self.readSections_(config, config_out, self.sectionSuffix)
+
+        # the file is held to the same rules as a client's changes
+        for key in self.VALID_VALUES:
+            value = self.validValue_(key, config_out[key])
+            if value is None:
+                raise Exception("Invalid " + key + " in " + self.configFile + ": " + str(config_out[key]))
+            config_out[key] = value
+        curve_name = self.invalidCurve_(config_out)
+        if curve_name is not None:
+            raise Exception("Invalid " + curve_name + "_curve in " + self.configFile)
+
+        for key, (low, high) in self.FILE_RANGES.items():
+            # max() first so NaN ends up at the minimum too
+            value = min(high, max(low, config_out[key]))
+            if value != config_out[key]:
+                print("Using " + str(value) + " for " + key + " in " + self.configFile + " (" + str(config_out[key]) + " is out of range)")
+                config_out[key] = value
+        return config_out
+
+    def readConfig(self):
+        self.config = self.readFile_()
+        self.compileCurves()
+
+    # Picks up changes made to the config file while we are running, the settings that are only used at startup keep
+    # their current values. Returns True if anything changed, if anything in the file is invalid this raises and the
+    # current config stays.
+    def reloadConfig(self):
+        config = self.readFile_()
+        for key in self.RESTART_KEYS:
+            config[key] = self.config[key]
+        if config == self.config:
+            return False
+
+        changed_curves = self.changedCurves_(config)
+        old_config = self.config
+        self.config = config
+        try:
+            self.compileCurves(changed_curves)
+        except Exception:
+            self.config = old_config
+            raise
+        return True
+
+    # The names of the curves in config, CURVE_NAMES followed by any curves for SENSORS
+    def curveNames(self, config):
+        return self.CURVE_NAMES + [key[:-5] for key in config
+            if key.endswith("_temp") and key[:-5] not in self.CURVE_NAMES and key[:-5] + "_speed" in config]
+
+    # The names of the curves that differ between the current config and config, including any added or removed
+    def changedCurves_(self, config):
+        return [curve_name for curve_name in dict.fromkeys(self.curveNames(self.config) + self.curveNames(config))
+            if config.get(curve_name + "_temp") != self.config.get(curve_name + "_temp") or config.get(curve_name + "_speed") != self.config.get(curve_name + "_speed")]
+
+    # Builds the lookup tables used by the controller every tick, only needed when the curves are loaded or changed.
+    # curve_names limits it to those curves, the others are kept as they are.
+    def compileCurves(self, curve_names=None):
+        names = self.curveNames(self.config)
+        old_curves = getattr(self, 'curves', {})
+        curves = {}
+        for curve_name in names:
+            if curve_name in old_curves and curve_names is not None and curve_name not in curve_names:
+                curves[curve_name] = old_curves[curve_name]
+            else:
+                curves[curve_name] = CurveTable(self.config[curve_name + "_temp"], self.config[curve_name + "_speed"])
+        self.curves = curves
+        self.bank = CurveBank(curves)
 
     def writeConfig(self):
+        # keep the sections belonging to the other devices
         config = ConfigParser();
-        config['pulley'] = self.writeValues({}, self.config, ['mode', 'enable_dbus', 'use_liquid_temp', 'boost_duration', 'cpu_critical', 'liquid_critical', 'boost_after_critical'])
-        config['fixed'] = self.writeValues({}, self.config, [['fan', 'fixed_fan_speed'], ['pump', 'fixed_pump_speed' ]])
+        config.read(self.configFile)
+        config['pulley' + self.sectionSuffix] = self.writeValues({}, self.config, self.PULLEY_KEYS)
+        config['fixed' + self.sectionSuffix] = self.writeValues({}, self.config, [['fan', 'fixed_fan_speed'], ['pump', 'fixed_pump_speed' ]])
 
-        curve_names = [ 'cpu_fan', 'cpu_pump', 'liquid_fan', 'liquid_pump' ];
-        config['custom'] = {}
-        for curve_name in curve_names:
-            config['custom'][curve_name + "_curve"] = str(self.join_curve(self.config[curve_name + "_temp"], self.config[curve_name + "_speed"]))
+        config['custom' + self.sectionSuffix] = {}
+        for curve_name in self.curveNames(self.config):
+            config['custom' + self.sectionSuffix][curve_name + "_curve"] = str(self.join_curve(self.config[curve_name + "_temp"], self.config[curve_name + "_speed"]))
 
-        with open(self.configFile, "w") as configFile:
-            config.write(configFile)
+        content = StringIO()
+        config.write(content)
+        content = content.getvalue()
+        try:
+            with open(self.configFile, "r") as configFile:
+                if configFile.read() == content:
+                    return
+        except OSError:
+            pass
+
+        # write a new file and rename it over the old one, so a reader never sees half a config
+        with open(self.configFile + ".tmp", "w") as configFile:
+            configFile.write(content)
+        os.replace(self.configFile + ".tmp", self.configFile)
 
     def readValue_(self, config_out, section, name_in, name_out):
         if name_out in config_out:
@@ -105,7 +391,8 @@ class KrakenControllerConfig:
             elif type(config_out[name_out]) is float:
                 config_out[name_out] = section.getfloat(name_in, config_out[name_out])
             elif type(config_out[name_out]) is list:
-                config_out[name_out] = json.loads(section.get(name_in, config_out[name_out]))
+                if name_in in section:
+                    config_out[name_out] = json.loads(section.get(name_in))
             else:
                 config_out[name_out] = section.get(name_in, config_out[name_out])
         else:
@@ -122,165 +409,213 @@ class KrakenControllerConfig:
             self.readValue(config_out, section, name)
 
     def toJSON(self):
-        result = json.dumps({
-            'mode': self.config['mode'],
-            'use_liquid_temp': self.config['use_liquid_temp'],
-            'boost_duration': self.config['boost_duration'],
-            'cpu_critical': self.config['cpu_critical'],
-            'liquid_critical': self.config['liquid_critical'],
-            'boost_after_critical': self.config['boost_after_critical'],
-            'fixed_fan_speed': self.config['fixed_fan_speed'],
-            'fixed_pump_speed': self.config['fixed_pump_speed'],
-            'cpu_pump_temp': self.config['cpu_pump_temp'],
-            'cpu_pump_speed': self.config['cpu_pump_speed'],
-            'cpu_fan_temp': self.config['cpu_fan_temp'],
-            'cpu_fan_speed': self.config['cpu_fan_speed'],
-            'liquid_pump_temp': self.config['liquid_pump_temp'],
-            'liquid_pump_speed': self.config['liquid_pump_speed'],
-            'liquid_fan_temp': self.config['liquid_fan_temp'],
-            'liquid_fan_speed': self.config['liquid_fan_speed']
-        });
-        return result
+        # clients poll this, so it is only rebuilt once the config changes (every change replaces self.config)
+        if self.jsonCache is None or self.jsonCache[0] is not self.config:
+            self.jsonCache = (self.config, json.dumps({key: self.config[key] for key in self.VALID_VALUES}))
+        return self.jsonCache[1]
+
+    # Returns value converted to the type of setting key, or None if it is not a valid value for it
+    def validValue_(self, key, value):
+        rule = self.VALID_VALUES[key]
+        try:
+            if rule[0] == 'choice':
+                return str(value) if value in rule[1] else None
+            if rule[0] == 'bool':
+                return bool(value) if (value == True or value == False) else None
+            if rule[0] == 'int':
+                return int(value) if rule[1] <= value <= rule[2] else None
+            if rule[0] == 'axis':
+                if not isinstance(value, list):
+                    return None
+                result = []
+                prev = 0
+                for val in value:
+                    if prev > int(val) or int(val) > rule[1]:
+                        return None
+                    prev = int(val)
+                    result.append(int(val))
+                return result
+        except (TypeError, ValueError):
+            return None
+
+    # Returns the name of the first curve in config that is empty or whose axes differ in length, or for the curves of
+    # SENSORS (which have no VALID_VALUES of their own) that has an invalid axis. None if they are all valid.
+    def invalidCurve_(self, config):
+        for curve_name in self.curveNames(config):
+            temps = config[curve_name + "_temp"]
+            speeds = config[curve_name + "_speed"]
+            if curve_name not in self.CURVE_NAMES:
+                target = curve_name.rsplit('_', 1)[1]
+                if self.validValue_('cpu_' + target + '_temp', temps) is None or self.validValue_('cpu_' + target + '_speed', speeds) is None:
+                    return curve_name
+            elif len(temps) == 0:
+                return curve_name
+            if len(temps) != len(speeds):
+                return curve_name
+        return None
+
+    # Validates the settings in patch (any of VALID_VALUES) and applies them, then recompiles the curves that changed and
+    # writes the config file. Returns False without changing anything if a setting is invalid.
+    def applyPatch(self, patch):
+        newConfig = dict(self.config)
+        for key in patch:
+            if key not in self.VALID_VALUES:
+                return False
+            value = self.validValue_(key, patch[key])
+            if value is None:
+                return False
+            newConfig[key] = value
+
+        if self.invalidCurve_(newConfig) is not None:
+            return False
+
+        changed_curves = self.changedCurves_(newConfig)
+        self.config = newConfig
+        self.compileCurves(changed_curves)
+        self.writeConfig()
+        return True
 
+    # Replaces every setting, a config missing any of them or with an invalid one is ignored
     def parseJSON(self, rawConfigStr):
         rawConfig = json.loads(rawConfigStr)
-        newConfig = {}
-        newConfig['enable_dbus'] = self.config['enable_dbus']
-
-        if "mode" in rawConfig and (rawConfig['mode'] == "fixed" or rawConfig['mode']=="custom"):
-            newConfig['mode'] = str(rawConfig['mode'])
-        else:
-            return
-
-        if "use_liquid_temp" in rawConfig and (rawConfig['use_liquid_temp'] == True or rawConfig['use_liquid_temp'] == False):
-            newConfig['use_liquid_temp'] = bool(rawConfig['use_liquid_temp'])
-        else:
-            return
-
-        if 'boost_duration' in rawConfig and (rawConfig['boost_duration'] >=0 and rawConfig['boost_duration'] <= 1800):
-            newConfig['boost_duration'] = int(rawConfig['boost_duration'])
-        else:
-            return
-
-        if "cpu_critical" in rawConfig and (rawConfig['cpu_critical'] >=0 and rawConfig['cpu_critical'] <= 150):
-            newConfig['cpu_critical'] = int(rawConfig['cpu_critical'])
-        else:
-            return
-
-        if "liquid_critical" in rawConfig and(rawConfig['liquid_critical'] >=0 and rawConfig['liquid_critical'] <= 150):
-            newConfig['liquid_critical'] = int(rawConfig['liquid_critical'])
-        else:
-            return
-
-        if 'boost_after_critical' in rawConfig and (rawConfig['boost_after_critical'] == True or rawConfig['boost_after_critical'] == False):
-            newConfig['boost_after_critical'] = bool(rawConfig['boost_after_critical'])
-        else:
-            return
-
-        if 'fixed_fan_speed' in rawConfig and (rawConfig['fixed_fan_speed'] >=0 and rawConfig['fixed_fan_speed'] <= 100):
-            newConfig['fixed_fan_speed'] = int(rawConfig['fixed_fan_speed'])
-        else:
-            return
-
-        if 'fixed_pump_speed' in rawConfig and (rawConfig['fixed_pump_speed'] >=0 and rawConfig['fixed_pump_speed'] <= 100):
-            newConfig['fixed_pump_speed'] = int(rawConfig['fixed_pump_speed'])
-        else:
-            return
-            
-        if 'cpu_pump_temp' in rawConfig and 'cpu_pump_speed' in rawConfig and isinstance(rawConfig['cpu_pump_temp'], list) and isinstance(rawConfig['cpu_pump_speed'], list) and len(rawConfig['cpu_pump_temp'])>0 and len(rawConfig['cpu_pump_temp']) == len(rawConfig['cpu_pump_speed']):
-            newConfig['cpu_pump_temp'] = []
-            newConfig['cpu_pump_speed'] = []
-            prev = 0
-            for val in rawConfig['cpu_pump_temp']:
-                if prev > int(val):
-                    return
-                if int(val) > 150:
-                    return
-                prev = int(val);
-                newConfig['cpu_pump_temp'].append(int(val))
-
-            prev = 0
-            for val in rawConfig['cpu_pump_speed']:
-                if prev > int(val):
-                    return
-                if int(val) > 100:
-                    return
-                prev = int(val);
-                newConfig['cpu_pump_speed'].append(int(val))
-        else:
-            return
+        for key in self.VALID_VALUES:
+            if key not in rawConfig:
+                return
+        self.applyPatch({key: rawConfig[key] for key in self.VALID_VALUES})
+
+    # Changes only the settings given
+    def patchJSON(self, rawPatchStr):
+        patch = json.loads(rawPatchStr)
+        if not isinstance(patch, dict) or not self.applyPatch(patch):
+            raise Exception("Invalid config patch")
+
+class TelemetryHistory:
+    """
+    Fixed size ring buffer of the samples taken every tick, each field lives in its own array so a sample costs 22 bytes
+    rather than a Python object. Readings that were not available are stored as NaN (temperatures) or -1 (duties).
+    """
 
-        if 'cpu_fan_temp' in rawConfig and 'cpu_fan_speed' in rawConfig and isinstance(rawConfig['cpu_fan_temp'], list) and isinstance(rawConfig['cpu_fan_speed'], list) and len(rawConfig['cpu_fan_temp'])>0 and len(rawConfig['cpu_fan_temp']) == len(rawConfig['cpu_fan_speed']):
-            newConfig['cpu_fan_temp'] = []
-            newConfig['cpu_fan_speed'] = []
-            prev = 0
-            for val in rawConfig['cpu_fan_temp']:
-                if prev > int(val):
-                    return
-                if int(val) > 150:
-                    return
-                prev = int(val);
-                newConfig['cpu_fan_temp'].append(int(val))
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.timestamp = array('d', bytes(8 * self.capacity))
+        self.cpu_temp = array('f', bytes(4 * self.capacity))
+        self.liquid_temp = array('f', bytes(4 * self.capacity))
+        self.fan_duty = array('b', bytes(self.capacity))
+        self.pump_duty = array('b', bytes(self.capacity))
+        self.fan_set = array('b', bytes(self.capacity))
+        self.pump_set = array('b', bytes(self.capacity))
+        # the slot the next sample goes into and the number of samples held
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, cpu_temp, liquid_temp, fan_duty, pump_duty, fan_set, pump_set):
+        idx = self.head
+        self.timestamp[idx] = timestamp
+        self.cpu_temp[idx] = cpu_temp
+        self.liquid_temp[idx] = liquid_temp
+        self.fan_duty[idx] = fan_duty
+        self.pump_duty[idx] = pump_duty
+        self.fan_set[idx] = fan_set
+        self.pump_set[idx] = pump_set
+        self.head = (idx + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # Index into the arrays of the nth oldest sample
+    def slot_(self, n):
+        return (self.head - self.count + n) % self.capacity
+
+    def mean_(self, values, first, last, invalid):
+        total = 0
+        count = 0
+        for n in range(first, last):
+            value = values[self.slot_(n)]
+            if value == value and value != invalid:
+                total += value
+                count += 1
+        return total / count if count > 0 else invalid
+
+    # Returns the samples taken after since (seconds since the epoch) as one list per field. If there are more than
+    # max_points (0 for no limit) consecutive samples are averaged into max_points buckets.
+    def query(self, since, max_points):
+        # samples are in time order so the first one we want can be found with a binary search
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp[self.slot_(mid)] <= since:
+                lo = mid + 1
+            else:
+                hi = mid
+        total = self.count - lo
+
+        fields = [self.timestamp, self.cpu_temp, self.liquid_temp, self.fan_duty, self.pump_duty, self.fan_set, self.pump_set]
+        if max_points <= 0 or total <= max_points:
+            return tuple([values[self.slot_(n)] for n in range(lo, self.count)] for values in fields)
+
+        result = tuple([] for values in fields)
+        for bucket in range(max_points):
+            first = lo + (bucket * total) // max_points
+            last = lo + ((bucket + 1) * total) // max_points
+            for values, out in zip(fields, result):
+                if values.typecode == 'b':
+                    out.append(int(round(self.mean_(values, first, last, -1))))
+                else:
+                    out.append(self.mean_(values, first, last, nan))
+        return result
 
-            prev = 0
-            for val in rawConfig['cpu_fan_speed']:
-                if prev > int(val):
-                    return
-                if int(val) > 100:
-                    return
-                prev = int(val);
-                newConfig['cpu_fan_speed'].append(int(val))
-        else:
-            return
 
-        if 'liquid_pump_temp' in rawConfig and 'liquid_pump_speed' in rawConfig and isinstance(rawConfig['liquid_pump_temp'], list) and isinstance(rawConfig['liquid_pump_speed'], list) and len(rawConfig['liquid_pump_temp'])>0 and len(rawConfig['liquid_pump_temp']) == len(rawConfig['liquid_pump_speed']):
-            newConfig['liquid_pump_temp'] = []
-            newConfig['liquid_pump_speed'] = []
-            prev = 0;
-            for val in rawConfig['liquid_pump_temp']:
-                if prev > int(val):
-                    return
-                if int(val) > 150:
-                    return
-                prev = int(val);
-                newConfig['liquid_pump_temp'].append(int(val))
+class TickTimings:
+    """
+    How long each phase of the last WINDOW ticks took (in nanoseconds), kept in preallocated arrays so recording a tick
+    allocates nothing. The statistics are only worked out when asked for.
+    """
 
-            prev = 0;
-            for val in rawConfig['liquid_pump_speed']:
-                if prev > int(val):
-                    return
-                if int(val) > 100:
-                    return
-                prev = int(val);
-                newConfig['liquid_pump_speed'].append(int(val))
-        else:
-            return
+    PHASES = ['status', 'cpu_temp', 'decide', 'set_speed', 'tick']
+    WINDOW = 1024
 
-        if 'liquid_fan_temp' in rawConfig and 'liquid_fan_speed' in rawConfig and isinstance(rawConfig['liquid_fan_temp'], list) and isinstance(rawConfig['liquid_fan_speed'], list) and len(rawConfig['liquid_fan_temp'])>0 and len(rawConfig['liquid_fan_temp']) == len(rawConfig['liquid_fan_speed']):
-            newConfig['liquid_fan_temp'] = []
-            newConfig['liquid_fan_speed'] = []
-            prev = 0;
-            for val in rawConfig['liquid_fan_temp']:
-                if prev > int(val):
-                    return
-                if int(val) > 150:
-                    return
-                prev = int(val);
-                newConfig['liquid_fan_temp'].append(int(val))
+    # A tick taking longer than this (in seconds) is counted as over budget
+    BUDGET = 0.1
 
-            prev = 0;
-            for val in rawConfig['liquid_fan_speed']:
-                if prev > int(val):
-                    return
-                if int(val) > 100:
-                    return
-                prev = int(val);
-                newConfig['liquid_fan_speed'].append(int(val))
-        else:
-            return
+    def __init__(self):
+        self.samples = [array('q', bytes(8 * self.WINDOW)) for phase in self.PHASES]
+        self.budget_ns = int(self.BUDGET * 1000000000)
+        self.head = 0
+        self.count = 0
+        # totals since startup
+        self.ticks = 0
+        self.over_budget = 0
+
+    def record(self, status_ns, cpu_temp_ns, decide_ns, set_speed_ns):
+        idx = self.head
+        total = status_ns + cpu_temp_ns + decide_ns + set_speed_ns
+        self.samples[0][idx] = status_ns
+        self.samples[1][idx] = cpu_temp_ns
+        self.samples[2][idx] = decide_ns
+        self.samples[3][idx] = set_speed_ns
+        self.samples[4][idx] = total
+        self.head = (idx + 1) % self.WINDOW
+        self.count = min(self.count + 1, self.WINDOW)
+        self.ticks += 1
+        if total > self.budget_ns:
+            self.over_budget += 1
+
+    # min/mean/p50/p99/max of every phase over the window, in milliseconds
+    def stats(self):
+        phases = {}
+        for phase, samples in zip(self.PHASES, self.samples):
+            values = sorted(samples[:self.count])
+            if not values:
+                phases[phase] = {'count': 0}
+                continue
+            phases[phase] = {
+                'count': len(values),
+                'min_ms': values[0] / 1000000,
+                'mean_ms': sum(values) / len(values) / 1000000,
+                'p50_ms': values[(len(values) - 1) // 2] / 1000000,
+                'p99_ms': values[min(len(values) - 1, (len(values) * 99 + 99) // 100 - 1)] / 1000000,
+                'max_ms': values[-1] / 1000000}
+        return {'ticks': self.ticks, 'over_budget': self.over_budget, 'budget_ms': self.BUDGET * 1000, 'phases': phases}
 
-        self.config = newConfig
-        self.writeConfig()
 
 class KrakenControllerDBUS(object):
     dbus = """
@@ -294,6 +629,37 @@ class KrakenControllerDBUS(object):
                 <method name=\'UpdateConfig\'>
                     <arg type="s" name="config" direction="in" />
                 </method>
+                <method name='PatchConfig'>
+                    <arg type="s" name="patch" direction="in" />
+                </method>
+                <method name='GetHistory'>
+                    <arg type="d" name="since" direction="in" />
+                    <arg type="u" name="max_points" direction="in" />
+                    <arg type="ad" name="timestamps" direction="out" />
+                    <arg type="ad" name="cpu_temp" direction="out" />
+                    <arg type="ad" name="liquid_temp" direction="out" />
+                    <arg type="ai" name="fan_duty" direction="out" />
+                    <arg type="ai" name="pump_duty" direction="out" />
+                    <arg type="ai" name="fan_set" direction="out" />
+                    <arg type="ai" name="pump_set" direction="out" />
+                </method>
+                <method name='GetStats'>
+                    <arg type="s" name="stats" direction="out" />
+                </method>
+                <method name='GetSnapshot'>
+                    <arg type="t" name="since_version" direction="in" />
+                    <arg type="t" name="version" direction="out" />
+                    <arg type="a{sv}" name="values" direction="out" />
+                    <arg type="s" name="config" direction="out" />
+                </method>
+                <method name='ReadNow'>
+                    <arg type="a{sv}" name="values" direction="out" />
+                </method>
+                <method name='StartProfile'>
+                    <arg type="u" name="seconds" direction="in" />
+                    <arg type="s" name="mode" direction="in" />
+                    <arg type="s" name="filename" direction="out" />
+                </method>
                 <property name="KrakenDevice" type="s" access="read">
                     <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
                 </property>
@@ -309,18 +675,60 @@ class KrakenControllerDBUS(object):
                 <property name="PumpDuty" type="i" access="read">
                     <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
                 </property>
+                <property name="CheckInterval" type="d" access="read">
+                    <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
+                </property>
+                <property name="Boosting" type="b" access="read">
+                    <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+                </property>
+                <property name="Devices" type="ao" access="read">
+                    <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="const"/>
+                </property>
             </interface>
         </node>
     """
 
+    # the live values GetSnapshot returns, with their D-Bus types
+    SNAPSHOT_TYPES = {
+        'KrakenDevice': 's',
+        'LiquidTemp': 'i',
+        'CPUTemp': 'i',
+        'FanDuty': 'i',
+        'PumpDuty': 'i',
+        'CheckInterval': 'd',
+        'Boosting': 'b'}
+
     def __init__(self, configMgr):
         self._kraken_device = "unknown"
         self._liquid_temp = int(0)
         self._cpu_temp = int(0)
         self._fan_duty = int(0)
         self._pump_duty = int(0)
+        self._devices = []
+        self._check_interval = float(0)
+        self._boosting = False
         self.controller = None
+        self.worker = None
         self.configMgr = configMgr
+        self.object_path = None
+        self.subscribers = None
+        # properties changed since the last PropertiesChanged signal
+        self._changed = {}
+        self._last_signal = 0
+        # GetSnapshot: bumped on every change, with the version each value and the config last changed at
+        self._version = 1
+        self._versions = dict.fromkeys(self.SNAPSHOT_TYPES, 1)
+        self._config = None
+        self._config_version = 0
+        # a ReadNow refresh is queued on the worker
+        self._refreshing = False
+
+    # signal is False for the properties that don't emit PropertiesChanged, GetSnapshot still has their changes
+    def changed_(self, name, value, signal=True):
+        if signal:
+            self._changed[name] = value
+        self._version += 1
+        self._versions[name] = self._version
 
     @property
     def KrakenDevice(self):
@@ -329,7 +737,7 @@ class KrakenControllerDBUS(object):
     @KrakenDevice.setter
     def KrakenDevice(self, value):
         self._kraken_device = value
-        self.PropertiesChanged("net.mjjw.KrakenController", {"KrakenDevice": self.KrakenDevice}, [])
+        self.changed_("KrakenDevice", self.KrakenDevice)
 
     @property
     def LiquidTemp(self):
@@ -339,7 +747,7 @@ class KrakenControllerDBUS(object):
     def LiquidTemp(self, value):
         if int(value) != self._liquid_temp:
             self._liquid_temp = int(value)
-            self.PropertiesChanged("net.mjjw.KrakenController", {"LiquidTemp": self.LiquidTemp}, [])
+            self.changed_("LiquidTemp", self.LiquidTemp)
 
     @property
     def CPUTemp(self):
@@ -349,7 +757,7 @@ class KrakenControllerDBUS(object):
     def CPUTemp(self, value):
         if int(value) != self._cpu_temp:
             self._cpu_temp = int(value)
-            self.PropertiesChanged("net.mjjw.KrakenController", {"CPUTemp": self.CPUTemp}, [])
+            self.changed_("CPUTemp", self.CPUTemp)
 
     @property
     def FanDuty(self):
@@ -359,7 +767,7 @@ class KrakenControllerDBUS(object):
     def FanDuty(self, value):
         if int(value) != self._fan_duty:
             self._fan_duty = int(value)
-            self.PropertiesChanged("net.mjjw.KrakenController", {"FanDuty": self.FanDuty}, [])
+            self.changed_("FanDuty", self.FanDuty)
 
     @property
     def PumpDuty(self):
@@ -369,20 +777,899 @@ class KrakenControllerDBUS(object):
     def PumpDuty(self, value):
         if int(value) != self._pump_duty:
             self._pump_duty = int(value)
-            self.PropertiesChanged("net.mjjw.KrakenController", {"PumpDuty": self.PumpDuty}, [])
+            self.changed_("PumpDuty", self.PumpDuty)
+
+    # Seconds until the next check, this changes with how fast the temperatures are moving. It changes on almost every
+    # check while they move, so it is left out of PropertiesChanged, clients read it or get it from GetSnapshot.
+    @property
+    def CheckInterval(self):
+        return self._check_interval
 
+    @CheckInterval.setter
+    def CheckInterval(self, value):
+        if float(value) != self._check_interval:
+            self._check_interval = float(value)
+            self.changed_("CheckInterval", self.CheckInterval, False)
+
+    @property
+    def Boosting(self):
+        return self._boosting
+
+    @Boosting.setter
+    def Boosting(self, value):
+        if bool(value) != self._boosting:
+            self._boosting = bool(value)
+            self.changed_("Boosting", self.Boosting)
+
+    # The object paths of every device controlled by pulley, this device included
+    @property
+    def Devices(self):
+        return self._devices
+
+    @Devices.setter
+    def Devices(self, value):
+        self._devices = value
+
+    # The USB work for Boost and UpdateConfig happens on the worker, these return straight away
     def Boost(self):
         if self.controller is not None:
-            self.controller.boost()
+            self.worker.post(self.controller.boost)
 
     def GetConfig(self):
         return self.configMgr.toJSON();
 
     def UpdateConfig(self, newConfig):
         self.configMgr.parseJSON(newConfig)
-        self.controller.update_speed_(True)
+        self.worker.post(lambda: self.controller.update_speed_(True, self.controller.STATUS_TTL))
+
+    # Like UpdateConfig but with only the settings that changed
+    def PatchConfig(self, patch):
+        self.configMgr.patchJSON(patch)
+        self.worker.post(lambda: self.controller.update_speed_(True, self.controller.STATUS_TTL))
+
+    # The temperatures and duties as of the last device read rather than the last tick, with Age in seconds. The main
+    # loop never reads the device itself: when the last read is older than STATUS_TTL the worker is asked for one (a
+    # single one however many callers ask, merged with a tick reading at the same time) and a read the worker already
+    # has in flight is waited for briefly. Otherwise the reply is the older read and calling again shortly gets the new one.
+    def ReadNow(self):
+        controller = self.controller
+        if controller.lost_since is not None:
+            raise Exception(controller.session.description + " is not answering")
+        status, age = controller.session.peek_status(0)
+        if age is None or age > controller.STATUS_TTL:
+            if not self._refreshing:
+                self._refreshing = True
+                self.worker.post(controller.refresh_status_, self.on_refreshed_)
+            status, age = controller.session.peek_status(controller.READ_NOW_WAIT)
+        if status is None:
+            raise Exception(controller.session.description + " has not been read yet, try again")
+
+        values = {'Age': GLib.Variant('d', age)}
+        if controller.cpu_now is not None:
+            values['CPUTemp'] = GLib.Variant('i', int(controller.cpu_now))
+        if not (status['liquid'] < 5 and status['fan'] == 0 and status['pump'] == 0):
+            values['LiquidTemp'] = GLib.Variant('i', int(status['liquid']))
+            values['FanDuty'] = GLib.Variant('i', int(status['fan']))
+            values['PumpDuty'] = GLib.Variant('i', int(status['pump']))
+        return values
+
+    def on_refreshed_(self):
+        self._refreshing = False
+        return False
+
+    def GetHistory(self, since, max_points):
+        return self.controller.history.query(since, max_points)
+
+    # Timings of the phases of the recent ticks as JSON, see TickTimings
+    def GetStats(self):
+        stats = self.controller.timings.stats()
+        stats['recovery'] = self.controller.recovery_stats()
+        stats['decisions'] = self.controller.decisions
+        stats['readback_offsets'] = {target: dict(hysteresis.readback_offset) for target, hysteresis in self.controller.hysteresis.items()}
+        return json.dumps(stats)
+
+    # Everything a client shows in one call: the current version, the live values that changed after since_version and
+    # the config JSON if it changed after since_version (empty otherwise). 0 gets everything.
+    def GetSnapshot(self, since_version):
+        config = self.configMgr.toJSON()
+        if config != self._config:
+            self._config = config
+            self._version += 1
+            self._config_version = self._version
+
+        values = {}
+        for name, version in self._versions.items():
+            if version > since_version:
+                values[name] = GLib.Variant(self.SNAPSHOT_TYPES[name], getattr(self, name))
+        return (self._version, values, config if self._config_version > since_version else "")
+
+    # Profiles the whole daemon for seconds ('deterministic' or 'sampling', see pulleyprof.py) and returns the file the
+    # result is written to once it is done, under log_dir. Root only: the bus policy (net.mjjw.KrakenController.conf)
+    # keeps anyone else from calling it on the system bus and the caller is checked again here, on a session bus the
+    # user pulley runs as may too.
+    def StartProfile(self, seconds, mode, dbus_context=None):
+        if dbus_context is not None and dbus_context.bus.dbus.GetConnectionUnixUser(dbus_context.sender) not in (0, os.getuid()):
+            raise Exception("Only root can profile pulley")
+        if self.worker.profile is not None:
+            raise Exception("A profile is already running")
+
+        from pulleyprof import ProfileSession
+        profile = ProfileSession(mode, seconds, path.join(self.configMgr.config['log_dir'], "profiles"), self.worker)
+        profile.start()
+        self.worker.profile = profile
+        GLib.timeout_add(seconds * 1000, self.finish_profile_)
+        return profile.filename
+
+    def finish_profile_(self):
+        def done(filename):
+            self.worker.profile = None
+            if filename is not None:
+                print("Profile written to " + filename)
+
+        self.worker.profile.finish(done)
+        return False
+
+    # Sends everything that changed since the last flush as a single PropertiesChanged signal
+    def flush(self):
+        if not self._changed:
+            return
+
+        if self.subscribers is not None and not self.subscribers.has_subscribers(self.object_path):
+            # nobody would receive it, clients read the current values when they connect anyway. A client that just
+            # joined may not have added its match yet, so the changes are kept for it until that is known.
+            if not self.subscribers.uncertain():
+                self._changed = {}
+            return
+
+        now = monotonic()
+        if now - self._last_signal < self.configMgr.config['min_signal_interval']:
+            return
+
+        changed = self._changed
+        self._changed = {}
+        self._last_signal = now
+        self.PropertiesChanged("net.mjjw.KrakenController", changed, [])
+
+    # PropertiesChanged = pydbus.generic.signal(), added by import_dbus()
+
+
+class ConfigWatcher:
+    """
+    Reloads the config file when it changes on disk (inotify, through Gio.FileMonitor). Saving a file comes as a burst of
+    events so the reload waits until they have settled.
+    """
+
+    SETTLE_TIME = 250
+
+    def __init__(self, controllers, worker):
+        self.controllers = controllers
+        self.worker = worker
+        self.timer = None
+        self.monitor = Gio.File.new_for_path(controllers[0].configMgr.configFile).monitor_file(Gio.FileMonitorFlags.NONE, None)
+        self.monitor.connect('changed', self.on_changed_)
+
+    def on_changed_(self, monitor, file, other_file, event_type):
+        if event_type not in [Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED]:
+            return
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+        self.timer = GLib.timeout_add(self.SETTLE_TIME, self.reload_)
+
+    def reload_(self):
+        self.timer = None
+        for controller in self.controllers:
+            try:
+                changed = controller.configMgr.reloadConfig()
+            except Exception as error:
+                # a half saved or mistyped file, the current config stays until the file is fixed
+                print("Ignoring changes to " + controller.configMgr.configFile + ": " + str(error))
+                continue
+            # our own writes (UpdateConfig, PatchConfig) come back here too, they change nothing
+            if changed:
+                self.worker.post(lambda controller=controller: controller.update_speed_(True))
+        return False
+
+    def close(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.monitor.cancel()
+
+
+class SubscriberTracker:
+    """
+    Tracks whether anyone on the bus has a match rule that would deliver our PropertiesChanged signals to them
+
+    The match rules come from the bus daemon's stats interface. They are looked up again when a client joins or leaves
+    the bus (NameOwnerChanged) and every RECHECK_INTERVAL seconds, because a client can add a match at any time. If the
+    bus does not offer the stats interface everyone is assumed to be listening.
+    """
+
+    RECHECK_INTERVAL = 10
+
+    # A client joins the bus before it adds its match, for this many seconds after a NameOwnerChanged the rules are
+    # looked up on every check (and once more after that) and not finding a match is uncertain()
+    JOIN_WINDOW = 2
+
+    RULE_PATTERN = re.compile(r"(\w+)='([^']*)'")
+
+    def __init__(self, bus, bus_name):
+        self.bus = bus
+        self.senders = [bus_name, bus.con.get_unique_name()]
+        self.available = True
+        self.last_check = None
+        # monotonic() of the last NameOwnerChanged, None if there was none
+        self.joined = None
+        self.rules = []
+        bus.subscribe(sender="org.freedesktop.DBus", iface="org.freedesktop.DBus", signal="NameOwnerChanged", signal_fired=self.on_name_owner_changed_)
+
+    def on_name_owner_changed_(self, sender, obj, iface, signal, params):
+        self.last_check = None
+        self.joined = monotonic()
+
+    # True while a client that just joined may still be about to add its match
+    def uncertain(self):
+        return self.joined is not None and monotonic() - self.joined < self.JOIN_WINDOW
+
+    def refresh_(self):
+        try:
+            reply = self.bus.con.call_sync("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus.Debug.Stats", "GetAllMatchRules",
+                None, GLib.VariantType.new("(a{sas})"), 0, 1000, None)
+        except GLib.Error:
+            self.available = False
+            return
+
+        rules = []
+        for connection, connection_rules in reply.unpack()[0].items():
+            if connection == self.senders[1]:
+                continue
+            for rule in connection_rules:
+                rules.append(dict(self.RULE_PATTERN.findall(rule)))
+        self.rules = rules
+
+    def matches_(self, rule, path):
+        if rule.get('type', 'signal') != 'signal':
+            return False
+        if 'sender' in rule and rule['sender'] not in self.senders:
+            return False
+        if rule.get('interface', 'org.freedesktop.DBus.Properties') != 'org.freedesktop.DBus.Properties':
+            return False
+        if rule.get('member', 'PropertiesChanged') != 'PropertiesChanged':
+            return False
+        if rule.get('arg0', 'net.mjjw.KrakenController') != 'net.mjjw.KrakenController':
+            return False
+        if 'path' in rule and rule['path'] != path:
+            return False
+        if 'path_namespace' in rule:
+            namespace = rule['path_namespace']
+            if not (namespace == '/' or path == namespace or path.startswith(namespace + '/')):
+                return False
+        return True
+
+    def has_subscribers(self, path):
+        if not self.available:
+            return True
+
+        now = monotonic()
+        settling = self.joined is not None and self.last_check is not None and self.last_check - self.joined < self.JOIN_WINDOW
+        if self.last_check is None or now - self.last_check > self.RECHECK_INTERVAL or settling:
+            self.last_check = now
+            self.refresh_()
+            if not self.available:
+                return True
+
+        for rule in self.rules:
+            if self.matches_(rule, path):
+                return True
+        return False
+
+
+class StatusRead:
+    """
+    A device status read in flight, the callers that find it there wait for it instead of reading again
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.status = None
+        self.error = None
+
+
+class KrakenDeviceSession:
+    """
+    Long lived connection to a Kraken device, reopened when the handle goes stale
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.description = device.description
+        # to find the device again if it goes away, worked out while it is still there
+        self.identity = device_identity(device)
+        self.connected = False
+        # maps the raw status descriptions (e.g. "Liquid temperature") to our short keys (e.g. "liquid"),
+        # these are fixed per device so they only need working out once
+        self.status_keys = {}
+        # the worker ticks the device but ReadNow reads it from the main loop, one transfer at a time
+        self.lock = RLock()
+        # the last status read and when (monotonic()), and the StatusRead in flight if any
+        self.status_lock = Lock()
+        self.status = None
+        self.status_time = 0
+        self.status_read = None
+
+    def open(self):
+        with self.lock:
+            if not self.connected:
+                self.device.connect()
+                self.connected = True
+
+    def close(self):
+        with self.lock:
+            if self.connected:
+                self.connected = False
+                try:
+                    self.device.disconnect()
+                except OSError:
+                    pass
+
+    def call_(self, fn, *args):
+        with self.lock:
+            self.open()
+            try:
+                return fn(*args)
+            except OSError:
+                # the handle has most likely gone stale (suspend/resume, USB reset, ...) so reopen it and try once more
+                self.close()
+                self.open()
+                return fn(*args)
+
+    # Returns a status read no more than max_age seconds ago, or else the one in flight or a new one: however many
+    # callers want the status at once (the tick, the refresh ReadNow asks for) the device is only read once
+    def get_status(self, max_age=0):
+        with self.status_lock:
+            if self.status is not None and monotonic() - self.status_time <= max_age:
+                return dict(self.status)
+            flight = self.status_read
+            leader = flight is None
+            if leader:
+                flight = self.status_read = StatusRead()
+
+        if leader:
+            try:
+                flight.status = self.read_status_()
+            except Exception as error:
+                flight.error = error
+            with self.status_lock:
+                self.status = flight.status
+                self.status_time = monotonic()
+                self.status_read = None
+            flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        # the callers add to it
+        return dict(flight.status)
+
+    # The last status read and how many seconds ago, or None, None if there is none. Never touches the device or waits
+    # for the device lock, so the main loop can call it, but a read in flight is waited for up to timeout seconds.
+    def peek_status(self, timeout):
+        flight = self.status_read
+        if flight is not None:
+            flight.done.wait(timeout)
+        with self.status_lock:
+            if self.status is None:
+                return None, None
+            return dict(self.status), monotonic() - self.status_time
+
+    def read_status_(self):
+        status = {}
+        for tup in self.call_(self.device.get_status):
+            key = self.status_keys.get(tup[0])
+            if key is None:
+                key = tup[0].lower().split(' ')[0]
+                self.status_keys[tup[0]] = key
+            status[key] = tup[1]
+        return status
+
+    def set_fixed_speed(self, target, speed):
+        self.call_(self.device.set_fixed_speed, target, speed)
+
+    def set_speed_profile(self, target, profile):
+        self.call_(self.device.set_speed_profile, target, profile)
+
+
+class HwmonSensor:
+    """
+    A temperature from sysfs, the sensor is resolved once and its file is kept open and re-read when it is read
+    """
+
+    HWMON_PATH = "/sys/class/hwmon"
+
+    # hwmon drivers that report the temperature, with the labels of the input we want in order of preference
+    HWMON_CHIPS = {}
+
+    # only take an input with one of the labels above, rather than the driver's first input, when the driver has labels
+    LABEL_REQUIRED = False
+
+    # used when none of the hwmon drivers above are loaded
+    FALLBACK_FILES = []
+
+    DESCRIPTION = "temperature"
+
+    # a reading is reused for this many seconds, for sensors that are slow or costly to read or that change slowly
+    MAX_AGE = 0
+
+    # how far (in C) the temperature has to move up or down since a target's last write for the target to follow it,
+    # see TargetHysteresis
+    MIN_TEMP_CHANGE_UP = 2
+    MIN_TEMP_CHANGE_DOWN = 5
+
+    def __init__(self):
+        self.path = None
+        self.fd = None
+        self.lock = Lock()
+        self.value = None
+        self.read_time = 0
+
+    def read_text_(self, filename):
+        try:
+            with open(filename, "r") as f:
+                return f.readline().strip()
+        except OSError:
+            return None
+
+    def find_hwmon_input_(self):
+        for hwmon in sorted(glob(path.join(self.HWMON_PATH, 'hwmon*'))):
+            labels = self.HWMON_CHIPS.get(self.read_text_(path.join(hwmon, 'name')))
+            if labels is None:
+                continue
+
+            inputs = sorted(glob(path.join(hwmon, 'temp*_input')), key=lambda p: int(path.basename(p)[4:-6]))
+            for label in labels:
+                for temp_input in inputs:
+                    if self.read_text_(temp_input[:-6] + '_label') == label:
+                        return temp_input
+
+            if inputs and not (self.LABEL_REQUIRED and labels):
+                return inputs[0]
+        return None
+
+    def resolve(self):
+        self.close()
+
+        temp_input = self.find_hwmon_input_()
+        if temp_input is None:
+            for tfile in self.FALLBACK_FILES:
+                if path.exists(tfile):
+                    temp_input = tfile
+                    break
+
+        if temp_input is None:
+            raise Exception("Unable to find " + self.DESCRIPTION)
+
+        self.fd = os.open(temp_input, os.O_RDONLY)
+        self.path = temp_input
+
+    def read(self):
+        # shared by the controllers of every device, which run on their own threads
+        with self.lock:
+            now = monotonic()
+            if self.value is not None and now - self.read_time < self.MAX_AGE:
+                return self.value
+
+            if self.fd is None:
+                self.resolve()
+
+            try:
+                # sysfs regenerates the value on every read from offset 0, so there is no need to reopen or seek
+                self.value = int(os.pread(self.fd, 32, 0)) / 1000
+            except (OSError, ValueError):
+                # the sensor has gone away (e.g. the driver was reloaded and the hwmon index changed), look for it again
+                self.resolve()
+                self.value = int(os.pread(self.fd, 32, 0)) / 1000
+            self.read_time = now
+            return self.value
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+
+class CpuTemperatureSensor(HwmonSensor):
+    HWMON_CHIPS = {
+        'k10temp': ['Tctl', 'Tdie'],
+        'zenpower': ['Tctl', 'Tdie'],
+        'coretemp': ['Package id 0'],
+    }
+
+    FALLBACK_FILES = [
+        '/sys/devices/platform/coretemp.0/temp1_input',
+        '/sys/bus/acpi/devices/LNXTHERM:00/thermal_zone/temp',
+        '/sys/devices/virtual/thermal/thermal_zone0/temp',
+        '/sys/bus/acpi/drivers/ATK0110/ATK0110:00/hwmon/hwmon0/temp1_input'
+    ]
+
+    DESCRIPTION = "CPU temperature"
+
+
+class GpuTemperatureSensor(HwmonSensor):
+    # the open source drivers, the nvidia driver has no hwmon interface (see NvmlTemperatureSensor)
+    HWMON_CHIPS = {
+        'amdgpu': ['edge'],
+        'radeon': [],
+        'nouveau': [],
+    }
+
+    DESCRIPTION = "GPU temperature"
+    MAX_AGE = 1.0
+
+
+class NvmeTemperatureSensor(HwmonSensor):
+    HWMON_CHIPS = {
+        'nvme': ['Composite'],
+    }
+
+    DESCRIPTION = "NVMe temperature"
+
+    # every read is an admin command to the drive, which can also keep it out of its low power states, and the
+    # temperature of a drive moves slowly anyway
+    MAX_AGE = 5.0
+    MIN_TEMP_CHANGE_UP = 1
+    MIN_TEMP_CHANGE_DOWN = 2
+
+
+class ChipsetTemperatureSensor(HwmonSensor):
+    HWMON_CHIPS = {
+        'asus_ec_sensors': ['Chipset'],
+        'nct6775': ['PCH_CHIP_TEMP', 'PCH_CHIP_CPU_MAX_TEMP'],
+        'pch_skylake': [],
+        'pch_cannonlake': [],
+        'pch_cometlake': [],
+    }
+
+    # the Super I/O chips have a dozen inputs, only the chipset one will do
+    LABEL_REQUIRED = True
+    DESCRIPTION = "chipset temperature"
+    MAX_AGE = 2.0
+    MIN_TEMP_CHANGE_UP = 1
+    MIN_TEMP_CHANGE_DOWN = 2
+
+
+class NvmlTemperatureSensor:
+    """
+    Temperature of the first NVIDIA GPU through NVML, needs nvidia-ml-py
+    """
+
+    DESCRIPTION = "NVIDIA GPU temperature"
+    MAX_AGE = 1.0
+    MIN_TEMP_CHANGE_UP = 2
+    MIN_TEMP_CHANGE_DOWN = 5
+
+    def __init__(self):
+        self.path = None
+        self.nvml = None
+        self.handle = None
+        self.lock = Lock()
+        self.value = None
+        self.read_time = 0
+
+    def resolve(self):
+        try:
+            import pynvml
+        except ImportError:
+            raise Exception("Unable to find " + self.DESCRIPTION + ", nvidia-ml-py is not installed")
+        pynvml.nvmlInit()
+        self.nvml = pynvml
+        self.handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        name = pynvml.nvmlDeviceGetName(self.handle)
+        self.path = "nvml:" + (name.decode() if isinstance(name, bytes) else name)
+
+    def read(self):
+        with self.lock:
+            now = monotonic()
+            if self.value is not None and now - self.read_time < self.MAX_AGE:
+                return self.value
+
+            if self.handle is None:
+                self.resolve()
+            self.value = float(self.nvml.nvmlDeviceGetTemperature(self.handle, self.nvml.NVML_TEMPERATURE_GPU))
+            self.read_time = now
+            return self.value
+
+    def close(self):
+        if self.nvml is not None:
+            self.nvml.nvmlShutdown()
+        self.nvml = None
+        self.handle = None
+
+
+# The temperature sources curves can be declared for besides 'cpu' and 'liquid', as <source>_fan_curve and
+# <source>_pump_curve in the [custom] section
+SENSORS = {
+    'gpu': GpuTemperatureSensor,
+    'nvidia': NvmlTemperatureSensor,
+    'nvme': NvmeTemperatureSensor,
+    'chipset': ChipsetTemperatureSensor,
+}
+
+
+class SensorRegistry:
+    """
+    The host temperature sensors by source, shared by the controllers of every device. A sensor in SENSORS is only
+    looked for the first time a curve asks for it, one that can't be found or read reads as None.
+    """
+
+    # the liquid temperature is read from the device rather than by a sensor here, its deadband as (up, down)
+    LIQUID_TEMP_CHANGE = (1, 2)
+
+    def __init__(self, cpu_sensor):
+        self.sensors = {'cpu': cpu_sensor}
+        self.missing = set()
+        self.lock = Lock()
+
+    def sensor_(self, source):
+        with self.lock:
+            if source in self.sensors or source in self.missing:
+                return self.sensors.get(source)
+
+            sensor = SENSORS[source]()
+            try:
+                sensor.resolve()
+            except Exception as error:
+                print(error)
+                self.missing.add(source)
+                return None
+            print(sensor.DESCRIPTION + ": ", sensor.path)
+            self.sensors[source] = sensor
+            return sensor
+
+    def read(self, source):
+        sensor = self.sensors.get(source)
+        if sensor is None:
+            sensor = self.sensor_(source)
+            if sensor is None:
+                return None
+        try:
+            return sensor.read()
+        except Exception:
+            return None
+
+    # The deadband of source going up or down, see HwmonSensor.MIN_TEMP_CHANGE_UP. A source without one of its own, such
+    # as the simulated CPU sensor, gets HwmonSensor's.
+    def min_temp_change(self, source, rising):
+        if source == 'liquid':
+            return self.LIQUID_TEMP_CHANGE[0 if rising else 1]
+        sensor = self.sensors[source] if source in self.sensors else SENSORS.get(source, HwmonSensor)
+        name = 'MIN_TEMP_CHANGE_UP' if rising else 'MIN_TEMP_CHANGE_DOWN'
+        return getattr(sensor, name, getattr(HwmonSensor, name))
+
+    def close(self):
+        for sensor in self.sensors.values():
+            sensor.close()
+
+
+class LoadSensor:
+    """
+    How hard the CPU is working, from the package power (RAPL through powercap) as a fraction of the CPU's TDP if the
+    system has it or else from the CPU utilisation in /proc/stat. Both are worked out from the change since the previous
+    read, the files are kept open.
+    """
+
+    PROC_STAT = "/proc/stat"
+    POWERCAP_PATH = "/sys/class/powercap"
+
+    # Reads closer together than this (in seconds) return the previous value, the devices each read it every tick
+    MIN_PERIOD = 0.1
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stat_fd = None
+        self.energy_fd = None
+        self.energy_range = 0
+        self.last_time = None
+        self.last_busy = 0
+        self.last_total = 0
+        self.last_energy = 0
+        # the package's long term power limit in watts from powercap, 0 if it has none
+        self.max_power = 0.0
+        self.value = None
+
+    def read_text_(self, filename):
+        try:
+            with open(filename, "r") as f:
+                return f.readline().strip()
+        except OSError:
+            return None
+
+    def open(self):
+        self.stat_fd = os.open(self.PROC_STAT, os.O_RDONLY)
+        for zone in sorted(glob(path.join(self.POWERCAP_PATH, '*'))):
+            if self.read_text_(path.join(zone, 'name')) != 'package-0':
+                continue
+            try:
+                self.energy_fd = os.open(path.join(zone, 'energy_uj'), os.O_RDONLY)
+                self.energy_range = int(self.read_text_(path.join(zone, 'max_energy_range_uj')))
+            except (OSError, TypeError, ValueError):
+                self.energy_fd = None
+            for name in ['constraint_0_max_power_uw', 'constraint_0_power_limit_uw']:
+                try:
+                    self.max_power = int(self.read_text_(path.join(zone, name))) / 1000000
+                except (TypeError, ValueError):
+                    continue
+                if self.max_power > 0:
+                    break
+            break
+
+    # Returns the load as a fraction of tdp watts (the package's power limit if 0) up to 1, or of all the CPUs being busy
+    # if the power can't be read or there is nothing to compare it with. None until there are two reads to compare.
+    def read(self, tdp=0):
+        with self.lock:
+            if self.stat_fd is None:
+                self.open()
+
+            now = monotonic()
+            if self.last_time is not None and now - self.last_time < self.MIN_PERIOD:
+                return self.value
+
+            # the first line is the total over every CPU: user nice system idle iowait irq softirq steal ...
+            times = [int(value) for value in os.pread(self.stat_fd, 256, 0).split(b'\n', 1)[0].split()[1:9]]
+            total = sum(times)
+            busy = total - times[3] - times[4]
+            energy = int(os.pread(self.energy_fd, 32, 0)) if self.energy_fd is not None else 0
+
+            reference = tdp if tdp > 0 else self.max_power
+            if self.last_time is not None:
+                if self.energy_fd is not None and reference > 0:
+                    used = energy - self.last_energy
+                    if used < 0:
+                        # the counter wrapped
+                        used += self.energy_range
+                    power = used / 1000000 / (now - self.last_time)
+                    self.value = min(1.0, power / reference)
+                elif total > self.last_total:
+                    self.value = (busy - self.last_busy) / (total - self.last_total)
+
+            self.last_time = now
+            self.last_busy = busy
+            self.last_total = total
+            self.last_energy = energy
+            return self.value
+
+    def close(self):
+        for fd in [self.stat_fd, self.energy_fd]:
+            if fd is not None:
+                os.close(fd)
+        self.stat_fd = None
+        self.energy_fd = None
+
+
+class FeedForward:
+    """
+    Predicts how far the CPU temperature is about to climb, from a jump in the load (a fast moving average of it
+    pulling away from a slow one) and from the smoothed temperature slope. The state is a handful of numbers.
+    """
+
+    FAST_TIME_CONSTANT = 1.0
+    SLOW_TIME_CONSTANT = 30.0
+    SLOPE_TIME_CONSTANT = 2.0
+
+    def __init__(self):
+        self.last_time = None
+        self.last_temp = 0.0
+        self.fast = None
+        self.slow = None
+        self.slope = 0.0
+
+    # Returns the lead (in C) to add to the CPU temperature. gain is the lead for going from idle to full load, horizon
+    # how many seconds ahead the slope is projected. load (0-1) is None if it is not known.
+    def update(self, now, temp, load, gain, horizon):
+        if self.last_time is None or now <= self.last_time:
+            self.last_time = now
+            self.last_temp = temp
+            return 0.0
+
+        elapsed = now - self.last_time
+        self.slope += (1 - exp(-elapsed / self.SLOPE_TIME_CONSTANT)) * ((temp - self.last_temp) / elapsed - self.slope)
+        self.last_time = now
+        self.last_temp = temp
+
+        lead = horizon * max(0.0, self.slope)
+        if load is not None:
+            if self.fast is None:
+                self.fast = load
+                self.slow = load
+            self.fast += (1 - exp(-elapsed / self.FAST_TIME_CONSTANT)) * (load - self.fast)
+            self.slow += (1 - exp(-elapsed / self.SLOW_TIME_CONSTANT)) * (load - self.slow)
+            lead += gain * max(0.0, self.fast - self.slow)
+        return lead
+
+
+class TargetHysteresis:
+    """
+    The hysteresis of one target (fan or pump): the speed set last, when and at which temperatures, and what the device
+    reports back for it
+
+    A target only moves once a source that drives it has moved far enough since the target's own last write and long
+    enough has passed, so a pump change never resets the fan's timers or drags the fan into a write. Some firmwares
+    always report a duty a little off the one set, a difference that is still there after the speed was set again is
+    learned as that duty's readback offset instead of being corrected every FORCE_SET_INTERVAL.
+    """
+
+    # at the speed the curves ask for, waiting to go up or down, or left to the firmware (see upload_profile_)
+    HOLD = 'hold'
+    RISING = 'rising'
+    FALLING = 'falling'
+    OFFLOADED = 'offloaded'
 
-    PropertiesChanged = signal()
+    def __init__(self):
+        self.state = self.HOLD
+        self.set = 0
+        self.last_write = 0
+        # since when the curves have asked for less without a break
+        self.falling_since = 0
+        # the temperatures of the sources driving the target at the last write
+        self.last_temp = {}
+        # learned difference between the duty reported and the duty set, and the difference that was corrected but not
+        # learned yet, by duty set
+        self.readback_offset = {}
+        self.corrected = {}
+
+    # Nothing set before can be relied on, e.g. after the device was lost. The readback offsets belong to the firmware
+    # and are kept.
+    def forget(self):
+        self.state = self.HOLD
+        self.set = 0
+
+    # Moves towards speed, temps are the temperatures of the sources driving the target. Returns None while at speed,
+    # 'up' or 'down' if speed is to be written now, or 'deadband' or 'timer' for what is holding it back.
+    def step(self, now, target, speed, temps, controller):
+        if speed == self.set:
+            self.state = self.HOLD
+            return None
+
+        rising = speed > self.set
+        if not rising and self.state != self.FALLING:
+            self.falling_since = now
+        self.state = self.RISING if rising else self.FALLING
+        # the temperatures are those of the sources with a curve for the target, in fixed mode too (a new fixed speed
+        # from a config change is forced through rather than waiting here). A target none of them can be read for this
+        # tick has no temperatures to go by and moves on the timer alone.
+        if temps and not any(source not in self.last_temp or abs(temp - self.last_temp[source]) >= controller.sensors.min_temp_change(source, rising) for source, temp in temps.items()):
+            return 'deadband'
+        if abs(speed - self.set) < controller.MIN_SPEED_CHANGE[target] and speed not in (controller.MIN_SPEED[target], controller.MAX_SPEED[target]):
+            return 'deadband'
+        # going down also waits for the curves to have asked for less all along, so a short dip is not followed by
+        # going straight back up
+        if now - (self.last_write if rising else max(self.last_write, self.falling_since)) <= (controller.MIN_TIME_CHANGE_UP if rising else controller.MIN_TIME_CHANGE_DOWN):
+            return 'timer'
+        return 'up' if rising else 'down'
+
+    # Compares the duty the device reports with the one set, FORCE_SET_INTERVAL after the last write. Returns None if
+    # it matches (give or take the learned offset), 'readback' if speed (the speed the curves ask for, which may still
+    # be held back) should be written now or 'tolerated' if the same difference was reported after writing it and has
+    # now been learned. The difference is kept for the duty checked and for the duty written, the one checked next time.
+    def check_readback(self, now, current, speed, controller):
+        if now - self.last_write <= controller.FORCE_SET_INTERVAL:
+            return None
+        error = current - self.set
+        if abs(error - self.readback_offset.get(self.set, 0)) <= controller.FORCE_SET_THRESHOLD:
+            return None
+        if self.set in self.corrected and abs(error - self.corrected[self.set]) <= controller.FORCE_SET_THRESHOLD:
+            self.readback_offset[self.set] = error
+            del self.corrected[self.set]
+            return 'tolerated'
+        self.corrected[self.set] = error
+        self.corrected[speed] = error
+        return 'readback'
+
+    def wrote(self, now, speed, temps):
+        self.state = self.HOLD
+        self.set = speed
+        self.last_write = now
+        self.last_temp = temps
 
 
 class KrakenController:
@@ -393,241 +1680,978 @@ class KrakenController:
     SOURCES = ['cpu', 'liquid']
     TARGETS = ['fan', 'pump']
 
-    # The time (in seconds) to wait between checking speeds
+    # The time (in seconds) to wait before the first check, after that the PollScheduler adapts it
     CHECK_INTERVAL = 1
 
+    # A status read this recent (in seconds) is good enough for ReadNow and for the updates after a boost or a config
+    # change, the scheduled ticks always read afresh. ReadNow waits for a read the worker has in flight for at most
+    # READ_NOW_WAIT.
+    STATUS_TTL = 0.25
+    READ_NOW_WAIT = 0.05
+
     # If the speed is not the desired speed after a given time, update it again
     FORCE_SET_INTERVAL = 10
     FORCE_SET_THRESHOLD = 3
 
-    # Hysteresis - scale up more aggressively than down
-    MIN_TEMP_CHANGE_UP = {'cpu': 2, 'liquid': 1}
-    MIN_TEMP_CHANGE_DOWN = {'cpu': 5, 'liquid': 2}
+    # Why a target's speed was written, or held back from the speed the curves ask for (see TargetHysteresis)
+    WRITE_REASONS = ['up', 'down', 'boost', 'boost_end', 'critical', 'readback', 'takeover', 'forced']
+    HOLD_REASONS = ['deadband', 'timer', 'tolerated']
+
+    # Reconnecting to a device that stopped answering, the attempts back off from RETRY_MIN to RETRY_MAX seconds. After
+    # SAFE_DEADLINE seconds without it the maximum speeds are sent, in case writes still get through when reads do not.
+    RETRY_MIN = 0.25
+    RETRY_MAX = 8
+    SAFE_DEADLINE = 10
+
+    # Hysteresis - scale up more aggressively than down, the temperature deadbands belong to each sensor (see
+    # SensorRegistry.min_temp_change)
     MIN_TIME_CHANGE_UP = 0
     MIN_TIME_CHANGE_DOWN = 10
+    # a duty change smaller than this is not worth a write, unless it gets to the minimum or maximum speed
+    MIN_SPEED_CHANGE = {'fan': 2, 'pump': 2}
     MIN_BOOST_DURATION = 10
 
     MIN_SPEED = {'fan': 25, 'pump': 60}
     MAX_SPEED = {'fan': 100, 'pump': 100}
 
-    def __init__(self, dbus_interface, configMgr):
-        # find the Kraken
-        supported_devices = KrakenZ3.find_supported_devices()
-
-        if not supported_devices:
-            supported_devices = KrakenX3.find_supported_devices()
-
-        if not supported_devices:
-            supported_devices = KrakenTwoDriver.find_supported_devices()
-
-        if not supported_devices:
-            raise Exception('Failed to find the Kraken X')
-
-        print("Found device: ", supported_devices[0].description)
-        self.kraken_device = supported_devices[0]
+    def __init__(self, dbus_interface, configMgr, device, cpu_sensor):
+        self.session = KrakenDeviceSession(device)
+        self.session.open()
+        self.cpu_sensor = cpu_sensor
+        # the sensors of any other sources the curves use, KrakenControllerGroup shares one between the devices
+        self.sensors = SensorRegistry(cpu_sensor)
 
         self.configMgr = configMgr
-        dbus_interface.KrakenDevice = supported_devices[0].description
+        dbus_interface.KrakenDevice = device.description
 
-        # The last update to the speeds
-        self.last_update = 0
-        self.last_temp = {'cpu': 0, 'liquid': 0}
-        self.last_speed_set = {'fan': 0, 'pump': 0}
+        # The last update to each speed
+        self.hysteresis = {target: TargetHysteresis() for target in self.TARGETS}
+        # write and hold decisions by target and reason
+        self.decisions = {target: dict.fromkeys(self.WRITE_REASONS + self.HOLD_REASONS, 0) for target in self.TARGETS}
         self.dbus_interface = dbus_interface
         self.boost_start = 0
         self.dbus_interface.controller = self
         self.was_boosting = False
+        self.reading = None
+        self.published = None
+        self.temps = {}
+        # the last CPU temperature read on the worker, for ReadNow
+        self.cpu_now = None
+        self.history = TelemetryHistory(configMgr.config['history_size'])
+        # the on disk HistoryLog, if enabled
+        self.log = None
+        # time source of the control logic, pulleyreplay.py swaps it for a simulated clock
+        self.clock = monotonic
+        self.was_critical = False
+        # running totals for the metrics exporter
+        self.counters = {'usb_writes': 0, 'boosts': 0, 'critical_trips': 0, 'force_set_corrections': 0, 'device_errors': 0, 'recoveries': 0}
+        self.timings = TickTimings()
+        # scheduled checks so far, unlike timings.ticks this leaves out the updates Boost and config changes run
+        self.ticks = 0
+        # the liquid curve (and liquid critical temperature) running on the device for each target in firmware offload
+        # mode, None while the host sets the speed
+        self.profile = {'fan': None, 'pump': None}
+        self.offload_supported = True
+        self.feed_forward = FeedForward()
+        # the LoadSensor feeding it, shared by every device
+        self.load_sensor = None
+        # while the device is not answering: when it stopped, when to try again and whether it was sent the safe speeds
+        self.lost_since = None
+        self.retry_at = 0
+        self.retry_delay = self.RETRY_MIN
+        self.safe = False
+        # seconds it took to get the device back, the last time and the longest
+        self.last_recovery = None
+        self.max_recovery = None
 
     # Run fan and pump at maximum for a few minutes
     def boost(self):
-        self.boost_start = monotonic()
-        self.update_speed_(True)
+        self.boost_start = self.clock()
+        self.update_speed_(True, self.STATUS_TTL)
 
     # Returns a dictionary containing the status details of the Kraken.
     #
     # Possible keys: fan, liquid, firmware, pump (and now cpu too, for convenience)
     def status(self):
-        status = {}
-
-        rawStatus = self.kraken_device.get_status()
-        for tup in rawStatus:
-            status[tup[0].lower().split(' ')[0]] = tup[1]
-
+        status = self.session.get_status()
         status['cpu'] = self.cpu_temperature()
 
         # if status['liquid'] < 5:
-        #     print(rawStatus)
+        #     print(status)
 
         return status
 
     def cpu_temperature(self):
-        # lifted from a list I found online somewhere, I forget where but
-        # give full credit that I did not compile this myself
-        temperatureFiles = [
-            '/sys/class/hwmon/hwmon0/temp1_input',
-            '/sys/devices/platform/coretemp.0/temp1_input',
-            '/sys/bus/acpi/devices/LNXTHERM:00/thermal_zone/temp',
-            '/sys/devices/virtual/thermal/thermal_zone0/temp',
-            '/sys/bus/acpi/drivers/ATK0110/ATK0110:00/hwmon/hwmon0/temp1_input',
-            '/proc/acpi/thermal_zone/THM0/temperature',
-            '/proc/acpi/thermal_zone/THRM/temperature',
-            '/proc/acpi/thermal_zone/THR0/temperature',
-            '/proc/acpi/thermal_zone/TZ0/temperature',
-            '/sys/class/hwmon/hwmon0/device/temp1_input'
-        ]
-        for tfile in temperatureFiles:
-            if path.exists(tfile):
-                content = open(tfile, "r").readline()
-                return float(content.split(' ')[0]) / 1000
-
-        raise Exception("Unable to find CPU temperature")
+        return self.cpu_sensor.read()
+
+    # Brings the status ReadNow gives up to date, on the worker. Merges with any tick reading the device at the same
+    # time, a device error is left for the next tick to deal with.
+    def refresh_status_(self):
+        try:
+            self.session.get_status(self.STATUS_TTL)
+        except OSError:
+            pass
+        self.cpu_now = self.cpu_temperature()
 
     def update_speed(self):
-        self.update_speed_(False)
+        self.ticks += 1
+        if self.lost_since is not None and self.clock() < self.retry_at:
+            return
 
-    def update_speed_(self, autoforce):
-        with self.kraken_device.connect():
-            status = self.status()
+        try:
+            # after getting the device back every speed is written again, it may have been reset
+            self.update_speed_(self.lost_since is not None)
+        except OSError as error:
+            self.device_error_(error)
+            return
 
-            self.dbus_interface.CPUTemp = int(status['cpu'])
-            if not (status['liquid'] < 5 and status['fan'] == 0 and status['pump'] == 0):
-                self.dbus_interface.LiquidTemp = int(status['liquid'])
-                self.dbus_interface.FanDuty = int(status['fan'])
-                self.dbus_interface.PumpDuty = int(status['pump'])
+        if self.lost_since is not None:
+            recovery = self.clock() - self.lost_since
+            print("Recovered " + self.session.description + " after %.1fs" % recovery)
+            self.last_recovery = recovery
+            self.max_recovery = max(recovery, self.max_recovery or 0)
+            self.counters['recoveries'] += 1
+            self.lost_since = None
+            self.safe = False
+
+    # The device did not answer even after reopening it (see KrakenDeviceSession), keep trying with backoff rather than
+    # giving up on it
+    def device_error_(self, error):
+        now = self.clock()
+        self.counters['device_errors'] += 1
+        self.session.close()
+        if self.lost_since is None:
+            print("Lost " + self.session.description + ": " + str(error))
+            self.lost_since = now
+            self.retry_delay = self.RETRY_MIN
+            self.temps = {}
+            # nothing we set or uploaded can be relied on once it answers again
+            for target in self.TARGETS:
+                self.hysteresis[target].forget()
+            self.profile = {'fan': None, 'pump': None}
+        else:
+            self.retry_delay = min(self.RETRY_MAX, self.retry_delay * 2)
+            self.reprobe_()
+        self.retry_at = now + self.retry_delay
+        if not self.safe and now < self.lost_since + self.SAFE_DEADLINE:
+            # don't let the backoff put off the safe speeds
+            self.retry_at = min(self.retry_at, self.lost_since + self.SAFE_DEADLINE)
+
+        if not self.safe and now - self.lost_since >= self.SAFE_DEADLINE:
+            try:
+                for target in self.TARGETS:
+                    self.session.set_fixed_speed(target, self.MAX_SPEED[target])
+                    self.counters['usb_writes'] += 1
+                self.safe = True
+                print("Set " + self.session.description + " to maximum speed until it answers again")
+            except OSError:
+                self.session.close()
+
+    # A replug or a hub reset brings the device back at a new USB address, look for it again among the devices of its
+    # own driver only
+    def reprobe_(self):
+        try:
+            found = type(self.session.device).find_supported_devices()
+        except OSError:
+            return
+        matches = [device for device in found if device_identity(device) == self.session.identity]
+        if len(matches) == 1:
+            self.session.device = matches[0]
+
+    # How often the device was lost and how long it took to get it back, for GetStats
+    def recovery_stats(self):
+        return {
+            'connected': self.lost_since is None,
+            'lost_for_s': self.clock() - self.lost_since if self.lost_since is not None else 0.0,
+            'device_errors': self.counters['device_errors'],
+            'recoveries': self.counters['recoveries'],
+            'last_recovery_s': self.last_recovery,
+            'max_recovery_s': self.max_recovery}
+
+    def update_speed_(self, autoforce, max_age=0):
+        # same as self.status() but with each read timed
+        start = perf_counter_ns()
+        status = self.session.get_status(max_age)
+        status_done = perf_counter_ns()
+        status['cpu'] = self.cpu_now = self.cpu_temperature()
+        # the config can be replaced from D-Bus while we are running, stick to one version of it for the whole tick
+        config = self.configMgr.config
+        bank = self.configMgr.bank
+        curves = bank.curves
+        for source in bank.sources:
+            if source not in self.SOURCES:
+                status[source] = self.sensors.read(source)
+        # recorded in the history too, so a logged trace can replay feed forward
+        load = None
+        if (config['feed_forward'] or self.log is not None) and self.load_sensor is not None:
+            load = self.load_sensor.read(config['cpu_tdp'])
+        cpu_temp_done = perf_counter_ns()
+        set_speed_ns = 0
+
+        self.temps = {'cpu': status['cpu'], 'liquid': status['liquid']}
+
+        # the temperatures the curves are looked up at, with feed forward the CPU one is raised by how far the
+        # temperature is about to climb so the speeds start going up before it does
+        curve_temp = {source: status[source] for source in self.SOURCES + bank.sources}
+        if config['feed_forward']:
+            curve_temp['cpu'] += self.feed_forward.update(self.clock(), status['cpu'], load, config['feed_forward_gain'], config['feed_forward_horizon'])
+        reading = {'time': time(), 'cpu': status['cpu'], 'load': load}
+        if not (status['liquid'] < 5 and status['fan'] == 0 and status['pump'] == 0):
+            reading['liquid'] = status['liquid']
+            reading['fan'] = int(status['fan'])
+            reading['pump'] = int(status['pump'])
+
+        current_speed = {}
+        new_speed = {}
+        # the reason a target is written whatever the hysteresis says
+        force_reason = {}
+
+        for target in self.TARGETS:
+            current_speed[target] = int(status[target])
+            new_speed[target] = 0
+            force_reason[target] = None
+
+        boost_duration = max(config['boost_duration'], config['max_interval']*1.5, self.MIN_BOOST_DURATION)
+        boosting = self.clock() < (self.boost_start + boost_duration)
+        if boosting:
+            if not self.was_boosting:
+                # print("pulley boost started for approx " + str(boost_duration) + "s")
+                self.was_boosting = True
+                self.boost_start = self.clock()
+                self.counters['boosts'] += 1
 
-            forced = autoforce
-            current_speed = {}
-            new_speed = {}
-            force_update = {}
+            for target in self.TARGETS:
+                new_speed[target] = self.MAX_SPEED[target]
+                if self.hysteresis[target].set != new_speed[target]:
+                    force_reason[target] = 'boost'
+        elif self.was_boosting:
+            # print("pulley boost ended")
+            self.was_boosting = False
+            for target in self.TARGETS:
+                force_reason[target] = 'boost_end'
+
+        reached_critical_temp = False
+        for source in self.SOURCES:
+            # there seems to be a bug in liquidctl (or in our use of it?) where sometimes temperature is 0, 1 or 2 C and
+            # all other values are 0. The critical liquid temp is checked even if we are not using the liquid temperature
+            # to control speeds.
+            if status[source] > 5 and status[source] >= int(config[source + "_critical"]):
+                reached_critical_temp = True
+
+        # the temperature each curve is looked up at, None for the sources not to be used this tick
+        temps = []
+        for source in bank.sources:
+            if status[source] is None or status[source] <= 5 or (source == 'liquid' and not config['use_liquid_temp']):
+                temps.append(None)
+            else:
+                temps.append(curve_temp[source])
 
+        # the maximum speed any source asks for, e.g. if liquid resolves fan speed 25 and cpu resolves fan speed 30
+        # then fan speed will be 30
+        if reached_critical_temp:
             for target in self.TARGETS:
-                current_speed[target] = int(status[target])
+                new_speed[target] = self.MAX_SPEED[target]
+        elif temps.count(None) < len(temps):
+            if config['mode'] == 'fixed':
+                speeds = {target: config['fixed_' + target + '_speed'] for target in self.TARGETS}
+            else:
+                speeds = {target: speed for target, speed in zip(bank.targets, bank.evaluate(temps)) if speed >= 0}
+            for target in speeds:
+                new_speed[target] = int(min(self.MAX_SPEED[target], max(self.MIN_SPEED[target], new_speed[target], speeds[target])))
+
+        if reached_critical_temp and config['boost_after_critical']:
+            if not self.was_boosting:
+                # print("critical temp reached, pulley will boost to maximum duty")
+                # print("pulley boost started until temperature is reduced")
+                self.was_boosting = True
+                self.counters['boosts'] += 1
+            self.boost_start = self.clock()
+
+        if reached_critical_temp and not self.was_critical:
+            self.counters['critical_trips'] += 1
+        self.was_critical = reached_critical_temp
+
+        time_now = self.clock()
+
+        # each target only goes by the temperatures of the sources with a curve for it
+        drivers = {target: [] for target in self.TARGETS}
+        for n in range(len(bank.source_idx)):
+            source = bank.sources[bank.source_idx[n]]
+            target = bank.targets[bank.target_idx[n]]
+            if target in drivers and temps[bank.source_idx[n]] is not None and source not in drivers[target]:
+                drivers[target].append(source)
+        target_temps = {target: {source: curve_temp[source] for source in drivers[target]} for target in self.TARGETS}
+
+        # in firmware offload mode the device runs the liquid curves itself, the host only takes a target back when the
+        # CPU curve, a boost or a critical temperature asks for more than the liquid curve gives. Taking it back and
+        # handing it back both go through the target's hysteresis like any other change, so a CPU temperature hovering
+        # where its curve crosses the liquid curve does not swap the target between the two on every tick.
+        offloaded = []
+        offload = config['firmware_offload'] and self.offload_supported and config['mode'] == 'custom' and config['use_liquid_temp']
+        for target in self.TARGETS:
+            curve = curves['liquid_' + target]
+            if offload and 'liquid' not in reading and self.profile[target] is not None:
+                # a bogus reading, leave the firmware to it
+                offloaded.append(target)
                 new_speed[target] = 0
-                force_update[target] = False
+                continue
+
+            if offload and 'liquid' in reading and not self.was_boosting and not reached_critical_temp:
+                hysteresis = self.hysteresis[target]
+                liquid_speed = int(min(self.MAX_SPEED[target], max(self.MIN_SPEED[target], curve.speed(status['liquid']))))
+                if self.profile[target] is not None:
+                    # what the firmware should be running at, it follows the liquid temperature by itself so only the
+                    # other sources are held to the temperatures of the hand-off
+                    hysteresis.set = liquid_speed
+                    if 'liquid' in target_temps[target]:
+                        hysteresis.last_temp = dict(hysteresis.last_temp, liquid=target_temps[target]['liquid'])
+                    reason = None
+                    if new_speed[target] > liquid_speed:
+                        reason = hysteresis.step(time_now, target, new_speed[target], target_temps[target], self)
+                    if reason not in self.WRITE_REASONS:
+                        if reason is not None:
+                            self.decisions[target][reason] += 1
+                        if self.profile[target] != (curve, config['liquid_critical']):
+                            # the curve or the critical temperature changed
+                            upload_start = perf_counter_ns()
+                            self.upload_profile_(target, config, curve)
+                            set_speed_ns += perf_counter_ns() - upload_start
+                        if self.profile[target] is not None:
+                            offloaded.append(target)
+                            new_speed[target] = 0
+                            continue
+                elif new_speed[target] <= liquid_speed and hysteresis.step(time_now, target, liquid_speed, target_temps[target], self) not in self.HOLD_REASONS:
+                    # the host has the target, it is handed back once the curves ask for no more than the liquid curve
+                    # and it would have moved there by itself. While held it stays with the host below.
+                    upload_start = perf_counter_ns()
+                    if self.upload_profile_(target, config, curve):
+                        hysteresis.wrote(time_now, liquid_speed, target_temps[target])
+                        offloaded.append(target)
+                        new_speed[target] = 0
+                    set_speed_ns += perf_counter_ns() - upload_start
+                    if target in offloaded:
+                        continue
 
-            boost_duration = max(self.configMgr.config['boost_duration'], self.CHECK_INTERVAL*1.5, self.MIN_BOOST_DURATION)
-            boosting = monotonic() < (self.boost_start + boost_duration)
-            if boosting:
-                if not self.was_boosting:
-                    # print("pulley boost started for approx " + str(boost_duration) + "s")
-                    self.was_boosting = True
-                    self.boost_start = monotonic()
+            if self.profile[target] is not None:
+                # take the target back from the firmware
+                self.profile[target] = None
+                force_reason[target] = 'takeover'
+
+        # print("New speeds: ", new_speed)
+
+        for target in self.TARGETS:
+            hysteresis = self.hysteresis[target]
+            if target in offloaded:
+                hysteresis.state = hysteresis.OFFLOADED
+                continue
+            if new_speed[target] <= 0:
+                continue
+
+            reason = force_reason[target]
+            if reason is None and new_speed[target] != hysteresis.set:
+                if reached_critical_temp:
+                    reason = 'critical'
+                elif autoforce:
+                    reason = 'forced'
+            if reason is None:
+                reason = hysteresis.step(time_now, target, new_speed[target], target_temps[target], self)
+                # after a period of time ensure that the set speed was actually set, unless the reading is bogus
+                if reason not in self.WRITE_REASONS and 'liquid' in reading:
+                    reason = hysteresis.check_readback(time_now, current_speed[target], new_speed[target], self) or reason
+            if reason is None:
+                continue
+
+            self.decisions[target][reason] += 1
+            if reason in self.WRITE_REASONS:
+                # print("Setting ", target, " ", hysteresis.set, " => ", new_speed[target], " (" + reason + ")")
+                set_speed_start = perf_counter_ns()
+                self.session.set_fixed_speed(target, new_speed[target])
+                set_speed_ns += perf_counter_ns() - set_speed_start
+                hysteresis.wrote(time_now, new_speed[target], target_temps[target])
+                self.counters['usb_writes'] += 1
+                if reason == 'readback':
+                    self.counters['force_set_corrections'] += 1
+
+        reading['fan_set'] = self.hysteresis['fan'].set
+        reading['pump_set'] = self.hysteresis['pump'].set
+        self.reading = reading
+
+        decide_ns = perf_counter_ns() - cpu_temp_done - set_speed_ns
+        self.timings.record(status_done - start, cpu_temp_done - status_done, decide_ns, set_speed_ns)
+
+    # Uploads the liquid curve of target to the device as a speed profile that goes to full speed at the liquid critical
+    # temperature, so the device stays safe even if pulley stops. Returns False if the device can not run profiles.
+    def upload_profile_(self, target, config, curve):
+        critical = config['liquid_critical']
+        profile = []
+        for temp, speed in zip(config['liquid_' + target + '_temp'], config['liquid_' + target + '_speed']):
+            if temp < critical:
+                profile.append((temp, int(min(self.MAX_SPEED[target], max(self.MIN_SPEED[target], speed)))))
+        profile.append((critical, self.MAX_SPEED[target]))
 
-                for target in self.TARGETS:
-                    new_speed[target] = self.MAX_SPEED[target]
-                    if self.last_speed_set[target] != new_speed[target]:
-                        force_update[target] = True
-                        forced = True
-            elif self.was_boosting:
-                # print("pulley boost ended")
-                self.was_boosting = False
-                for target in self.TARGETS:
-                    force_update[target] = True
-                    forced = True
+        try:
+            self.session.set_speed_profile(target, profile)
+        except OSError:
+            raise
+        except Exception as error:
+            # e.g. liquidctl's NotSupportedByDevice on older firmware
+            print("Firmware offload is not available on " + self.session.description + ": " + str(error))
+            self.offload_supported = False
+            return False
 
-            # determiune the maximum speed defined for each source,
-            # e.g. if liquid resolves fan speed 25 and cpu resolves fan speed 30 then fan speed will be 30
-            # because I'm lazy and I wrote bad code we still enter this loop even in fixed mode to detect critical temp
-            reached_critical_temp = False
-            for target in self.TARGETS:
-                for source in self.SOURCES:
-                    temp = status[source]
-                    if temp <= 5:
-                        # there seems to be a bug in liquidctl (or in our use of it?) where sometimes temperature is 0, 1 or 2 C and
-                        # all other values are 0
-                        continue
-                    if temp >= int(self.configMgr.config[source + "_critical"]):
-                        new_speed[target] = self.MAX_SPEED[target]
-                        reached_critical_temp = True
-                    else:
-                        # this check is here so that the critical liquid temp gets done even if we are not using the liquid temperature
-                        # to control speeds
-                        if source == 'liquid' and not self.configMgr.config['use_liquid_temp']:
-                            continue
-                        elif self.configMgr.config['mode'] == 'fixed':
-                            new_speed[target] = max(new_speed[target], self.configMgr.config['fixed_' + target + '_speed'])
-                        else:
-                            curveXAxis = self.configMgr.config[source + "_" + target + "_temp"];
-                            curveYAxis = self.configMgr.config[source + "_" + target + "_speed"];
-                            # if we get a borked curve default to 100, if we are off the end then clamp to the last values on the curve,
-                            # otherwise interpolate through the curve
-                            speed = int(100) if (len(curveXAxis)<=0 or len(curveXAxis) != len(curveYAxis)) else (int(curveYAxis[len(curveYAxis)-1]) if (temp >= curveXAxis[len(curveXAxis)-1]) else int(curveYAxis[0]) if (temp < curveXAxis[0]) else int(interp(temp, curveXAxis, curveYAxis)))
-                            new_speed[target] = max(new_speed[target], speed)
-                    new_speed[target] = int(min(self.MAX_SPEED[target], max(self.MIN_SPEED[target], new_speed[target])))
-
-            if reached_critical_temp and self.configMgr.config['boost_after_critical']:
-                if not self.was_boosting:
-                    # print("critical temp reached, pulley will boost to maximum duty")
-                    # print("pulley boost started until temperature is reduced")
-                    self.was_boosting = True
-                self.boost_start = monotonic()
-
-            # print("New speeds: ", new_speed)
-            time_now = monotonic()
-            time_since_update = time_now - self.last_update
-
-            temp_diff_exceeds_required = reached_critical_temp
-            time_diff_exceeds_required = reached_critical_temp
-
-            # after a period of time ensure that the set speed was actually set
-            if time_since_update > self.FORCE_SET_INTERVAL:
-                for target in self.TARGETS:
-                    if abs(current_speed[target] - self.last_speed_set[target]) > self.FORCE_SET_THRESHOLD:
-                        forced = True
-                        force_update[target] = True
+        self.profile[target] = (curve, critical)
+        self.counters['usb_writes'] += 1
+        return True
 
-            for source in self.SOURCES:
-                temp_diff_since_update = abs(status[source] - self.last_temp[source]);
-                for target in self.TARGETS:
-                    if new_speed[target] > self.last_speed_set[target] and temp_diff_since_update >= self.MIN_TEMP_CHANGE_UP[source]:
-                        temp_diff_exceeds_required = True
-                    elif new_speed[target] < self.last_speed_set[target] and temp_diff_since_update >= self.MIN_TEMP_CHANGE_DOWN[source]:
-                        temp_diff_exceeds_required = True
+    # Pushes the values read by the last update to D-Bus and the history, this has to run on the main loop
+    def publish(self):
+        reading = self.reading
+        if reading is None or reading is self.published:
+            return
+        self.published = reading
+
+        self.dbus_interface.Boosting = self.was_boosting
+        self.dbus_interface.CPUTemp = int(reading['cpu'])
+        if 'liquid' in reading:
+            self.dbus_interface.LiquidTemp = int(reading['liquid'])
+            self.dbus_interface.FanDuty = reading['fan']
+            self.dbus_interface.PumpDuty = reading['pump']
+            sample = [reading['time'], reading['cpu'], reading['liquid'], reading['fan'], reading['pump'], reading['fan_set'], reading['pump_set']]
+        else:
+            sample = [reading['time'], reading['cpu'], nan, -1, -1, reading['fan_set'], reading['pump_set']]
+        self.history.append(*sample)
+        if self.log is not None:
+            self.log.append(*sample, nan if reading['load'] is None else reading['load'])
+
+    # The values of the last published reading and the counters, for the metrics exporter
+    def metrics(self, idx):
+        reading = self.published if self.published is not None else {}
+        return {
+            'device': idx,
+            'description': self.session.description,
+            'cpu_temp': reading.get('cpu'),
+            'liquid_temp': reading.get('liquid'),
+            'fan_duty': reading.get('fan'),
+            'pump_duty': reading.get('pump'),
+            'fan_set': reading.get('fan_set'),
+            'pump_set': reading.get('pump_set'),
+            'mode': self.configMgr.config['mode'],
+            'boosting': int(self.was_boosting),
+            'critical': int(self.was_critical),
+            'ticks': self.ticks,
+            'usb_writes': self.counters['usb_writes'],
+            'boosts': self.counters['boosts'],
+            'critical_trips': self.counters['critical_trips'],
+            'force_set_corrections': self.counters['force_set_corrections'],
+            'decisions': {target: dict(reasons) for target, reasons in self.decisions.items()},
+            'connected': int(self.lost_since is None),
+            'device_errors': self.counters['device_errors'],
+            'recoveries': self.counters['recoveries'],
+            'last_recovery': self.last_recovery}
+
+    def close(self):
+        self.session.close()
+        if self.log is not None:
+            self.log.close()
+
+
+class KrakenControllerGroup:
+    """
+    Drives every attached Kraken, the status reads and speed writes of each device run in parallel so a slow USB
+    transfer on one device does not hold up the others
+    """
 
-            for target in self.TARGETS:
-                if new_speed[target] > self.last_speed_set[target] and time_since_update > self.MIN_TIME_CHANGE_UP:
-                    time_diff_exceeds_required = True
-                elif new_speed[target] < self.last_speed_set[target] and time_since_update > self.MIN_TIME_CHANGE_DOWN:
-                    time_diff_exceeds_required = True
+    def __init__(self, controllers, cpu_sensor):
+        self.controllers = controllers
+        self.cpu_sensor = cpu_sensor
+        self.sensors = SensorRegistry(cpu_sensor)
+        for controller in controllers:
+            controller.sensors = self.sensors
+        self.load_sensor = None
+        self.executor = None
+        if len(controllers) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=len(controllers), thread_name_prefix="pulley-device")
 
-            if forced or (temp_diff_exceeds_required and time_diff_exceeds_required):
-                self.last_update = time_now
-                for source in self.SOURCES:
-                    self.last_temp[source] = status[source]
+    def update_speed(self):
+        if self.executor is None:
+            for controller in self.controllers:
+                controller.update_speed()
+            return
 
-                for target in self.TARGETS:
-                    if new_speed[target] <= 0:
-                        continue
-                    if new_speed[target] != self.last_speed_set[target] or force_update[target]:
-                        # if force_update[target]:
-                        #     print("Setting ", target, " ", current_speed[target], " => ", new_speed[target], " (forced)")
-                        # else:
-                        #     print("Setting ", target, " ", self.last_speed_set[target], " => ", new_speed[target])
-                        self.last_speed_set[target] = new_speed[target]
-                        self.kraken_device.set_fixed_speed(target, new_speed[target])
+        futures = [self.executor.submit(controller.update_speed) for controller in self.controllers]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    # The latest temperature of every source on every device with its critical temperature, keyed by (device, source)
+    def temperatures(self):
+        temps = {}
+        for idx, controller in enumerate(self.controllers):
+            for source, temp in controller.temps.items():
+                # see update_speed_, readings this low are bogus
+                if temp > 5:
+                    temps[(idx, source)] = (temp, controller.configMgr.config[source + "_critical"])
+        return temps
+
+    # Seconds until the next reconnect attempt to a lost device, None if every device is answering
+    def retry_in(self):
+        retries = [max(0.0, controller.retry_at - controller.clock()) for controller in self.controllers if controller.lost_since is not None]
+        return min(retries, default=None)
+
+    # True while every device runs its curves in firmware, the host only needs to supervise
+    def offloaded(self):
+        for controller in self.controllers:
+            if None in controller.profile.values():
+                return False
+        return True
+
+    def publish(self, interval):
+        for controller in self.controllers:
+            controller.publish()
+            controller.dbus_interface.CheckInterval = interval
+            controller.dbus_interface.flush()
+
+    def metrics(self, interval, tick_latency):
+        return MetricsSnapshot([controller.metrics(idx) for idx, controller in enumerate(self.controllers)], interval, tick_latency.copy())
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        for controller in self.controllers:
+            controller.close()
+        self.sensors.close()
+        if self.load_sensor is not None:
+            self.load_sensor.close()
+
+
+class PollScheduler:
+    """
+    Works out the time until the next check from how fast the temperatures are moving and how close they are to critical,
+    polling quickly during a ramp and backing off while everything is stable
+    """
+
+    # Smoothing time constant (in seconds) of the temperature slope, sensors are noisy tick to tick
+    SLOPE_TIME_CONSTANT = 2.0
+
+    # At or above this slope (C/s), or this close to a critical temperature (C), check as often as allowed
+    FAST_SLOPE = 1.0
+    NEAR_CRITICAL = 5
+
+    # Above this slope (C/s) the interval is halved, below it the interval grows by BACKOFF each check
+    STEADY_SLOPE = 0.2
+    BACKOFF = 1.5
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_time = None
+        self.last_temps = {}
+        self.slope = 0.0
+
+    def next_interval(self, now, temps, min_interval, max_interval):
+        max_interval = max(min_interval, max_interval)
+
+        slope = 0.0
+        if self.last_time is not None and now > self.last_time:
+            elapsed = now - self.last_time
+            for key, (temp, critical) in temps.items():
+                if key in self.last_temps:
+                    slope = max(slope, abs(temp - self.last_temps[key]) / elapsed)
+            alpha = 1 - exp(-elapsed / self.SLOPE_TIME_CONSTANT)
+            self.slope += alpha * (slope - self.slope)
+
+        self.last_time = now
+        self.last_temps = {key: value[0] for key, value in temps.items()}
+
+        headroom = min([critical - temp for temp, critical in temps.values()], default=self.NEAR_CRITICAL + 1)
+        if headroom <= self.NEAR_CRITICAL or self.slope >= self.FAST_SLOPE:
+            interval = min_interval
+        elif self.slope >= self.STEADY_SLOPE:
+            interval = self.interval / 2
+        else:
+            interval = self.interval * self.BACKOFF
+
+        self.interval = min(max_interval, max(min_interval, interval))
+        return self.interval
+
+
+class KrakenControllerWorker:
+    """
+    Runs the device I/O and the control decisions on a thread of its own, so the GLib main loop that serves D-Bus never
+    waits on USB. Work is handed over through a queue and the results are posted back to the main loop.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.queue = Queue()
+        self.scheduler = PollScheduler(KrakenController.CHECK_INTERVAL)
+        self.timer = None
+        self.thread = Thread(target=self.run_, name="pulley-worker", daemon=True)
+        # time taken by every tick, filled in on the main loop from tick_duration
+        self.tick_latency = LatencyHistogram()
+        self.tick_duration = 0.0
+        # the MetricsExporter, if enabled, gets a fresh snapshot after every tick
+        self.exporter = None
+        # the pulleyshm StatusWriter, if enabled, is written after every tick and every job
+        self.status = None
+        # monotonic() by which the next scheduled tick is due to start, the watchdog stops being pinged once one is late
+        self.tick_due = monotonic()
+        # the pulleyprof ProfileSession running, if any
+        self.profile = None
+        # the main loop, quit when a job fails with anything but a device error, and that error
+        self.loop = None
+        self.error = None
+
+    def start(self):
+        self.thread.start()
+        self.tick_due = monotonic() + self.scheduler.interval
+        self.schedule_(self.scheduler.interval)
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.queue.put((None, None))
+        self.thread.join()
+
+    # Queues a job (any callable) to run on the worker, safe to call from any thread. Once the job is done, on_done runs
+    # on the main loop.
+    def post(self, job, on_done=None):
+        self.queue.put((job, on_done if on_done is not None else self.on_done_))
+
+    # The timer is one shot and is re-armed once the tick is done, so ticks never pile up behind a slow device
+    def schedule_(self, interval):
+        self.timer = GLib.timeout_add(int(interval * 1000), self.on_timer)
 
     def on_timer(self):
+        self.timer = None
+        self.post(self.tick_, self.on_tick_done_)
+        return False
+
+    def tick_(self):
+        start = monotonic()
         try:
-            self.update_speed()
-        except Exception as error:
-            raise SystemError(error)
+            self.group.update_speed()
+        finally:
+            self.tick_duration = monotonic() - start
+
+    def on_tick_done_(self):
+        config = self.group.controllers[0].configMgr.config
+        max_interval = config['offload_interval'] if self.group.offloaded() else config['max_interval']
+        interval = self.scheduler.next_interval(monotonic(), self.group.temperatures(), config['min_interval'], max_interval)
+        retry = self.group.retry_in()
+        if retry is not None:
+            interval = min(interval, max(config['min_interval'], retry))
+        self.tick_latency.observe(self.tick_duration)
+        self.tick_due = monotonic() + interval
+        try:
+            self.publish_(interval, True)
+        finally:
+            # the next tick is scheduled even if publishing failed, that error stops the loop through GLib instead
+            if self.timer is None and self.error is None:
+                self.schedule_(interval)
+        return False
+
+    # Sends the values out on D-Bus, to the exporter and to the status file, scheduled is False after a job (a Boost,
+    # a config change...) rather than a tick
+    def publish_(self, interval, scheduled):
+        self.group.publish(interval)
+        if self.exporter is not None or self.status is not None:
+            snapshot = self.group.metrics(interval, self.tick_latency)
+            if self.exporter is not None:
+                self.exporter.snapshot = snapshot
+            if self.status is not None:
+                self.status.write(snapshot, time(), scheduled)
+
+    # Device errors are dealt with in KrakenController.update_speed, anything else is a bug. Rather than go on ticking
+    # in whatever state it left behind, stop (with a non zero exit, see __main__) so systemd restarts pulley.
+    def on_error_(self, error, trace):
+        if self.error is None:
+            self.error = error
+            devices = ", ".join(controller.session.description for controller in self.group.controllers)
+            print("Stopping after an error on the worker, controlling " + devices + ":\n" + trace, file=sys.stderr)
+            if self.loop is not None:
+                self.loop.quit()
+        return False
+
+    def run_(self):
+        while True:
+            job, on_done = self.queue.get()
+            if job is None:
+                break
+            try:
+                job()
+            except Exception as error:
+                GLib.idle_add(self.on_error_, error, traceback.format_exc())
+            GLib.idle_add(on_done)
+
+    def on_done_(self):
+        self.publish_(self.scheduler.interval, False)
+        return False
+
+
+class SystemdNotifier:
+    """
+    sd_notify(3) without libsystemd, messages go to the socket in $NOTIFY_SOCKET and nowhere if systemd did not set one.
+    With WatchdogSec in the unit the main loop pings the watchdog, but only while the scheduled ticks keep finishing on
+    time, so a hung device call, a hung main loop or a timer that was never re-armed gets the service restarted.
+    """
 
+    def __init__(self):
+        self.socket = None
+        address = os.environ.get('NOTIFY_SOCKET')
+        if address:
+            if address.startswith('@'):
+                # abstract namespace
+                address = '\0' + address[1:]
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+            self.socket.connect(address)
+
+        # seconds, 0 if the watchdog is off or meant for another process
+        self.watchdog_interval = 0
+        watchdog_pid = os.environ.get('WATCHDOG_PID')
+        if os.environ.get('WATCHDOG_USEC') and (not watchdog_pid or int(watchdog_pid) == os.getpid()):
+            self.watchdog_interval = int(os.environ['WATCHDOG_USEC']) / 1000000
+
+    def notify(self, message):
+        if self.socket is not None:
+            try:
+                self.socket.send(message.encode('utf-8'))
+            except OSError:
+                pass
+
+    def start_watchdog(self, worker):
+        if self.watchdog_interval > 0:
+            GLib.timeout_add(int(self.watchdog_interval * 1000 / 2), self.on_watchdog_, worker)
+
+    # Pings while the last scheduled tick finished and the next one is not overdue by more than half of WatchdogSec
+    def on_watchdog_(self, worker):
+        if monotonic() < worker.tick_due + self.watchdog_interval / 2:
+            self.notify("WATCHDOG=1")
         return True
 
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = None
 
-if __name__ == '__main__':
-    elevate()
-    configMgr = KrakenControllerConfig();
-    configMgr.readConfig()
-    configMgr.writeConfig()
 
-    dbus_iface = KrakenControllerDBUS(configMgr);
-    controller = KrakenController(dbus_iface, configMgr)
+# Imports pydbus and GLib, everything that publishes on D-Bus or runs on the main loop needs this called first
+def import_dbus():
+    global GLib, Gio, SessionBus, SystemBus
+    from gi.repository import GLib, Gio
+    from pydbus import SessionBus, SystemBus
+    from pydbus.generic import signal
+    if not hasattr(KrakenControllerDBUS, 'PropertiesChanged'):
+        KrakenControllerDBUS.PropertiesChanged = signal()
+
 
-    if configMgr.config['enable_dbus']:
-        bus = SystemBus()
-        bus.publish("net.mjjw.KrakenController", dbus_iface)
+# Where the identity of the devices found last time is kept, so the next start can skip the full probe
+DEVICE_CACHE = "/var/lib/pulley/devices.json"
 
-    GLib.timeout_add(controller.CHECK_INTERVAL*1000, lambda: controller.on_timer())
+
+# The supported driver families. liquidctl is slow to import, so this waits until a device is looked for.
+def kraken_drivers():
+    from liquidctl.driver.kraken2 import KrakenTwoDriver
+    from liquidctl.driver.kraken3 import KrakenZ3, KrakenX3
+    return [KrakenZ3, KrakenX3, KrakenTwoDriver]
+
+
+# What tells a device apart from any other, the USB address is left out as it changes on every replug or resume
+def device_identity(device):
+    identity = {'driver': type(device).__name__}
+    for key in ['vendor_id', 'product_id', 'serial_number', 'bus', 'port']:
+        try:
+            value = getattr(device, key, None)
+        except OSError:
+            value = None
+        identity[key] = list(value) if isinstance(value, tuple) else value
+    return identity
+
+
+# Returns every supported Kraken attached to the system, the driver families are probed at the same time
+def find_kraken_devices():
+    drivers = kraken_drivers()
+    with ThreadPoolExecutor(max_workers=len(drivers), thread_name_prefix="pulley-probe") as executor:
+        found = list(executor.map(lambda driver: driver.find_supported_devices(), drivers))
+    devices = []
+    for driver_devices in found:
+        devices.extend(driver_devices)
+    return devices
+
+
+# Returns the devices found last time, in the same order, by probing only their driver families. Returns None if the
+# cache is missing or any of them can not be found, then a full probe is needed.
+def find_cached_devices():
+    try:
+        with open(DEVICE_CACHE, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    drivers = {driver.__name__: driver for driver in kraken_drivers()}
+    found = {}
+    devices = []
+    for identity in cached:
+        driver = drivers.get(identity.get('driver'))
+        if driver is None:
+            return None
+        if driver not in found:
+            found[driver] = driver.find_supported_devices()
+        matches = [device for device in found[driver] if device_identity(device) == identity]
+        if len(matches) != 1:
+            return None
+        devices.append(matches[0])
+    return devices if devices else None
+
+
+def save_device_cache(devices):
+    content = json.dumps([device_identity(device) for device in devices])
+    try:
+        with open(DEVICE_CACHE, "r") as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+
+    try:
+        os.makedirs(path.dirname(DEVICE_CACHE), exist_ok=True)
+        with open(DEVICE_CACHE + ".tmp", "w") as f:
+            f.write(content)
+        os.replace(DEVICE_CACHE + ".tmp", DEVICE_CACHE)
+    except OSError as error:
+        # only costs the next start a full probe
+        print("Could not save the device cache: " + str(error))
+
+
+# Started from the cache, so a device attached since then would go unnoticed. Probe everything (off the critical path)
+# and remember what is there for the next start.
+def refresh_device_cache(devices):
+    identities = [device_identity(device) for device in devices]
+    found = find_kraken_devices()
+    if any(device_identity(device) not in identities for device in found):
+        print("Found devices that are not controlled yet, restart pulley to control them")
+    # a device we are controlling is still there even if it is busy, keep it first so the indices stay put
+    save_device_cache(devices + [device for device in found if device_identity(device) not in identities])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Control the fan and pump speeds of NZXT Krakens")
+    parser.add_argument('--config', default="/etc/pulley.conf", help="config file (default /etc/pulley.conf)")
+    parser.add_argument('--bus', choices=['system', 'session'], default='system',
+        help="publish on the system bus or on the session bus, e.g. a private one started by pulleyload.py (default system)")
+    parser.add_argument('--simulate', type=int, default=0, metavar="DEVICES",
+        help="control this many simulated Krakens (see pulleysim.py) instead of real ones, root is not needed")
+    parser.add_argument('--latency', type=float, default=0.008, help="seconds every simulated USB transfer takes (default 0.008)")
+    args = parser.parse_args()
+
+    if args.simulate > 0:
+        from pulleysim import SimulatedCpuSensor, SimulatedKraken, SimulatedLoadSensor, ThermalModel
+        model = ThermalModel()
+        cpu_sensor = SimulatedCpuSensor(model)
+        devices = [SimulatedKraken(model if idx == 0 else ThermalModel(), args.latency, args.latency / 4) for idx in range(args.simulate)]
+        cached = False
+    else:
+        from elevate import elevate
+        elevate()
+
+        cpu_sensor = CpuTemperatureSensor()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="pulley-probe") as executor:
+            # look for the CPU sensor while the devices are probed
+            sensor_found = executor.submit(cpu_sensor.resolve)
+            devices = find_cached_devices()
+            cached = devices is not None
+            if not cached:
+                devices = find_kraken_devices()
+            sensor_found.result()
+
+    if not devices:
+        raise Exception('Failed to find the Kraken X')
+    print("CPU temperature: ", cpu_sensor.path)
+
+    controllers = []
+    for idx, device in enumerate(devices):
+        print("Found device: ", device.description)
+        configMgr = KrakenControllerConfig(idx);
+        configMgr.configFile = args.config
+        configMgr.readConfig()
+        if idx == 0 and not path.exists(configMgr.configFile) and args.simulate == 0:
+            configMgr.writeConfig()
+
+        dbus_iface = KrakenControllerDBUS(configMgr);
+        controllers.append(KrakenController(dbus_iface, configMgr, device, cpu_sensor))
+    controller = KrakenControllerGroup(controllers, cpu_sensor)
+    # only opened if feed_forward or log_history is turned on
+    controller.load_sensor = SimulatedLoadSensor(model) if args.simulate > 0 else LoadSensor()
+    for c in controllers:
+        c.load_sensor = controller.load_sensor
+
+    # until the first speed write the fans run at whatever the firmware defaults to, so that comes before anything else
+    controller.update_speed()
+    import_dbus()
+    if not cached and args.simulate == 0:
+        save_device_cache(devices)
+
+    for idx, c in enumerate(controllers):
+        if c.configMgr.config['log_history']:
+            c.log = HistoryLog(c.configMgr.config['log_dir'], idx)
+    worker = KrakenControllerWorker(controller)
+    for c in controllers:
+        c.dbus_interface.worker = worker
+
+    if controllers[0].configMgr.config['enable_dbus']:
+        # the first device stays on the original object path so existing clients keep working, every other
+        # device N is published under /net/mjjw/KrakenController/DeviceN
+        objects = [controllers[0].dbus_interface]
+        object_paths = ["/net/mjjw/KrakenController"]
+        for idx in range(1, len(controllers)):
+            objects.append(("Device" + str(idx), controllers[idx].dbus_interface))
+            object_paths.append("/net/mjjw/KrakenController/Device" + str(idx))
+        for c, object_path in zip(controllers, object_paths):
+            c.dbus_interface.Devices = object_paths
+            c.dbus_interface.object_path = object_path
+
+        bus = SystemBus() if args.bus == 'system' else SessionBus()
+        bus.publish("net.mjjw.KrakenController", *objects)
+        subscribers = SubscriberTracker(bus, "net.mjjw.KrakenController")
+        for c in controllers:
+            c.dbus_interface.subscribers = subscribers
+
+    controller.publish(worker.scheduler.interval)
+    watcher = ConfigWatcher(controllers, worker)
+    if cached:
+        worker.post(lambda: refresh_device_cache(devices))
+
+    if controllers[0].configMgr.config['status_file']:
+        from pulleyshm import StatusWriter
+        try:
+            worker.status = StatusWriter(controllers[0].configMgr.config['status_file'], len(controllers))
+        except OSError as error:
+            # e.g. /run/pulley when not root, only pulleymon status and the like go without
+            print("Could not open the status file: " + str(error))
+
+    if controllers[0].configMgr.config['metrics_listen']:
+        worker.exporter = MetricsExporter(controllers[0].configMgr.config['metrics_listen'])
+        worker.exporter.start()
+
+    worker.start()
+    notifier = SystemdNotifier()
+    notifier.start_watchdog(worker)
+    notifier.notify("READY=1\nSTATUS=Controlling " + str(len(controllers)) + " device(s)")
     loop = GLib.MainLoop()
-    loop.run()
+    worker.loop = loop
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, SIGTERM, loop.quit)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, SIGINT, loop.quit)
+    try:
+        loop.run()
+    finally:
+        notifier.notify("STOPPING=1")
+        notifier.close()
+        watcher.close()
+        worker.stop()
+        if worker.exporter is not None:
+            worker.exporter.stop()
+        if worker.status is not None:
+            worker.status.close()
+        controller.close()
+    if worker.error is not None:
+        sys.exit(1)
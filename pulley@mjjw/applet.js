@@ -31,6 +31,12 @@ const KrakenControllerProxy = Gio.DBusProxy.makeProxyWrapper('\
         <method name=\'UpdateConfig\'> \
             <arg type="s" name="config" direction="in" /> \
         </method> \
+        <method name=\'GetSnapshot\'> \
+            <arg type="t" name="since_version" direction="in" /> \
+            <arg type="t" name="version" direction="out" /> \
+            <arg type="a{sv}" name="values" direction="out" /> \
+            <arg type="s" name="config" direction="out" /> \
+        </method> \
         <property name="KrakenDevice" type="s" access="read"> \
             <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/> \
         </property> \
@@ -115,7 +121,15 @@ KrakenControlApplet.prototype = {
         this.kcProxyPropertiesID = this.kcProxy.connect('g-properties-changed', (proxy, changed, invalidated) => { 
             onProps(proxy);
         });
-        this.update_kraken_info(this.kcProxy);
+        try {
+            // everything in one round trip, pulley versions without GetSnapshot fall back to the properties
+            let [version, values, config] = this.kcProxy.GetSnapshotSync(0);
+            let info = {};
+            Object.keys(values).forEach(function(key) { info[key] = values[key].deep_unpack(); });
+            this.update_kraken_info(info);
+        } catch (e) {
+            this.update_kraken_info(this.kcProxy);
+        }
     },
     onNameVanished: function(connection, name) {
         this.disconnectProxy();
@@ -0,0 +1,240 @@
+import argparse
+import json
+import subprocess
+import sys
+from threading import Thread
+from time import monotonic, perf_counter_ns, sleep
+
+from pulleysim import SimulatedCpuSensor, SimulatedKraken, ThermalModel
+
+# Benchmarks pulley against simulated Krakens (see pulleysim.py), no hardware needed. Results are printed (or saved
+# with --output) as JSON, --compare shows how they moved against an earlier run.
+
+
+def distribution(samples_ns):
+    values = sorted(samples_ns)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'min_ms': values[0] / 1000000,
+        'mean_ms': sum(values) / len(values) / 1000000,
+        'p50_ms': values[(len(values) - 1) // 2] / 1000000,
+        'p90_ms': values[min(len(values) - 1, (len(values) * 90 + 99) // 100 - 1)] / 1000000,
+        'p99_ms': values[min(len(values) - 1, (len(values) * 99 + 99) // 100 - 1)] / 1000000,
+        'max_ms': values[-1] / 1000000}
+
+
+def memory_usage():
+    result = {}
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ['VmRSS', 'VmHWM']:
+                result[key.lower() + '_kib'] = int(value.split()[0])
+    return result
+
+
+# Builds what the daemon would for count simulated devices, without touching /etc/pulley.conf or the bus
+def build(args, count):
+    from pulley import KrakenController, KrakenControllerConfig, KrakenControllerDBUS, KrakenControllerGroup
+
+    model = ThermalModel()
+    cpu_sensor = SimulatedCpuSensor(model)
+    devices = []
+    controllers = []
+    for idx in range(count):
+        device = SimulatedKraken(model if idx == 0 else ThermalModel(), args.latency, args.jitter)
+        devices.append(device)
+        configMgr = KrakenControllerConfig(idx)
+        controllers.append(KrakenController(KrakenControllerDBUS(configMgr), configMgr, device, cpu_sensor))
+    return KrakenControllerGroup(controllers, cpu_sensor), devices
+
+
+def bench_tick_latency(args):
+    group, devices = build(args, args.devices)
+    samples = []
+    for n in range(args.ticks):
+        start = perf_counter_ns()
+        group.update_speed()
+        samples.append(perf_counter_ns() - start)
+    result = distribution(samples)
+    result['usb_writes'] = sum(device.writes for device in devices)
+    result['phases'] = group.controllers[0].timings.stats()['phases']
+    group.close()
+    return result
+
+
+def bench_saturation(args):
+    group, devices = build(args, args.devices)
+    ticks = 0
+    start = monotonic()
+    while monotonic() - start < args.duration:
+        group.update_speed()
+        ticks += 1
+    elapsed = monotonic() - start
+    group.close()
+    return {'ticks': ticks, 'seconds': elapsed, 'ticks_per_second': ticks / elapsed}
+
+
+# Runs in a fresh interpreter (see bench_startup) and goes through startup the way pulley.py's __main__ does: import,
+# open the device, the first tick (the first speed write), and only then pydbus and GLib. Reports when each was done.
+def startup_child(args):
+    started = monotonic()
+    import pulley
+    imported = monotonic()
+
+    SimulatedKraken.DEVICES = [SimulatedKraken(latency=args.latency, jitter=args.jitter)]
+    device = SimulatedKraken.find_supported_devices()[0]
+    cpu_sensor = SimulatedCpuSensor(device.model)
+    configMgr = pulley.KrakenControllerConfig()
+    controller = pulley.KrakenController(pulley.KrakenControllerDBUS(configMgr), configMgr, device, cpu_sensor)
+    group = pulley.KrakenControllerGroup([controller], cpu_sensor)
+    opened = monotonic()
+
+    group.update_speed()
+    ticked = monotonic()
+    if device.first_write is None:
+        raise Exception("The first tick did not write a speed")
+
+    pulley.import_dbus()
+    dbus_imported = monotonic()
+    group.close()
+
+    result = {'started_monotonic': started, 'imported_monotonic': imported, 'opened_monotonic': opened,
+        'first_write_monotonic': device.first_write, 'ticked_monotonic': ticked, 'dbus_imported_monotonic': dbus_imported}
+    result.update(memory_usage())
+    print(json.dumps(result))
+
+
+def bench_startup(args):
+    start = monotonic()
+    output = subprocess.run([sys.executable, __file__, '--startup-child', '--latency', str(args.latency), '--jitter', str(args.jitter)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    child = json.loads(output.strip().splitlines()[-1])
+    # CLOCK_MONOTONIC is system wide so the child's timestamps compare with ours
+    return {
+        'interpreter_s': child['started_monotonic'] - start,
+        'import_s': child['imported_monotonic'] - child['started_monotonic'],
+        'device_open_s': child['opened_monotonic'] - child['imported_monotonic'],
+        'first_tick_s': child['first_write_monotonic'] - child['opened_monotonic'],
+        'first_write_s': child['first_write_monotonic'] - start,
+        'dbus_import_s': child['dbus_imported_monotonic'] - child['ticked_monotonic'],
+        'rss_kib': child.get('vmrss_kib'),
+        'peak_rss_kib': child.get('vmhwm_kib')}
+
+
+# Latency of the main loop, and of D-Bus methods if a session bus is available, while the worker ticks back to back
+def bench_busy_loop(args):
+    from gi.repository import GLib
+
+    group, devices = build(args, args.devices)
+    from pulley import KrakenControllerWorker, import_dbus
+    import_dbus()
+    worker = KrakenControllerWorker(group)
+    for controller in group.controllers:
+        controller.dbus_interface.worker = worker
+        controller.configMgr.config['min_interval'] = 0.001
+        controller.configMgr.config['max_interval'] = 0.001
+
+    result = {}
+    bus = None
+    try:
+        from pydbus import SessionBus
+        bus = SessionBus()
+        publication = bus.publish("net.mjjw.KrakenController.Bench", ("/net/mjjw/KrakenController", group.controllers[0].dbus_interface))
+    except Exception as error:
+        bus = None
+        result['dbus_method'] = {'error': str(error)}
+
+    loop = GLib.MainLoop()
+    idle_samples = []
+    dbus_samples = []
+
+    def client():
+        # let the worker get going first
+        sleep(0.5)
+        for n in range(args.calls):
+            queued = perf_counter_ns()
+            done = []
+            GLib.idle_add(lambda: done.append(perf_counter_ns()) and False)
+            while not done:
+                sleep(0.0005)
+            idle_samples.append(done[0] - queued)
+
+        if bus is not None:
+            proxy = bus.get("net.mjjw.KrakenController.Bench", "/net/mjjw/KrakenController")
+            for n in range(args.calls):
+                start = perf_counter_ns()
+                proxy.GetConfig()
+                dbus_samples.append(perf_counter_ns() - start)
+        GLib.idle_add(loop.quit)
+
+    worker.start()
+    thread = Thread(target=client, daemon=True)
+    thread.start()
+    loop.run()
+    worker.stop()
+    if bus is not None:
+        publication.unpublish()
+        result['dbus_method'] = distribution(dbus_samples)
+    result['main_loop'] = distribution(idle_samples)
+    result['ticks'] = group.controllers[0].timings.ticks
+    group.close()
+    return result
+
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key in value:
+            flatten(prefix + "." + key if prefix else key, value[key], out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+
+def compare(old, new):
+    old_values = flatten("", old, {})
+    new_values = flatten("", new, {})
+    for key in new_values:
+        if key not in old_values:
+            continue
+        change = ""
+        if old_values[key] != 0:
+            change = "%+.1f%%" % ((new_values[key] - old_values[key]) * 100 / old_values[key])
+        print("%-45s %14.4f %14.4f %10s" % (key, old_values[key], new_values[key], change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pulley against simulated Krakens")
+    parser.add_argument('--latency', type=float, default=0.008, help="seconds every simulated USB transfer takes (default 0.008)")
+    parser.add_argument('--jitter', type=float, default=0.002, help="+/- seconds added to every transfer (default 0.002)")
+    parser.add_argument('--devices', type=int, default=1, help="number of simulated devices (default 1)")
+    parser.add_argument('--ticks', type=int, default=500, help="ticks timed for the latency distribution (default 500)")
+    parser.add_argument('--duration', type=float, default=5, help="seconds to tick back to back for (default 5)")
+    parser.add_argument('--calls', type=int, default=200, help="main loop and D-Bus calls timed (default 200)")
+    parser.add_argument('--output', help="save the results to this file")
+    parser.add_argument('--compare', help="compare the results with an earlier --output")
+    parser.add_argument('--startup-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_child:
+        startup_child(args)
+        sys.exit(0)
+
+    results = {
+        'settings': {'latency': args.latency, 'jitter': args.jitter, 'devices': args.devices},
+        'tick_latency': bench_tick_latency(args),
+        'saturation': bench_saturation(args),
+        'startup': bench_startup(args),
+        'busy_loop': bench_busy_loop(args),
+        'memory': memory_usage()}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), results)
+    elif not args.output:
+        print(json.dumps(results, indent=2))
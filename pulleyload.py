@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from threading import Event, Thread
+from time import monotonic, perf_counter_ns, sleep, time
+
+from pulleybench import distribution
+from pulleyshm import StatusReader
+
+# Loads pulley's D-Bus interface the way several desktop sessions and scripts at once would and measures what that does
+# to the clients and to the control loop. pulley runs with simulated Krakens (pulley.py --simulate) on a private
+# dbus-daemon started here, so neither hardware, root nor the desktop's buses are involved.
+#
+# Many method clients call GetConfig, UpdateConfig and Boost, each on its own connection, while subscribers listen
+# for PropertiesChanged. The control tick is followed through the status file (see pulleyshm.py): every tick is
+# stamped there, so the slip of each tick against the interval it was scheduled with is known without any help from
+# the daemon, and so is the lag from a tick to its PropertiesChanged signal reaching the subscribers. The jobs Boost and
+# UpdateConfig run on the worker publish too and are stamped as well, marked as not scheduled, so they neither break
+# the run of ticks the slip is taken over nor get their signals put down to the tick before.
+
+BUS_NAME = "net.mjjw.KrakenController"
+OBJECT_PATH = "/net/mjjw/KrakenController"
+
+METHODS = ['GetConfig', 'UpdateConfig', 'Boost']
+
+# the daemon's timestamp of a tick (or job) is taken just after its signal is sent, one stamped this much after a
+# signal arrived is still the one that sent it
+STAMP_TOLERANCE = 0.002
+
+CONFIG = """[pulley]
+mode = custom
+enable_dbus = True
+min_interval = {interval}
+max_interval = {interval}
+min_signal_interval = 0.0
+log_history = False
+metrics_listen =
+status_file = {status_file}
+"""
+
+
+class PrivateBus:
+    """
+    A dbus-daemon of our own with the session bus policy (anything goes for our own user)
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'], stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self.address = self.process.stdout.readline().strip()
+        if not self.address:
+            self.process.wait()
+            raise Exception("dbus-daemon did not start")
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class TickMonitor(Thread):
+    """
+    Follows device 0's slot of the status file and keeps (timestamp, tick, check interval, scheduled) of every update
+    seen, scheduled is False for the ones after a job rather than a tick
+    """
+
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, filename):
+        super().__init__(daemon=True)
+        self.reader = StatusReader(filename)
+        self.ticks = []
+        self.stopping = Event()
+
+    def run(self):
+        last = None
+        while not self.stopping.is_set():
+            status = self.reader.read(0)
+            if status is not None and status['sequence'] != last:
+                last = status['sequence']
+                self.ticks.append((status['timestamp'], status['tick'], status['check_interval'], status['scheduled']))
+            sleep(self.POLL_INTERVAL)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        self.reader.close()
+
+    # How late every tick between start and end (time()) was against the interval it was scheduled with, in ns so it
+    # fits distribution()
+    def slip(self, start, end):
+        ticks = [tick for tick in self.ticks if tick[3]]
+        samples = []
+        for (stamp, tick, interval, scheduled), (next_stamp, next_tick, next_interval, next_scheduled) in zip(ticks, ticks[1:]):
+            # a tick missed in between would count twice, the jobs in between do not count at all
+            if next_tick == tick + 1 and start <= stamp and next_stamp <= end:
+                samples.append(int((next_stamp - stamp - interval) * 1000000000))
+        return samples
+
+    # How many ticks between start and end were seen and how many updates after a job
+    def counts(self, start, end):
+        seen = [tick for tick in self.ticks if start <= tick[0] <= end]
+        return {'ticks': sum(1 for tick in seen if tick[3]), 'jobs': sum(1 for tick in seen if not tick[3])}
+
+    # The time from the tick or job that sent each signal to the signal arriving, in ns
+    def lag(self, arrivals):
+        stamps = [tick[0] for tick in self.ticks]
+        samples = []
+        idx = 0
+        for arrival in sorted(arrivals):
+            while idx < len(stamps) and stamps[idx] <= arrival + STAMP_TOLERANCE:
+                idx += 1
+            if idx > 0:
+                samples.append(int(max(0.0, arrival - stamps[idx - 1]) * 1000000000))
+        return samples
+
+
+class MethodClient(Thread):
+    """
+    Calls the methods picked at random with the given weights on a connection of its own, rate times a second at most
+    (0 for back to back)
+    """
+
+    def __init__(self, address, weights, rate, seed, stopping):
+        super().__init__(daemon=True)
+        self.address = address
+        self.weights = weights
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.stopping = stopping
+        self.samples = {method: [] for method in METHODS}
+        self.errors = 0
+
+    def run(self):
+        from pydbus import connect
+        bus = connect(self.address)
+        proxy = bus.get(BUS_NAME, OBJECT_PATH)
+        config = json.loads(proxy.GetConfig())
+        while not self.stopping.is_set():
+            method = self.random.choices(METHODS, self.weights)[0]
+            start = perf_counter_ns()
+            try:
+                if method == 'GetConfig':
+                    config = json.loads(proxy.GetConfig())
+                elif method == 'UpdateConfig':
+                    # a real change, so the config is rebuilt and written every time, without changing the speeds
+                    config['fixed_fan_speed'] = 50 if config['fixed_fan_speed'] != 50 else 51
+                    proxy.UpdateConfig(json.dumps(config))
+                else:
+                    proxy.Boost()
+            except Exception:
+                self.errors += 1
+                continue
+            elapsed = perf_counter_ns() - start
+            self.samples[method].append(elapsed)
+            if self.rate > 0:
+                sleep(max(0.0, 1 / self.rate - elapsed / 1000000000))
+        bus.con.close_sync(None)
+
+
+class Subscriber:
+    """
+    Listens for PropertiesChanged on a connection of its own, the signals are delivered on the main loop
+    """
+
+    def __init__(self, address):
+        from pydbus import connect
+        self.bus = connect(address)
+        self.arrivals = []
+        self.proxy = self.bus.get(BUS_NAME, OBJECT_PATH)
+        self.subscription = self.proxy.PropertiesChanged.connect(self.on_changed_)
+
+    def on_changed_(self, interface, changed, invalidated):
+        self.arrivals.append(time())
+
+    def close(self):
+        self.subscription.disconnect()
+        self.bus.con.close_sync(None)
+
+
+def wait_for_daemon(address, daemon, status_file, timeout):
+    from pydbus import connect
+    bus = connect(address)
+    deadline = monotonic() + timeout
+    while not (bus.dbus.NameHasOwner(BUS_NAME) and os.path.exists(status_file)):
+        if daemon.poll() is not None:
+            raise Exception("pulley exited with " + str(daemon.returncode))
+        if monotonic() > deadline:
+            raise Exception("pulley did not show up on the bus")
+        sleep(0.05)
+    return bus
+
+
+def run(args):
+    from gi.repository import GLib
+
+    workdir = tempfile.mkdtemp(prefix="pulleyload-")
+    config_file = os.path.join(workdir, "pulley.conf")
+    status_file = os.path.join(workdir, "status")
+    with open(config_file, "w") as f:
+        f.write(CONFIG.format(interval=args.interval, status_file=status_file))
+
+    bus = PrivateBus()
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=bus.address)
+    env.pop('NOTIFY_SOCKET', None)
+    daemon = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "pulley.py"), '--bus', 'session',
+        '--simulate', str(args.devices), '--latency', str(args.latency), '--config', config_file], env=env, stdout=sys.stderr)
+    monitor = None
+    try:
+        control = wait_for_daemon(bus.address, daemon, status_file, args.timeout)
+        monitor = TickMonitor(status_file)
+        monitor.start()
+
+        loop = GLib.MainLoop()
+        # the control loop on its own first
+        idle_start = time()
+        GLib.timeout_add(int(args.idle * 1000), loop.quit)
+        loop.run()
+        idle_end = time()
+
+        subscribers = [Subscriber(bus.address) for n in range(args.subscribers)]
+        stopping = Event()
+        clients = [MethodClient(bus.address, args.weights, args.rate, args.seed + n, stopping) for n in range(args.clients)]
+        load_start = time()
+        for client in clients:
+            client.start()
+        GLib.timeout_add(int(args.duration * 1000), loop.quit)
+        loop.run()
+        stopping.set()
+        load_end = time()
+        for client in clients:
+            client.join()
+        for subscriber in subscribers:
+            subscriber.close()
+
+        stats = json.loads(control.get(BUS_NAME, OBJECT_PATH).GetStats())
+    finally:
+        if monitor is not None:
+            monitor.stop()
+        daemon.terminate()
+        daemon.wait()
+        bus.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    calls = {method: [] for method in METHODS}
+    for client in clients:
+        for method in METHODS:
+            calls[method].extend(client.samples[method])
+    arrivals = []
+    for subscriber in subscribers:
+        arrivals.extend(arrival for arrival in subscriber.arrivals if load_start <= arrival <= load_end)
+
+    return {
+        'settings': {'clients': args.clients, 'subscribers': args.subscribers, 'rate': args.rate, 'weights': dict(zip(METHODS, args.weights)),
+            'interval': args.interval, 'latency': args.latency, 'devices': args.devices, 'duration': args.duration},
+        'methods': {method: distribution(calls[method]) for method in METHODS},
+        'calls_per_second': sum(len(samples) for samples in calls.values()) / (load_end - load_start),
+        'errors': sum(client.errors for client in clients),
+        'signal_lag': distribution(monitor.lag(arrivals)),
+        'signals_per_subscriber': len(arrivals) / max(1, len(subscribers)),
+        'tick_slip': {'idle': distribution(monitor.slip(idle_start, idle_end)), 'load': distribution(monitor.slip(load_start, load_end))},
+        'updates': {'idle': monitor.counts(idle_start, idle_end), 'load': monitor.counts(load_start, load_end)},
+        'tick_phases': stats['phases']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load pulley's D-Bus interface with concurrent clients on a private bus and measure the latencies")
+    parser.add_argument('--clients', type=int, default=8, help="method clients, each on its own connection (default 8)")
+    parser.add_argument('--subscribers', type=int, default=8, help="PropertiesChanged subscribers, each on its own connection (default 8)")
+    parser.add_argument('--rate', type=float, default=20, help="calls per second per client, 0 for back to back (default 20)")
+    parser.add_argument('--mix', default="8,1,1", metavar="GETCONFIG,UPDATECONFIG,BOOST", help="relative weights of the methods (default 8,1,1)")
+    parser.add_argument('--duration', type=float, default=20, help="seconds under load (default 20)")
+    parser.add_argument('--idle', type=float, default=5, help="seconds without load first, for the tick slip to compare with (default 5)")
+    parser.add_argument('--interval', type=float, default=0.1, help="seconds between the control ticks (default 0.1)")
+    parser.add_argument('--latency', type=float, default=0.008, help="seconds every simulated USB transfer takes (default 0.008)")
+    parser.add_argument('--devices', type=int, default=1, help="number of simulated devices (default 1)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait for pulley to start (default 30)")
+    parser.add_argument('--output', help="save the results to this file")
+    parser.add_argument('--compare', help="compare the results with an earlier --output")
+    args = parser.parse_args()
+    args.weights = [float(weight) for weight in args.mix.split(",")]
+    if len(args.weights) != len(METHODS):
+        parser.error("--mix needs a weight for each of " + ", ".join(METHODS))
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        from pulleybench import compare
+        with open(args.compare, "r") as f:
+            compare(json.load(f), results)
+    elif not args.output:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,220 @@
+import mmap
+import os
+import struct
+from math import floor, isnan, nan
+from os import path
+
+# Every tier is a preallocated file made of a fixed size header followed by a ring of fixed width records, writes only
+# touch the memory map so there is no syscall (and no fsync) per sample.
+#
+# Header: magic, version, record size, capacity, head (the slot the next record goes into), count (records held)
+HEADER = struct.Struct('<8sIIIII')
+HEADER_SIZE = 64
+MAGIC = b'PULLEYTS'
+VERSION = 2
+
+# The fields of every sample, missing temperatures and loads are NaN and missing duties are -1. load is the CPU load
+# (see LoadSensor) the feed forward went by.
+FIELDS = ['cpu_temp', 'liquid_temp', 'fan_duty', 'pump_duty', 'fan_set', 'pump_set', 'load']
+
+# timestamp followed by the fields
+RAW_RECORD = struct.Struct('<dffbbbbf')
+
+# timestamp of the start of the period, number of samples, then min/avg/max of every field
+ROLLUP_RECORD = struct.Struct('<dI' + 'fff' * len(FIELDS))
+
+# name, record, seconds covered by a record (0 for raw samples), capacity
+TIERS = [
+    ['raw', RAW_RECORD, 0, 2 * 24 * 60 * 60],
+    ['minute', ROLLUP_RECORD, 60, 60 * 24 * 60],
+    ['hour', ROLLUP_RECORD, 60 * 60, 2 * 365 * 24],
+]
+
+
+def tier_path(log_dir, device, tier):
+    return path.join(log_dir, "device" + str(device) + "." + tier)
+
+
+class RingFile:
+    """
+    One memory mapped tier file
+    """
+
+    def __init__(self, filename, record, capacity, writable):
+        self.filename = filename
+        self.record = record
+        self.writable = writable
+        size = HEADER_SIZE + record.size * capacity
+
+        if writable:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.posix_fallocate(fd, 0, size)
+                self.map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            magic, version, record_size, file_capacity, head, count = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or version != VERSION or record_size != record.size or file_capacity != capacity:
+                HEADER.pack_into(self.map, 0, MAGIC, VERSION, record.size, capacity, 0, 0)
+        else:
+            with open(filename, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, record_size, capacity, head, count = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or version != VERSION or record_size != record.size:
+                raise Exception("Not a pulley history file: " + filename)
+
+        self.capacity = capacity
+
+    def header_(self):
+        magic, version, record_size, capacity, head, count = HEADER.unpack_from(self.map, 0)
+        return head, count
+
+    def append(self, *values):
+        head, count = self.header_()
+        self.record.pack_into(self.map, HEADER_SIZE + head * self.record.size, *values)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.record.size, self.capacity, (head + 1) % self.capacity, min(count + 1, self.capacity))
+
+    def timestamp_(self, head, count, n):
+        slot = (head - count + n) % self.capacity
+        return struct.unpack_from('<d', self.map, HEADER_SIZE + slot * self.record.size)[0]
+
+    # Yields the records with start <= timestamp < end, oldest first, only the records in range are read
+    def scan(self, start, end):
+        head, count = self.header_()
+
+        # records are in time order so the first one in range can be found with a binary search
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp_(head, count, mid) < start:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for n in range(lo, count):
+            slot = (head - count + n) % self.capacity
+            values = self.record.unpack_from(self.map, HEADER_SIZE + slot * self.record.size)
+            if values[0] >= end:
+                break
+            yield values
+
+    def close(self):
+        if self.writable:
+            self.map.flush()
+        self.map.close()
+
+
+class Rollup:
+    """
+    Running min/avg/max of every field over one period of a tier
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.start = None
+        self.reset_()
+
+    def reset_(self):
+        self.count = 0
+        self.mins = [nan] * len(FIELDS)
+        self.maxs = [nan] * len(FIELDS)
+        self.sums = [0.0] * len(FIELDS)
+        self.counts = [0] * len(FIELDS)
+
+    # Adds count samples with the given min/avg/max of every field, returns the record of the previous period if this
+    # sample starts a new one
+    def add(self, timestamp, count, mins, avgs, maxs):
+        start = floor(timestamp / self.period) * self.period
+        done = None
+        if self.start is not None and start != self.start and self.count > 0:
+            done = self.record()
+        if start != self.start:
+            self.start = start
+            self.reset_()
+
+        self.count += count
+        for idx in range(len(FIELDS)):
+            if isnan(avgs[idx]):
+                continue
+            self.mins[idx] = mins[idx] if isnan(self.mins[idx]) else min(self.mins[idx], mins[idx])
+            self.maxs[idx] = maxs[idx] if isnan(self.maxs[idx]) else max(self.maxs[idx], maxs[idx])
+            self.sums[idx] += avgs[idx] * count
+            self.counts[idx] += count
+        return done
+
+    def record(self):
+        values = [self.start, self.count]
+        for idx in range(len(FIELDS)):
+            avg = self.sums[idx] / self.counts[idx] if self.counts[idx] > 0 else nan
+            values.extend([self.mins[idx], avg, self.maxs[idx]])
+        return values
+
+
+class HistoryLog:
+    """
+    Persistent history of one device, raw samples plus minute and hour min/avg/max tiers that are rolled up as the
+    samples come in, every file is a fixed size ring so the log never grows
+    """
+
+    def __init__(self, log_dir, device):
+        os.makedirs(log_dir, exist_ok=True)
+        self.files = {}
+        for name, record, period, capacity in TIERS:
+            self.files[name] = RingFile(tier_path(log_dir, device, name), record, capacity, True)
+        self.rollups = [[name, Rollup(period)] for name, record, period, capacity in TIERS if period > 0]
+
+    def append(self, timestamp, cpu_temp, liquid_temp, fan_duty, pump_duty, fan_set, pump_set, load=nan):
+        self.files['raw'].append(timestamp, cpu_temp, liquid_temp, fan_duty, pump_duty, fan_set, pump_set, load)
+
+        values = [cpu_temp, liquid_temp, fan_duty, pump_duty, fan_set, pump_set, load]
+        values = [nan if (2 <= idx <= 5 and value < 0) else float(value) for idx, value in enumerate(values)]
+        sample = [timestamp, 1, values, values, values]
+        for name, rollup in self.rollups:
+            done = rollup.add(*sample)
+            if done is None:
+                break
+            # a period of this tier just finished, store it and feed it to the next tier up
+            self.files[name].append(*done)
+            sample = [done[0], done[1], done[2::3], done[3::3], done[4::3]]
+
+    def close(self):
+        for ring in self.files.values():
+            ring.close()
+
+
+class HistoryReader:
+    """
+    Read only access to the history of one device, see scan()
+    """
+
+    def __init__(self, log_dir, device):
+        self.files = {}
+        for name, record, period, capacity in TIERS:
+            filename = tier_path(log_dir, device, name)
+            if path.exists(filename):
+                self.files[name] = RingFile(filename, record, capacity, False)
+
+    # Yields the records of a tier (raw, minute or hour) with start <= timestamp < end as dictionaries, raw records
+    # have the fields as keys, the others have count plus <field>_min, <field>_avg and <field>_max
+    def scan(self, tier, start=0, end=float('inf')):
+        if tier not in self.files:
+            return
+        for values in self.files[tier].scan(start, end):
+            if tier == 'raw':
+                result = {'timestamp': values[0]}
+                for idx, field in enumerate(FIELDS):
+                    result[field] = values[idx + 1]
+            else:
+                result = {'timestamp': values[0], 'count': values[1]}
+                for idx, field in enumerate(FIELDS):
+                    result[field + '_min'] = values[2 + idx * 3]
+                    result[field + '_avg'] = values[3 + idx * 3]
+                    result[field + '_max'] = values[4 + idx * 3]
+            yield result
+
+    def close(self):
+        for ring in self.files.values():
+            ring.close()
@@ -0,0 +1,177 @@
+import os
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Thread
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class LatencyHistogram:
+    """
+    Cumulative histogram of durations (in seconds) with fixed buckets
+    """
+
+    BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+    def __init__(self):
+        # one count per bucket plus +Inf
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def copy(self):
+        result = LatencyHistogram()
+        result.counts = list(self.counts)
+        result.sum = self.sum
+        result.count = self.count
+        return result
+
+
+# Everything the exporter serves, taken by the control loop after every tick so a scrape never touches the devices
+class MetricsSnapshot:
+    def __init__(self, devices, check_interval, tick_latency):
+        # one dictionary per device, see KrakenController.metrics()
+        self.devices = devices
+        self.check_interval = check_interval
+        self.tick_latency = tick_latency
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render(snapshot):
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append("# TYPE " + name + " " + kind)
+        lines.append("# HELP " + name + " " + help_text)
+        for suffix, labels, value in samples:
+            label_text = ",".join(key + '="' + escape_label(labels[key]) + '"' for key in labels)
+            lines.append(name + suffix + ("{" + label_text + "}" if label_text else "") + " " + format_value(value))
+
+    def per_device(key, suffix=""):
+        samples = []
+        for device in snapshot.devices:
+            value = device[key]
+            if value is None or value != value:
+                continue
+            samples.append([suffix, {'device': device['device'], 'description': device['description']}, value])
+        return samples
+
+    family("pulley_cpu_temperature_celsius", "gauge", "CPU temperature.", per_device('cpu_temp'))
+    family("pulley_liquid_temperature_celsius", "gauge", "Liquid temperature reported by the device.", per_device('liquid_temp'))
+    family("pulley_fan_duty_percent", "gauge", "Fan duty reported by the device.", per_device('fan_duty'))
+    family("pulley_pump_duty_percent", "gauge", "Pump duty reported by the device.", per_device('pump_duty'))
+    family("pulley_fan_duty_set_percent", "gauge", "Fan duty last set by pulley.", per_device('fan_set'))
+    family("pulley_pump_duty_set_percent", "gauge", "Pump duty last set by pulley.", per_device('pump_set'))
+    family("pulley_boosting", "gauge", "1 while the device is boosting.", per_device('boosting'))
+    family("pulley_usb_writes", "counter", "Speed writes sent to the device.", per_device('usb_writes', "_total"))
+    family("pulley_boost_activations", "counter", "Boosts started, on request or after reaching a critical temperature.", per_device('boosts', "_total"))
+    family("pulley_critical_trips", "counter", "Times a critical temperature was reached.", per_device('critical_trips', "_total"))
+    family("pulley_force_set_corrections", "counter", "Speeds set again because the device did not report the duty we set.", per_device('force_set_corrections', "_total"))
+    decisions = []
+    for device in snapshot.devices:
+        for target, reasons in device['decisions'].items():
+            for reason, count in reasons.items():
+                decisions.append(["_total", {'device': device['device'], 'description': device['description'], 'target': target, 'reason': reason}, count])
+    family("pulley_speed_decisions", "counter", "Speed writes and speed changes held back, by target and reason.", decisions)
+    family("pulley_device_connected", "gauge", "0 while the device is not answering and pulley is trying to get it back.", per_device('connected'))
+    family("pulley_device_errors", "counter", "Device reads or writes that failed even after reopening the device.", per_device('device_errors', "_total"))
+    family("pulley_device_recoveries", "counter", "Times the device was got back after it stopped answering.", per_device('recoveries', "_total"))
+    family("pulley_last_recovery_seconds", "gauge", "Time it took to get the device back the last time it stopped answering.", per_device('last_recovery'))
+    family("pulley_check_interval_seconds", "gauge", "Time until the next check.", [["", {}, snapshot.check_interval]])
+
+    histogram = snapshot.tick_latency
+    samples = []
+    cumulative = 0
+    for bound, count in zip(histogram.BUCKETS + [float('inf')], histogram.counts):
+        cumulative += count
+        samples.append(["_bucket", {'le': "+Inf" if bound == float('inf') else repr(bound)}, cumulative])
+    samples.append(["_count", {}, histogram.count])
+    samples.append(["_sum", {}, histogram.sum])
+    family("pulley_tick_duration_seconds", "histogram", "Time taken by a control loop tick.", samples)
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        snapshot = self.server.exporter.snapshot
+        if snapshot is None:
+            self.send_error(503, "No data yet")
+            return
+
+        body = render(snapshot).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # scrapes are not worth a line in the journal
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    # BaseHTTPRequestHandler expects a (host, port) client address
+    def get_request(self):
+        request, client_address = super().get_request()
+        return request, ["local", 0]
+
+
+class MetricsExporter:
+    """
+    Serves the latest MetricsSnapshot in the OpenMetrics text format, on "host:port" or "unix:/path/to/socket"
+    """
+
+    def __init__(self, listen):
+        self.listen = listen
+        self.snapshot = None
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.listen.startswith("unix:"):
+            socket_path = self.listen[5:]
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+            self.server = ThreadingUnixHTTPServer(socket_path, MetricsRequestHandler)
+        else:
+            host, port = self.listen.rsplit(":", 1)
+            self.server = ThreadingHTTPServer((host.strip("[]"), int(port)), MetricsRequestHandler)
+        self.server.exporter = self
+
+        self.thread = Thread(target=self.server.serve_forever, name="pulley-metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.listen.startswith("unix:") and os.path.exists(self.listen[5:]):
+                os.unlink(self.listen[5:])
+        self.server = None
@@ -1,11 +1,15 @@
-from pydbus import SystemBus
-from gi.repository import GLib
+import argparse
+from datetime import datetime
+from time import time
 
 def _on_property_changed(sender, obj, arr):
     for key in obj:
         print(key, " => ", obj[key])
 
-if __name__ == '__main__':
+def monitor(args):
+    from pydbus import SystemBus
+    from gi.repository import GLib
+
     bus = SystemBus()
     controller = bus.get("net.mjjw.KrakenController")
     print("--- Initial ---")
@@ -17,4 +21,76 @@ if __name__ == '__main__':
     print("--- Updates ---")
     controller.PropertiesChanged.connect(_on_property_changed)
     loop = GLib.MainLoop()
-    loop.run()
\ No newline at end of file
+    loop.run()
+
+# Prints the latest values from the status file (status_file in /etc/pulley.conf), no D-Bus needed
+def status(args):
+    from pulleyshm import StatusReader
+
+    reader = StatusReader(args.file)
+    devices, pid = reader.header()
+    if pid == 0:
+        print("pulley is not running, these values are from when it stopped")
+    for idx, values in enumerate(reader.read_all()):
+        if values is None or values['sequence'] == 0:
+            continue
+        print("Device", idx, datetime.fromtimestamp(values['timestamp']).isoformat(timespec='seconds'))
+        print("  CPU Temp:    ", values['cpu_temp'])
+        print("  Liquid Temp: ", values['liquid_temp'])
+        print("  Fan Duty:    ", values['fan_duty'], "(set", str(values['fan_set']) + ")")
+        print("  Pump Duty:   ", values['pump_duty'], "(set", str(values['pump_set']) + ")")
+        print("  Mode:        ", values['mode'] + (", boosting" if values['boosting'] else ""))
+    reader.close()
+
+# Asks pulley to profile itself, needs root
+def profile(args):
+    from pydbus import SystemBus
+
+    bus = SystemBus()
+    controller = bus.get("net.mjjw.KrakenController")
+    filename = controller.StartProfile(args.seconds, args.mode)
+    print("Profiling for", args.seconds, "seconds, the result goes to", filename)
+
+# Prints the on disk history (log_history in /etc/pulley.conf) as CSV
+def history(args):
+    from pulleylog import HistoryReader
+
+    end = time() if args.until is None else args.until
+    start = end - args.hours * 60 * 60 if args.since is None else args.since
+
+    reader = HistoryReader(args.log_dir, args.device)
+    header = None
+    for record in reader.scan(args.tier, start, end):
+        if header is None:
+            header = list(record.keys())
+            print("time," + ",".join(header))
+        print(datetime.fromtimestamp(record['timestamp']).isoformat(timespec='seconds') + "," + ",".join(str(record[key]) for key in header))
+    reader.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Watch pulley, or dump its history")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('monitor', help="print the current values and follow their changes (the default)")
+    status_parser = subparsers.add_parser('status', help="print the latest values from the status file, without D-Bus")
+    status_parser.add_argument('--file', default="/run/pulley/status")
+    history_parser = subparsers.add_parser('history', help="print the recorded history as CSV")
+    history_parser.add_argument('--tier', choices=['raw', 'minute', 'hour'], default='minute')
+    history_parser.add_argument('--device', type=int, default=0)
+    history_parser.add_argument('--hours', type=float, default=24, help="how far back to go (default 24)")
+    history_parser.add_argument('--since', type=float, help="start time in seconds since the epoch, overrides --hours")
+    history_parser.add_argument('--until', type=float, help="end time in seconds since the epoch (default now)")
+    history_parser.add_argument('--log-dir', default="/var/lib/pulley")
+    profile_parser = subparsers.add_parser('profile', help="profile the running pulley for a while (as root)")
+    profile_parser.add_argument('--seconds', type=int, default=30, help="how long to profile for (default 30)")
+    profile_parser.add_argument('--mode', choices=['deterministic', 'sampling'], default='sampling',
+        help="cProfile into a pstats file, or stack samples into a collapsed stack file (default sampling)")
+    args = parser.parse_args()
+
+    if args.command == 'history':
+        history(args)
+    elif args.command == 'profile':
+        profile(args)
+    elif args.command == 'status':
+        status(args)
+    else:
+        monitor(args)
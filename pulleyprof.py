@@ -0,0 +1,126 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from threading import Event, Thread
+from time import strftime
+
+# Profiles the running daemon on request (StartProfile on D-Bus) for a bounded number of seconds. Nothing here is
+# imported, hooked in or running until a profile is asked for, so it costs nothing the rest of the time.
+#
+# 'deterministic' runs cProfile over the main loop thread (the D-Bus handlers) and the worker thread (the control loop)
+# and writes one merged pstats file, for python3 -m pstats, snakeviz and the like. 'sampling' takes the stack of every
+# thread SAMPLE_RATE times a second and writes them in the collapsed stack format (one "frame;frame;frame count" line
+# per stack, the thread name first) that flamegraph.pl, speedscope and inferno read. Sampling also sees the threads
+# the devices are ticked on when there are several of them, and slows pulley down far less.
+
+MODES = ['deterministic', 'sampling']
+
+# seconds a profile may run for
+MAX_SECONDS = 300
+
+SAMPLE_RATE = 200
+
+
+class SamplingProfiler(Thread):
+    """
+    Counts the stacks of every other thread, sampled SAMPLE_RATE times a second
+    """
+
+    def __init__(self):
+        super().__init__(name="pulley-profiler", daemon=True)
+        self.stacks = Counter()
+        self.stopping = Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(1 / SAMPLE_RATE):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                # the frames the way py-spy writes them, the tools split off the count at the last space
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(stack + " " + str(count) + "\n")
+
+
+class ProfileSession:
+    """
+    One profile, started and finished on the main loop. worker is the KrakenControllerWorker, its thread is profiled
+    through jobs posted to it.
+    """
+
+    def __init__(self, mode, seconds, directory, worker):
+        if mode not in MODES:
+            raise Exception("Unknown profile mode: " + mode + ", use one of " + ", ".join(MODES))
+        if not 0 < seconds <= MAX_SECONDS:
+            raise Exception("A profile can run for 1 to " + str(MAX_SECONDS) + " seconds")
+        self.mode = mode
+        self.seconds = seconds
+        self.worker = worker
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.filename = os.path.join(directory, "pulley-" + strftime("%Y%m%d-%H%M%S") + "-" + mode + (".pstats" if mode == 'deterministic' else ".collapsed"))
+        self.profiles = []
+        self.sampler = None
+
+    def start(self):
+        if self.mode == 'sampling':
+            self.sampler = SamplingProfiler()
+            self.sampler.start()
+            return
+
+        self.profiles.append(cProfile.Profile())
+        self.profiles[0].enable()
+        if sys.version_info < (3, 12):
+            # before 3.12 cProfile only follows the thread it was enabled on, from then on it follows them all
+            self.profiles.append(cProfile.Profile())
+            self.worker.post(self.profiles[1].enable, lambda: False)
+
+    # Stops profiling and writes the file, on_done(filename or None) runs on the main loop once it is written
+    def finish(self, on_done):
+        if self.mode == 'sampling':
+            self.sampler.stop()
+            self.write_(on_done)
+            return
+
+        self.profiles[0].disable()
+        if len(self.profiles) > 1:
+            self.worker.post(self.profiles[1].disable, lambda: self.write_(on_done))
+        else:
+            self.write_(on_done)
+
+    def write_(self, on_done):
+        try:
+            if self.sampler is not None:
+                self.sampler.write(self.filename)
+            else:
+                stats = pstats.Stats()
+                for profile in self.profiles:
+                    try:
+                        stats.add(profile)
+                    except TypeError:
+                        # nothing ran on that thread
+                        pass
+                stats.dump_stats(self.filename)
+        except OSError as error:
+            print("Could not write the profile: " + str(error))
+            on_done(None)
+            return False
+        on_done(self.filename)
+        return False
@@ -0,0 +1,360 @@
+import argparse
+import csv
+import itertools
+import json
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from math import isnan, pi, sin
+from time import monotonic
+
+from pulley import KrakenController, KrakenControllerConfig, KrakenControllerDBUS, KrakenControllerGroup, PollScheduler
+from pulleylog import HistoryReader
+from pulleysim import SimulatedCpuSensor, SimulatedKraken, SimulatedLoadSensor, ThermalModel, profile_duty
+
+# Replays a temperature trace through KrakenController's decision logic on a simulated clock, far faster than real
+# time, and sweeps parameter sets over it on a process pool.
+#
+# A recorded trace (the on disk history or a pulleymon history CSV) is replayed open loop, the temperatures are what
+# they were whatever the speeds are set to. A synthetic run (no trace given) is closed loop, the speeds feed back into
+# pulleysim's ThermalModel, so it also shows what the settings do to the peak temperatures.
+
+
+class ReplayClock:
+    """
+    Stands in for monotonic(), moved forward by the replay
+    """
+
+    def __init__(self):
+        # monotonic() counts from boot, starting at 0 would look like the controller was just boosted
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TraceDevice:
+    """
+    Stands in for a liquidctl Kraken reporting the liquid temperature of the current trace sample, the duties read
+    back are whatever was set last or what the speed profile gives
+    """
+
+    description = "Replayed NZXT Kraken"
+
+    def __init__(self, readback_offset):
+        self.cpu = 0
+        self.liquid = 0
+        # the load (0-1) if the trace has it
+        self.load = None
+        self.duty = {'fan': 0, 'pump': 0}
+        self.readback_offset = readback_offset
+        self.profiles = {}
+
+    def connect(self, **kwargs):
+        return self
+
+    def disconnect(self, **kwargs):
+        pass
+
+    def get_status(self, **kwargs):
+        if isnan(self.liquid):
+            # the device did not answer properly when this was recorded, replay it the way the device reports that
+            return [("Liquid temperature", 0, "°C"), ("Pump duty", 0, "%"), ("Fan duty", 0, "%")]
+        for channel, profile in self.profiles.items():
+            self.duty[channel] = profile_duty(profile, self.liquid)
+        return [("Liquid temperature", self.liquid, "°C"), ("Pump duty", self.duty['pump'] + self.readback_offset['pump'], "%"),
+            ("Fan duty", self.duty['fan'] + self.readback_offset['fan'], "%")]
+
+    def set_fixed_speed(self, channel, duty, **kwargs):
+        self.profiles.pop(channel, None)
+        self.duty[channel] = int(duty)
+
+    def set_speed_profile(self, channel, profile, **kwargs):
+        self.profiles[channel] = list(profile)
+
+
+class TraceCpuSensor:
+    def __init__(self, device):
+        self.device = device
+
+    def read(self):
+        return self.device.cpu
+
+    def close(self):
+        pass
+
+
+class TraceLoadSensor(TraceCpuSensor):
+    def read(self, tdp=0):
+        return self.device.load
+
+
+# Synthetic loads, fractions of full load for a time in seconds
+class SineLoad:
+    def __init__(self, seed):
+        self.seed = seed
+
+    def __call__(self, t):
+        return 0.5 + 0.5 * sin(2 * pi * t / 120)
+
+
+class StepLoad:
+    """
+    A new random load level every PERIOD seconds, mostly light with the odd heavy burst, the same for a given seed
+    """
+
+    PERIOD = 30
+
+    def __init__(self, seed):
+        self.seed = seed
+
+    def __call__(self, t):
+        return random.Random(self.seed * 1000003 + int(t // self.PERIOD)).random() ** 3
+
+
+class SteadyLoad:
+    """
+    A constant moderate load with the second to second jitter of a desktop doing the same thing all along, the same for
+    a given seed
+    """
+
+    LEVEL = 0.4
+    JITTER = 0.15
+
+    def __init__(self, seed):
+        self.seed = seed
+
+    def __call__(self, t):
+        return self.LEVEL + self.JITTER * (2 * random.Random(self.seed * 1000003 + int(t)).random() - 1)
+
+
+LOADS = {'sine': SineLoad, 'steps': StepLoad, 'steady': SteadyLoad}
+
+
+# Sets a parameter, upper case names are KrakenController constants and lower case ones are /etc/pulley.conf settings
+def apply_param(controller, configMgr, name, value):
+    if name.isupper() and hasattr(controller, name):
+        setattr(controller, name, value)
+    elif name in configMgr.config:
+        configMgr.config[name] = value
+    else:
+        raise Exception("Unknown parameter: " + name)
+
+
+class ReplayStats:
+    """
+    What a replay did, accumulated one tick at a time
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.seconds = 0.0
+        self.above_critical = 0.0
+        self.boosting = 0.0
+        self.peak_cpu = 0.0
+        self.peak_liquid = 0.0
+        self.duty_sum = {'fan': 0.0, 'pump': 0.0}
+        self.travel = {'fan': 0, 'pump': 0}
+        self.reversals = {'fan': 0, 'pump': 0}
+        self.last_set = {'fan': None, 'pump': None}
+        self.direction = {'fan': 0, 'pump': 0}
+
+    # Adds the tick just done, which holds for dt seconds
+    def add(self, dt):
+        reading = self.controller.reading
+        config = self.controller.configMgr.config
+        self.seconds += dt
+        self.peak_cpu = max(self.peak_cpu, reading['cpu'])
+        liquid = reading.get('liquid', 0)
+        self.peak_liquid = max(self.peak_liquid, liquid)
+        if reading['cpu'] >= config['cpu_critical'] or liquid >= config['liquid_critical']:
+            self.above_critical += dt
+        if self.controller.was_boosting:
+            self.boosting += dt
+
+        for target in KrakenController.TARGETS:
+            duty = reading[target + '_set']
+            self.duty_sum[target] += duty * dt
+            last = self.last_set[target]
+            if last is not None and duty != last:
+                direction = 1 if duty > last else -1
+                if self.direction[target] == -direction:
+                    self.reversals[target] += 1
+                self.direction[target] = direction
+                self.travel[target] += abs(duty - last)
+            self.last_set[target] = duty
+
+    def result(self):
+        hours = self.seconds / 3600 if self.seconds > 0 else 1
+        return {
+            'simulated_hours': self.seconds / 3600,
+            'writes_per_hour': self.controller.counters['usb_writes'] / hours,
+            'seconds_above_critical': self.above_critical,
+            'boost_seconds': self.boosting,
+            'peak_cpu': self.peak_cpu,
+            'peak_liquid': self.peak_liquid,
+            'mean_duty': {target: self.duty_sum[target] / max(self.seconds, 1e-9) for target in self.duty_sum},
+            'reversals_per_hour': {target: self.reversals[target] / hours for target in self.reversals},
+            'duty_travel_per_hour': {target: self.travel[target] / hours for target in self.travel},
+            'decisions': self.controller.decisions}
+
+
+# Replays one parameter set. trace is a list of (timestamp, cpu, liquid, load), without one a synthetic load is simulated for
+# the given number of hours with the ticks spaced by the daemon's PollScheduler. readback_offset is how far off the
+# duties the device reports are from the duties set, by target.
+def replay(params, trace=None, hours=1.0, load='steps', seed=0, readback_offset=None):
+    clock = ReplayClock()
+    configMgr = KrakenControllerConfig()
+    readback_offset = dict({'fan': 0, 'pump': 0}, **(readback_offset or {}))
+    if trace is None:
+        model = ThermalModel(LOADS[load](seed), clock)
+        device = SimulatedKraken(model, 0, 0, readback_offset)
+        cpu_sensor = SimulatedCpuSensor(model)
+        load_sensor = SimulatedLoadSensor(model)
+    else:
+        device = TraceDevice(readback_offset)
+        cpu_sensor = TraceCpuSensor(device)
+        load_sensor = TraceLoadSensor(device)
+
+    controller = KrakenController(KrakenControllerDBUS(configMgr), configMgr, device, cpu_sensor)
+    controller.load_sensor = load_sensor
+    controller.clock = clock
+    for name, value in params.items():
+        apply_param(controller, configMgr, name, value)
+    configMgr.compileCurves()
+    stats = ReplayStats(controller)
+
+    start = monotonic()
+    if trace is None:
+        group = KrakenControllerGroup([controller], cpu_sensor)
+        scheduler = PollScheduler(KrakenController.CHECK_INTERVAL)
+        end = clock.now + hours * 3600
+        clock.now += scheduler.interval
+        while clock.now < end:
+            controller.update_speed()
+            # the same as KrakenControllerWorker.on_tick_done_
+            max_interval = configMgr.config['offload_interval'] if group.offloaded() else configMgr.config['max_interval']
+            interval = scheduler.next_interval(clock.now, group.temperatures(), configMgr.config['min_interval'], max_interval)
+            stats.add(interval)
+            clock.now += interval
+    else:
+        origin = clock.now - trace[0][0]
+        for idx, (timestamp, cpu, liquid, load) in enumerate(trace):
+            clock.now = origin + timestamp
+            device.cpu = cpu
+            device.liquid = liquid
+            device.load = load
+            controller.update_speed()
+            stats.add(trace[idx + 1][0] - timestamp if idx + 1 < len(trace) else 0)
+
+    result = stats.result()
+    result['params'] = params
+    result['speedup'] = stats.seconds / max(monotonic() - start, 1e-9)
+    return result
+
+
+# Loads (timestamp, cpu, liquid, load) from the raw on disk history or from the CSV output of pulleymon.py history, the
+# load (0-1, for feed_forward) is only known if the CSV has a load column
+def load_trace(args):
+    trace = []
+    if args.csv:
+        with open(args.csv, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                cpu = row['cpu_temp'] if 'cpu_temp' in row else row['cpu_temp_avg']
+                liquid = row['liquid_temp'] if 'liquid_temp' in row else row['liquid_temp_avg']
+                load = row['load'] if 'load' in row else row.get('load_avg')
+                load = float(load) if load and load != 'nan' else None
+                trace.append((float(row['timestamp']), float(cpu), float(liquid), load))
+    else:
+        reader = HistoryReader(args.log_dir, args.device)
+        for record in reader.scan('raw', args.since or 0, args.until or float('inf')):
+            trace.append((record['timestamp'], record['cpu_temp'], record['liquid_temp'], None if isnan(record['load']) else record['load']))
+        reader.close()
+    return trace
+
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+TRACE = None
+
+
+def init_worker(trace):
+    global TRACE
+    TRACE = trace
+
+
+def replay_worker(job):
+    params, hours, load, seed, readback_offset = job
+    return replay(params, TRACE, hours, load, seed, readback_offset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay temperatures through pulley's control logic faster than real time")
+    source = parser.add_argument_group("trace, without one a synthetic load is simulated")
+    source.add_argument('--log-dir', help="replay the raw on disk history (log_history in /etc/pulley.conf) in this directory")
+    source.add_argument('--device', type=int, default=0)
+    source.add_argument('--since', type=float, help="start of the history to replay, in seconds since the epoch")
+    source.add_argument('--until', type=float, help="end of the history to replay, in seconds since the epoch")
+    source.add_argument('--csv', help="replay the output of pulleymon.py history")
+    synthetic = parser.add_argument_group("synthetic load")
+    synthetic.add_argument('--hours', type=float, default=24, help="hours to simulate (default 24)")
+    synthetic.add_argument('--load', choices=sorted(LOADS), default='steps')
+    synthetic.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], metavar="NAME=VALUE",
+        help="override a KrakenController constant (e.g. MIN_TIME_CHANGE_DOWN=20) or a pulley.conf setting (e.g. cpu_critical=85)")
+    parser.add_argument('--sweep', action='append', default=[], metavar="NAME=[VALUES]",
+        help="replay every value in the JSON list, several --sweep run every combination")
+    parser.add_argument('--readback-offset', action='append', default=[], metavar="TARGET=DUTY",
+        help="make the device report the duty of fan or pump this far off the duty set, as some firmwares do")
+    parser.add_argument('--jobs', type=int, default=None, help="processes to run the sweep on (default one per CPU)")
+    parser.add_argument('--json', action='store_true', help="print the full results as JSON")
+    args = parser.parse_args()
+
+    base = {}
+    for item in args.set:
+        name, value = item.split("=", 1)
+        base[name] = parse_value(value)
+
+    readback_offset = {}
+    for item in args.readback_offset:
+        target, value = item.split("=", 1)
+        readback_offset[target] = int(value)
+
+    names = []
+    choices = []
+    for item in args.sweep:
+        name, values = item.split("=", 1)
+        names.append(name)
+        choices.append(json.loads(values))
+
+    jobs = []
+    for combination in itertools.product(*choices):
+        params = dict(base)
+        params.update(zip(names, combination))
+        jobs.append((params, args.hours, args.load, args.seed, readback_offset))
+
+    trace = load_trace(args) if (args.log_dir or args.csv) else None
+    if trace is not None and len(trace) == 0:
+        print("Nothing to replay")
+        sys.exit(1)
+
+    if len(jobs) == 1:
+        init_worker(trace)
+        results = [replay_worker(jobs[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(trace,)) as executor:
+            results = list(executor.map(replay_worker, jobs))
+
+    results.sort(key=lambda result: (result['writes_per_hour'], result['peak_cpu']))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%10s %9s %9s %9s %9s %10s  %s" % ("writes/h", "peak cpu", "peak liq", "crit s", "boost s", "reversal/h", "params"))
+        for result in results:
+            print("%10.1f %9.1f %9.1f %9.0f %9.0f %10.1f  %s" % (result['writes_per_hour'], result['peak_cpu'], result['peak_liquid'],
+                result['seconds_above_critical'], result['boost_seconds'], sum(result['reversals_per_hour'].values()), json.dumps(result['params'])))
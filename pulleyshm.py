@@ -0,0 +1,159 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+from math import isnan, nan
+from time import sleep
+
+# The latest tick of every device in a small memory mapped file (on tmpfs, /run/pulley/status by default) so local
+# readers such as status bars can poll it as often as they like without a D-Bus round trip. The daemon is the only
+# writer. Every device has a slot guarded by a seqlock: the sequence number is odd while the slot is being written, a
+# reader copies the slot and retries if the sequence number was odd or changed meanwhile. Reading is a few loads from
+# the map, no syscalls after the file has been mapped.
+#
+# Header: magic, version, slot size, number of devices, pid of the daemon
+HEADER = struct.Struct('<8sIIII')
+HEADER_SIZE = 64
+MAGIC = b'PULLEYST'
+VERSION = 2
+
+# Slots are one cache line each and the file never changes size, so a reader's map stays valid across daemon restarts
+SLOT_SIZE = 64
+MAX_DEVICES = 16
+FILE_SIZE = HEADER_SIZE + SLOT_SIZE * MAX_DEVICES
+
+SEQUENCE = struct.Struct('<Q')
+
+# timestamp, tick, cpu temp, liquid temp, fan duty, pump duty, fan set, pump set, mode, boosting, critical, connected,
+# check interval, scheduled. Missing temperatures are NaN and missing duties are -1. tick counts the scheduled checks,
+# the values are also written after a Boost, a config change and the like, then scheduled is 0 and tick stays the same.
+RECORD = struct.Struct('<dQffbbbbBBBBfB')
+FIELDS = ['timestamp', 'tick', 'cpu_temp', 'liquid_temp', 'fan_duty', 'pump_duty', 'fan_set', 'pump_set', 'mode', 'boosting', 'critical', 'connected', 'check_interval', 'scheduled']
+
+MODES = ['fixed', 'custom']
+# written for a mode not in MODES, read back as None
+UNKNOWN_MODE = 255
+
+# Attempts at a consistent copy before giving up, the writer only holds a slot for a couple of microseconds but could
+# be preempted or killed half way through. Every YIELD_EVERY failed attempts the reader sleeps to let the writer finish.
+MAX_RETRIES = 10000
+YIELD_EVERY = 64
+
+
+def temperature(value):
+    return nan if value is None else value
+
+
+def duty(value):
+    return -1 if value is None else int(value)
+
+
+def mode(value):
+    return MODES.index(value) if value in MODES else UNKNOWN_MODE
+
+
+class StatusWriter:
+    """
+    The daemon's side, write() is called on the main loop after every tick and every job
+    """
+
+    def __init__(self, filename, devices):
+        self.filename = filename
+        os.makedirs(os.path.dirname(filename), mode=0o755, exist_ok=True)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # readers may have the file mapped from an earlier run, so it is reused rather than replaced
+            if os.fstat(fd).st_size != FILE_SIZE:
+                os.ftruncate(fd, FILE_SIZE)
+            self.map = mmap.mmap(fd, FILE_SIZE)
+        finally:
+            os.close(fd)
+        # any devices past MAX_DEVICES are left out
+        self.devices = min(devices, MAX_DEVICES)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, SLOT_SIZE, self.devices, os.getpid())
+
+    # snapshot is a MetricsSnapshot, see KrakenController.metrics()
+    def write(self, snapshot, timestamp, scheduled=True):
+        for device in snapshot.devices[:self.devices]:
+            offset = HEADER_SIZE + device['device'] * SLOT_SIZE
+            sequence = SEQUENCE.unpack_from(self.map, offset)[0] | 1
+            SEQUENCE.pack_into(self.map, offset, sequence)
+            RECORD.pack_into(self.map, offset + SEQUENCE.size, timestamp, device['ticks'], temperature(device['cpu_temp']),
+                temperature(device['liquid_temp']), duty(device['fan_duty']), duty(device['pump_duty']), duty(device['fan_set']),
+                duty(device['pump_set']), mode(device['mode']), device['boosting'], device['critical'], device['connected'],
+                snapshot.check_interval, scheduled)
+            SEQUENCE.pack_into(self.map, offset, sequence + 1)
+
+    def close(self):
+        # the pid tells readers nobody is writing any more
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, SLOT_SIZE, self.devices, 0)
+        self.map.close()
+
+
+class StatusReader:
+    """
+    The readers' side, the file is mapped read only once and every read() only touches memory
+    """
+
+    def __init__(self, filename="/run/pulley/status"):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slot_size, devices, pid = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE or len(self.map) < FILE_SIZE:
+            raise Exception("Not a pulley status file: " + filename)
+
+    # The number of devices and the pid of the daemon writing them (0 if it has stopped)
+    def header(self):
+        magic, version, slot_size, devices, pid = HEADER.unpack_from(self.map, 0)
+        return devices, pid
+
+    # Returns the latest values of the device as a dictionary, with 'sequence' going up by one with every update (0 if
+    # the device was never written), or None if the writer died half way through an update
+    def read(self, device=0):
+        offset = HEADER_SIZE + device * SLOT_SIZE
+        for attempt in range(MAX_RETRIES):
+            before = SEQUENCE.unpack_from(self.map, offset)[0]
+            if not before & 1:
+                values = RECORD.unpack_from(self.map, offset + SEQUENCE.size)
+                if SEQUENCE.unpack_from(self.map, offset)[0] == before:
+                    break
+            if attempt % YIELD_EVERY == YIELD_EVERY - 1:
+                sleep(0.0001)
+        else:
+            return None
+
+        result = dict(zip(FIELDS, values))
+        result['sequence'] = before // 2
+        for key in ['cpu_temp', 'liquid_temp']:
+            # stored as single precision, sensors only go to a thousandth of a degree anyway
+            result[key] = None if isnan(result[key]) else round(result[key], 3)
+        for key in ['fan_duty', 'pump_duty', 'fan_set', 'pump_set']:
+            if result[key] < 0:
+                result[key] = None
+        result['mode'] = MODES[result['mode']] if result['mode'] < len(MODES) else None
+        for key in ['boosting', 'critical', 'connected', 'scheduled']:
+            result[key] = bool(result[key])
+        return result
+
+    def read_all(self):
+        devices, pid = self.header()
+        return [self.read(device) for device in range(min(devices, MAX_DEVICES))]
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print the latest values pulley published to its status file")
+    parser.add_argument('--file', default="/run/pulley/status")
+    parser.add_argument('--watch', type=float, metavar="SECONDS", help="keep printing every this many seconds")
+    args = parser.parse_args()
+
+    reader = StatusReader(args.file)
+    while True:
+        print(json.dumps(reader.read_all()), flush=True)
+        if args.watch is None:
+            break
+        sleep(args.watch)
+    reader.close()
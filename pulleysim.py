@@ -0,0 +1,199 @@
+import random
+from math import exp, pi, sin
+from threading import Lock
+from time import monotonic, sleep
+
+
+class ThermalModel:
+    """
+    Rough thermal model of a CPU cooled by an AIO, good enough to make the temperatures move the way a real system does
+
+    The CPU dissipates between IDLE_POWER and MAX_POWER (W) depending on the load. The liquid is a single heat capacity
+    that is heated by the CPU and cooled by the radiator, the radiator gets better with fan duty. The CPU sits above
+    the liquid by its power times a thermal resistance that gets better with pump duty, it gets there with the time
+    constant of the die and heat spreader.
+    """
+
+    AMBIENT = 25.0
+    IDLE_POWER = 20.0
+    MAX_POWER = 200.0
+
+    # J/K, roughly 300ml of coolant plus the copper
+    LIQUID_CAPACITY = 1500.0
+
+    # W/K from the liquid to the air at 0% and 100% fan duty
+    RADIATOR_MIN = 4.0
+    RADIATOR_MAX = 20.0
+
+    # K/W from the CPU to the liquid at 0% and 100% pump duty
+    COLD_PLATE_MIN = 0.35
+    COLD_PLATE_MAX = 0.2
+
+    # seconds
+    DIE_TIME_CONSTANT = 4.0
+
+    def __init__(self, load=None, clock=monotonic):
+        # load(seconds since start) -> 0..1, defaults to a slow cycle between idle and full load
+        self.load = load if load is not None else (lambda t: 0.5 + 0.5 * sin(2 * pi * t / 120))
+        self.clock = clock
+        self.start = clock()
+        self.last = self.start
+        self.liquid = self.AMBIENT + 5
+        self.cpu = self.liquid
+        self.fan = 0
+        self.pump = 0
+        self.lock = Lock()
+
+    def power_(self, now):
+        return self.IDLE_POWER + (self.MAX_POWER - self.IDLE_POWER) * min(1.0, max(0.0, self.load(now - self.start)))
+
+    def step(self):
+        with self.lock:
+            now = self.clock()
+            elapsed = now - self.last
+            self.last = now
+
+            radiator = self.RADIATOR_MIN + (self.RADIATOR_MAX - self.RADIATOR_MIN) * self.fan / 100
+            cold_plate = self.COLD_PLATE_MIN + (self.COLD_PLATE_MAX - self.COLD_PLATE_MIN) * self.pump / 100
+            # integrate in small steps so a long gap between reads stays stable
+            while elapsed > 0:
+                dt = min(elapsed, 0.5)
+                power = self.power_(now - elapsed + dt)
+                self.liquid += (power - radiator * (self.liquid - self.AMBIENT)) * dt / self.LIQUID_CAPACITY
+                self.cpu += (self.liquid + power * cold_plate - self.cpu) * (1 - exp(-dt / self.DIE_TIME_CONSTANT))
+                elapsed -= dt
+
+    def cpu_temperature(self):
+        self.step()
+        return self.cpu
+
+    def liquid_temperature(self):
+        self.step()
+        return self.liquid
+
+    def set_duty(self, target, duty):
+        self.step()
+        with self.lock:
+            setattr(self, target, duty)
+
+
+# The duty a speed profile (a list of (temperature, duty) points) gives at temp, the way the firmware interpolates it
+def profile_duty(profile, temp):
+    if temp <= profile[0][0]:
+        return profile[0][1]
+    for (t0, d0), (t1, d1) in zip(profile, profile[1:]):
+        if temp <= t1:
+            return int(d0 + (d1 - d0) * (temp - t0) / (t1 - t0)) if t1 > t0 else d1
+    return profile[-1][1]
+
+
+class SimulatedKraken:
+    """
+    Stands in for a liquidctl Kraken driver (find_supported_devices, connect, disconnect, get_status, set_fixed_speed
+    and set_speed_profile), every USB transfer takes latency +/- jitter seconds
+    """
+
+    description = "Simulated NZXT Kraken Z"
+
+    # what find_supported_devices() returns, set up by the benchmark or a test before it is called
+    DEVICES = []
+
+    @classmethod
+    def find_supported_devices(cls, **kwargs):
+        return list(cls.DEVICES)
+
+    def __init__(self, model=None, latency=0.008, jitter=0.002, readback_offset=None):
+        self.model = model if model is not None else ThermalModel()
+        self.latency = latency
+        self.jitter = jitter
+        # how far off the duty set the duty reported is, as with firmwares that never report exactly what was set
+        self.readback_offset = readback_offset if readback_offset is not None else {'fan': 0, 'pump': 0}
+        self.connected = False
+        self.duty = {'fan': 0, 'pump': 0}
+        # the speed profiles running on the "firmware", by channel
+        self.profiles = {}
+        # monotonic() of the first set_fixed_speed, used to measure the startup time
+        self.first_write = None
+        self.reads = 0
+        self.writes = 0
+
+    def transfer_(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            sleep(delay)
+
+    def connect(self, **kwargs):
+        self.connected = True
+        return self
+
+    def disconnect(self, **kwargs):
+        self.connected = False
+
+    def get_status(self, **kwargs):
+        if not self.connected:
+            raise OSError("device not connected")
+        self.transfer_()
+        self.reads += 1
+        liquid = self.model.liquid_temperature()
+        for channel, profile in self.profiles.items():
+            self.duty[channel] = profile_duty(profile, liquid)
+            self.model.set_duty(channel, self.duty[channel])
+        return [
+            ("Liquid temperature", round(liquid, 1), "°C"),
+            ("Pump speed", 1000 + 18 * self.duty['pump'], "rpm"),
+            ("Pump duty", self.duty['pump'] + self.readback_offset['pump'], "%"),
+            ("Fan speed", 20 * self.duty['fan'], "rpm"),
+            ("Fan duty", self.duty['fan'] + self.readback_offset['fan'], "%"),
+        ]
+
+    def set_fixed_speed(self, channel, duty, **kwargs):
+        if not self.connected:
+            raise OSError("device not connected")
+        self.transfer_()
+        self.writes += 1
+        if self.first_write is None:
+            self.first_write = monotonic()
+        self.profiles.pop(channel, None)
+        self.duty[channel] = int(duty)
+        self.model.set_duty(channel, int(duty))
+
+    def set_speed_profile(self, channel, profile, **kwargs):
+        if not self.connected:
+            raise OSError("device not connected")
+        self.transfer_()
+        self.writes += 1
+        self.profiles[channel] = list(profile)
+
+
+class SimulatedCpuSensor:
+    """
+    Stands in for CpuTemperatureSensor, reads the CPU temperature from a ThermalModel
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.path = "simulated"
+
+    def resolve(self):
+        pass
+
+    def read(self):
+        return round(self.model.cpu_temperature(), 3)
+
+    def close(self):
+        pass
+
+
+class SimulatedLoadSensor:
+    """
+    Stands in for LoadSensor, reads the load driving a ThermalModel
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def read(self, tdp=0):
+        return min(1.0, max(0.0, self.model.load(self.model.clock() - self.model.start)))
+
+    def close(self):
+        pass
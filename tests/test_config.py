@@ -0,0 +1,62 @@
+import pytest
+
+from pulley import KrakenControllerConfig
+
+
+@pytest.fixture
+def config(tmp_path):
+    result = KrakenControllerConfig()
+    result.configFile = str(tmp_path / "pulley.conf")
+    return result
+
+
+def test_patch_applies_and_writes(config):
+    assert config.applyPatch({'mode': 'fixed', 'fixed_fan_speed': 40, 'cpu_fan_temp': [0, 50, 80], 'cpu_fan_speed': [25, 50, 100]})
+    assert config.config['mode'] == 'fixed'
+    assert config.curves['cpu_fan'].speed(65) == 75
+
+    reread = KrakenControllerConfig()
+    reread.configFile = config.configFile
+    reread.readConfig()
+    assert reread.config == config.config
+
+
+@pytest.mark.parametrize('patch', [
+    {'no_such_setting': 1},
+    {'mode': 'Custom'},
+    {'boost_duration': 3600},
+    {'use_liquid_temp': 'yes'},
+    {'fixed_pump_speed': '75'},
+    {'cpu_fan_temp': [0, 60, 50, 75]},
+    {'cpu_fan_temp': [0, 30, 40, 50, 60, 70, 200]},
+    {'cpu_fan_temp': [0, 50, 80]},
+    {'liquid_pump_temp': [], 'liquid_pump_speed': []},
+])
+def test_invalid_patch_changes_nothing(config, patch):
+    before = config.config
+    assert not config.applyPatch(patch)
+    assert config.config is before
+    with pytest.raises(Exception, match="Invalid config patch"):
+        config.patchJSON(repr(patch).replace("'", '"'))
+
+
+def test_reload_keeps_config_on_invalid_file(config):
+    config.applyPatch({'fixed_fan_speed': 40})
+    before = config.config
+    for content in ["[pulley]\nmode = Custom\n", "[fixed]\nfan = 140\n", "[custom]\ncpu_fan_curve = [[0, 25], [30]]\n",
+            "[custom]\ngpu_fan_curve = [[50, 25], [40, 100]]\n", "[pulley]\nboost_duration = soon\n"]:
+        with open(config.configFile, "w") as f:
+            f.write(content)
+        with pytest.raises(Exception):
+            config.reloadConfig()
+        assert config.config is before
+
+
+def test_reload_keeps_restart_keys(config):
+    with open(config.configFile, "w") as f:
+        f.write("[pulley]\nhistory_size = 10\nmin_interval = 0\n[fixed]\nfan = 50\n")
+    assert config.reloadConfig()
+    assert config.config['fixed_fan_speed'] == 50
+    assert config.config['history_size'] == 14400
+    assert config.config['min_interval'] == 0.05
+    assert not config.reloadConfig()
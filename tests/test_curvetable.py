@@ -0,0 +1,97 @@
+import random
+from bisect import bisect_right
+
+import pytest
+
+from pulley import CurveBank, CurveTable
+
+
+# numpy.interp, the way update_speed_ looked a speed up before the curves were compiled: the straight line between
+# the last point at or below temp and the next one, so of a vertical step the upper speed applies at the step
+def interp(temp, temps, speeds):
+    idx = bisect_right(temps, temp) - 1
+    if idx >= len(temps) - 1:
+        return float(speeds[-1])
+    slope = (speeds[idx + 1] - speeds[idx]) / (temps[idx + 1] - temps[idx])
+    return slope * (temp - temps[idx]) + speeds[idx]
+
+
+def interp_speed(temps, speeds, temp):
+    if len(temps) <= 0 or len(temps) != len(speeds):
+        return 100
+    if temp >= temps[-1]:
+        return int(speeds[-1])
+    if temp < temps[0]:
+        return int(speeds[0])
+    return int(interp(temp, temps, speeds))
+
+
+def random_curve(rng):
+    points = rng.randint(1, 8)
+    temps = sorted(rng.randint(0, CurveTable.MAX_TEMP) for n in range(points))
+    if points > 2 and rng.random() < 0.5:
+        # a vertical step
+        idx = rng.randrange(1, points)
+        temps[idx] = temps[idx - 1]
+    return temps, [rng.randint(0, 100) for n in range(points)]
+
+
+def probe_temps(rng, temps):
+    probes = [-10, -0.5, 0, CurveTable.MAX_TEMP, CurveTable.MAX_TEMP + 20]
+    for temp in temps:
+        # at, just before and just after every breakpoint
+        probes.extend([temp, temp - 0.001, temp + 0.001, temp - 0.5, temp + 0.5])
+    probes.extend(rng.uniform(-5, CurveTable.MAX_TEMP + 5) for n in range(200))
+    return probes
+
+
+def test_reference_is_numpy_interp():
+    numpy = pytest.importorskip("numpy")
+    rng = random.Random(7)
+    for n in range(200):
+        temps, speeds = random_curve(rng)
+        for temp in probe_temps(rng, temps):
+            if temps[0] <= temp < temps[-1]:
+                assert interp(temp, temps, speeds) == numpy.interp(temp, temps, speeds), (temps, speeds, temp)
+
+
+def test_matches_interp_on_random_curves():
+    rng = random.Random(3)
+    for n in range(500):
+        temps, speeds = random_curve(rng)
+        table = CurveTable(temps, speeds)
+        for temp in probe_temps(rng, temps):
+            assert table.speed(temp) == interp_speed(temps, speeds, temp), (temps, speeds, temp)
+
+
+def test_clamps_beyond_both_ends():
+    table = CurveTable([30, 40, 50], [25, 60, 90])
+    assert table.speed(-20) == 25
+    assert table.speed(29.999) == 25
+    assert table.speed(50) == 90
+    assert table.speed(200) == 90
+
+
+def test_duplicate_temperatures_step():
+    temps, speeds = [20, 40, 40, 60], [30, 30, 80, 100]
+    table = CurveTable(temps, speeds)
+    for temp in [39, 39.999, 40, 40.001, 41]:
+        assert table.speed(temp) == interp_speed(temps, speeds, temp)
+    assert table.speed(40) == 80
+
+
+def test_borked_curves_run_at_full_speed():
+    assert CurveTable([], []).speed(50) == 100
+    assert CurveTable([0, 50], [25]).speed(50) == 100
+
+
+def test_bank_matches_the_tables():
+    rng = random.Random(5)
+    for n in range(100):
+        curves = {name: CurveTable(*random_curve(rng)) for name in ['cpu_fan', 'cpu_pump', 'liquid_fan', 'liquid_pump']}
+        bank = CurveBank(curves)
+        temps = [rng.uniform(-5, CurveTable.MAX_TEMP + 5) for source in bank.sources]
+        speeds = dict(zip(bank.targets, bank.evaluate(temps)))
+        for target in bank.targets:
+            expected = max(table.speed(temps[bank.sources.index(name.rsplit('_', 1)[0])]) for name, table in curves.items() if name.endswith('_' + target))
+            assert speeds[target] == expected
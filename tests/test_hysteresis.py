@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pulley import KrakenController, SensorRegistry, TargetHysteresis
+
+
+@pytest.fixture
+def controller():
+    names = ['MIN_TIME_CHANGE_UP', 'MIN_TIME_CHANGE_DOWN', 'MIN_SPEED_CHANGE', 'MIN_SPEED', 'MAX_SPEED', 'FORCE_SET_INTERVAL', 'FORCE_SET_THRESHOLD']
+    return SimpleNamespace(sensors=SensorRegistry(None), **{name: getattr(KrakenController, name) for name in names})
+
+
+@pytest.fixture
+def hysteresis():
+    result = TargetHysteresis()
+    result.wrote(0, 50, {'cpu': 60.0, 'liquid': 30.0})
+    return result
+
+
+def test_up_waits_for_the_deadband(controller, hysteresis):
+    assert hysteresis.step(1, 'fan', 60, {'cpu': 61.5, 'liquid': 30.0}, controller) == 'deadband'
+    assert hysteresis.state == hysteresis.RISING
+    # the liquid deadband is smaller than the CPU one
+    assert hysteresis.step(2, 'fan', 60, {'cpu': 61.5, 'liquid': 31.0}, controller) == 'up'
+    assert hysteresis.step(3, 'fan', 60, {'cpu': 62.0, 'liquid': 30.0}, controller) == 'up'
+
+
+def test_down_waits_for_the_deadband_and_the_timer(controller, hysteresis):
+    assert hysteresis.step(20, 'fan', 40, {'cpu': 57.0, 'liquid': 30.0}, controller) == 'deadband'
+    assert hysteresis.step(21, 'fan', 40, {'cpu': 55.0, 'liquid': 30.0}, controller) == 'timer'
+    assert hysteresis.step(30, 'fan', 40, {'cpu': 55.0, 'liquid': 30.0}, controller) == 'timer'
+    assert hysteresis.step(31, 'fan', 40, {'cpu': 55.0, 'liquid': 30.0}, controller) == 'down'
+
+    # a dip back to the speed set starts the wait over
+    assert hysteresis.step(32, 'fan', 50, {'cpu': 55.0, 'liquid': 30.0}, controller) is None
+    assert hysteresis.state == hysteresis.HOLD
+    assert hysteresis.step(33, 'fan', 40, {'cpu': 55.0, 'liquid': 30.0}, controller) == 'timer'
+    assert hysteresis.step(44, 'fan', 40, {'cpu': 55.0, 'liquid': 30.0}, controller) == 'down'
+
+
+def test_small_changes_are_held(controller, hysteresis):
+    temps = {'cpu': 70.0, 'liquid': 30.0}
+    assert hysteresis.step(1, 'fan', 51, temps, controller) == 'deadband'
+    assert hysteresis.step(1, 'fan', 52, temps, controller) == 'up'
+
+    # unless they get to the minimum or maximum speed
+    hysteresis.wrote(2, 99, temps)
+    assert hysteresis.step(3, 'fan', 100, {'cpu': 75.0, 'liquid': 30.0}, controller) == 'up'
+    hysteresis.wrote(4, 26, temps)
+    assert hysteresis.step(20, 'fan', 25, {'cpu': 50.0, 'liquid': 30.0}, controller) == 'timer'
+    assert hysteresis.step(31, 'fan', 25, {'cpu': 50.0, 'liquid': 30.0}, controller) == 'down'
+
+
+def test_sources_without_temperatures(controller, hysteresis):
+    # no temperature to go by, the target moves on the timer alone
+    assert hysteresis.step(1, 'fan', 70, {}, controller) == 'up'
+    assert hysteresis.step(5, 'fan', 40, {}, controller) == 'timer'
+    assert hysteresis.step(16, 'fan', 40, {}, controller) == 'down'
+
+    # a source the deadband was not recorded for, or a sensor without one of its own, is not held back
+    assert hysteresis.step(17, 'fan', 70, {'cpu': 60.0, 'gpu': 50.0}, controller) == 'up'
+    hysteresis.wrote(18, 70, {'cpu': 60.0, 'custom': 50.0})
+    assert hysteresis.step(19, 'fan', 80, {'cpu': 60.0, 'custom': 51.0}, controller) == 'deadband'
+    assert hysteresis.step(19, 'fan', 80, {'cpu': 60.0, 'custom': 52.0}, controller) == 'up'
+
+
+def test_readback_learns_the_offset(controller, hysteresis):
+    assert hysteresis.check_readback(10, 55, 50, controller) is None
+    assert hysteresis.check_readback(11, 52, 50, controller) is None
+    assert hysteresis.check_readback(11, 55, 50, controller) == 'readback'
+
+    # the same difference after setting it again is learned for that duty
+    hysteresis.wrote(11, 50, {})
+    assert hysteresis.check_readback(22, 55, 50, controller) == 'tolerated'
+    assert hysteresis.readback_offset == {50: 5}
+    assert hysteresis.check_readback(40, 55, 50, controller) is None
+    assert hysteresis.check_readback(40, 50, 50, controller) == 'readback'
+
+    # and only for that duty
+    hysteresis.wrote(41, 70, {})
+    assert hysteresis.check_readback(52, 75, 70, controller) == 'readback'
+
+    # after forget() the offsets still hold
+    hysteresis.forget()
+    hysteresis.wrote(60, 50, {})
+    assert hysteresis.check_readback(71, 55, 50, controller) is None
+
+
+def test_readback_learns_the_duty_written(controller, hysteresis):
+    # the correction writes the speed the curves ask for, which is what gets checked next
+    assert hysteresis.check_readback(11, 55, 60, controller) == 'readback'
+    hysteresis.wrote(11, 60, {})
+    assert hysteresis.check_readback(22, 65, 60, controller) == 'tolerated'
+    assert hysteresis.readback_offset == {60: 5}
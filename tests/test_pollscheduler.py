@@ -0,0 +1,47 @@
+from pulley import PollScheduler
+
+
+def run(scheduler, samples, min_interval=0.25, max_interval=5.0):
+    now = 0.0
+    intervals = []
+    for temps in samples:
+        interval = scheduler.next_interval(now, temps, min_interval, max_interval)
+        intervals.append(interval)
+        now += interval
+    return intervals
+
+
+def test_backs_off_while_stable():
+    intervals = run(PollScheduler(1), [{'cpu': (50.0, 80), 'liquid': (30.0, 40)}] * 10)
+    assert intervals[:3] == [1.5, 2.25, 3.375]
+    assert intervals[-1] == 5.0
+
+
+def test_polls_fast_near_critical():
+    scheduler = PollScheduler(4)
+    assert scheduler.next_interval(0, {'cpu': (50.0, 80), 'liquid': (35.0, 40)}, 0.25, 5.0) == 0.25
+    # the intervals grow from there once out of reach
+    assert scheduler.next_interval(100, {'cpu': (50.0, 80), 'liquid': (34.0, 40)}, 0.25, 5.0) == 0.375
+
+
+def test_follows_the_slope():
+    scheduler = PollScheduler(4)
+    scheduler.next_interval(0, {'cpu': (50.0, 80)}, 0.25, 5.0)
+    # a moderate ramp halves the interval once the smoothed slope gets there, a steep one goes straight to the minimum
+    temp = 50.0
+    intervals = []
+    for now in range(1, 4):
+        temp += 0.5
+        intervals.append(scheduler.next_interval(now, {'cpu': (temp, 80)}, 0.25, 5.0))
+    assert intervals == [5.0, 2.5, 1.25]
+    for now in range(4, 10):
+        temp += 4
+        interval = scheduler.next_interval(now, {'cpu': (temp, 200)}, 0.25, 5.0)
+    assert interval == 0.25
+
+
+def test_stays_in_range():
+    # max_interval below min_interval gives min_interval
+    assert run(PollScheduler(1), [{'cpu': (50.0, 80)}] * 5, 2.0, 1.0) == [2.0] * 5
+    # without any temperature there is nothing to hurry for
+    assert run(PollScheduler(1), [{}] * 3) == [1.5, 2.25, 3.375]
@@ -0,0 +1,65 @@
+from math import isnan, nan
+
+from pulleylog import HistoryLog, HistoryReader
+
+# a whole hour, so every tier has a record
+START = 1700000000 - 1700000000 % 3600
+
+
+def fill(log_dir, seconds, step=1):
+    log = HistoryLog(log_dir, 0)
+    for t in range(0, seconds, step):
+        liquid = nan if t % 60 == 30 else 30.0 + t % 60 / 10
+        fan = -1 if t % 60 == 30 else 25 + t % 60
+        log.append(START + t, 40.0 + t // 60, liquid, fan, 60, 25, 60, t % 60 / 60)
+    log.close()
+
+
+def test_raw_samples(tmp_path):
+    fill(str(tmp_path), 120)
+    reader = HistoryReader(str(tmp_path), 0)
+    raw = list(reader.scan('raw'))
+    assert len(raw) == 120
+    assert raw[1]['timestamp'] == START + 1 and raw[1]['cpu_temp'] == 40.0 and raw[1]['fan_duty'] == 26
+    assert isnan(raw[30]['liquid_temp']) and raw[30]['fan_duty'] == -1
+    # only the records in range
+    assert [record['timestamp'] - START for record in reader.scan('raw', START + 10, START + 13)] == [10, 11, 12]
+    reader.close()
+
+
+def test_rollups(tmp_path):
+    fill(str(tmp_path), 3600 + 120)
+    reader = HistoryReader(str(tmp_path), 0)
+
+    minutes = list(reader.scan('minute'))
+    # a period is written once the next one starts, so the minute still going on is not there yet and the hour only
+    # is once its last minute was written
+    assert len(minutes) == 61
+    first = minutes[0]
+    assert first['timestamp'] == START and first['count'] == 60
+    assert first['cpu_temp_min'] == first['cpu_temp_avg'] == first['cpu_temp_max'] == 40.0
+    # a missing value is left out of min/avg/max, not counted as -1 or NaN
+    assert first['fan_duty_min'] == 25 and first['fan_duty_max'] == 84
+    assert abs(first['fan_duty_avg'] - (sum(range(25, 85)) - 55) / 59) < 1e-4
+    assert abs(first['liquid_temp_max'] - 35.9) < 1e-4
+    assert abs(first['load_avg'] - sum(range(60)) / 60 / 60) < 1e-4
+    assert minutes[59]['cpu_temp_avg'] == 99.0
+
+    hours = list(reader.scan('hour'))
+    assert len(hours) == 1
+    assert hours[0]['timestamp'] == START and hours[0]['count'] == 3600
+    assert hours[0]['cpu_temp_min'] == 40.0 and hours[0]['cpu_temp_max'] == 99.0
+    assert abs(hours[0]['cpu_temp_avg'] - 69.5) < 1e-4
+    assert hours[0]['fan_duty_min'] == 25 and hours[0]['fan_duty_max'] == 84
+    reader.close()
+
+
+def test_reopen_appends(tmp_path):
+    fill(str(tmp_path), 30)
+    log = HistoryLog(str(tmp_path), 0)
+    log.append(START + 30, 50.0, 30.0, 40, 60, 40, 60)
+    log.close()
+    reader = HistoryReader(str(tmp_path), 0)
+    raw = list(reader.scan('raw'))
+    assert len(raw) == 31 and raw[-1]['cpu_temp'] == 50.0 and isnan(raw[-1]['load'])
+    reader.close()
@@ -0,0 +1,87 @@
+import pstats
+from queue import Queue
+from threading import Event, Thread
+from time import monotonic
+
+import pytest
+
+from pulleyprof import ProfileSession
+
+
+class Worker:
+    """
+    Stands in for the KrakenControllerWorker, the posted jobs run on a thread of their own and so does on_done
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = Thread(target=self.run_, daemon=True)
+        self.thread.start()
+
+    def post(self, job, on_done=None):
+        self.queue.put((job, on_done))
+
+    def run_(self):
+        while True:
+            job, on_done = self.queue.get()
+            if job is None:
+                break
+            job()
+            if on_done is not None:
+                on_done()
+
+    def stop(self):
+        self.queue.put((None, None))
+        self.thread.join()
+
+
+def busy_tick(seconds):
+    # long enough for plenty of samples
+    end = monotonic() + seconds
+    while monotonic() < end:
+        sum(value * value for value in range(1000))
+
+
+def profile(tmp_path, mode):
+    worker = Worker()
+    session = ProfileSession(mode, 1, str(tmp_path / "profiles"), worker)
+    session.start()
+    worker.post(lambda: busy_tick(0.2))
+    done = Event()
+    worker.post(done.set)
+    done.wait(10)
+
+    written = []
+    finished = Event()
+    session.finish(lambda filename: (written.append(filename), finished.set()))
+    assert finished.wait(10)
+    worker.stop()
+    assert written == [session.filename]
+    return session.filename
+
+
+def test_deterministic(tmp_path):
+    filename = profile(tmp_path, 'deterministic')
+    assert filename.endswith(".pstats")
+    stats = pstats.Stats(filename)
+    assert any(name == 'busy_tick' for filename, line, name in stats.stats)
+
+
+def test_sampling(tmp_path):
+    filename = profile(tmp_path, 'sampling')
+    assert filename.endswith(".collapsed")
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    assert any("busy_tick (test_pulleyprof.py" in line for line in lines)
+
+
+def test_limits(tmp_path):
+    with pytest.raises(Exception, match="Unknown profile mode"):
+        ProfileSession('tracing', 10, str(tmp_path), None)
+    for seconds in [0, 301]:
+        with pytest.raises(Exception, match="1 to 300 seconds"):
+            ProfileSession('sampling', seconds, str(tmp_path), None)
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pulleyshm
+from pulleyshm import HEADER_SIZE, SEQUENCE, StatusReader, StatusWriter
+
+
+def device(number, **values):
+    result = {'device': number, 'ticks': 7, 'cpu_temp': 45.5, 'liquid_temp': None, 'fan_duty': 40, 'pump_duty': None,
+        'fan_set': 40, 'pump_set': 60, 'mode': 'custom', 'boosting': False, 'critical': False, 'connected': True}
+    result.update(values)
+    return result
+
+
+def snapshot(*devices):
+    return SimpleNamespace(devices=list(devices), check_interval=0.5)
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / "status")
+    writer = StatusWriter(filename, 2)
+    reader = StatusReader(filename)
+    assert reader.read(0)['sequence'] == 0
+
+    writer.write(snapshot(device(0), device(1, mode='fixed', boosting=True)), 1000.0)
+    writer.write(snapshot(device(0, ticks=8), device(1, mode='fixed', boosting=True)), 1001.0, False)
+    first, second = reader.read_all()
+    assert first['sequence'] == 2
+    assert first['tick'] == 8 and first['timestamp'] == 1001.0 and not first['scheduled']
+    assert first['cpu_temp'] == 45.5 and first['liquid_temp'] is None
+    assert first['fan_duty'] == 40 and first['pump_duty'] is None
+    assert first['mode'] == 'custom' and first['check_interval'] == 0.5
+    assert second['mode'] == 'fixed' and second['boosting']
+
+    writer.close()
+    assert reader.header() == (2, 0)
+    reader.close()
+
+
+def test_unknown_mode_is_written(tmp_path):
+    filename = str(tmp_path / "status")
+    writer = StatusWriter(filename, 1)
+    writer.write(snapshot(device(0, mode='Custom')), 1000.0)
+    reader = StatusReader(filename)
+    assert reader.read(0)['mode'] is None
+    assert reader.read(0)['sequence'] == 1
+
+
+def test_half_written_slot(tmp_path, monkeypatch):
+    filename = str(tmp_path / "status")
+    writer = StatusWriter(filename, 1)
+    writer.write(snapshot(device(0)), 1000.0)
+    reader = StatusReader(filename)
+
+    # a writer that died half way through leaves the sequence number odd
+    monkeypatch.setattr(pulleyshm, 'MAX_RETRIES', 100)
+    monkeypatch.setattr(pulleyshm, 'sleep', lambda seconds: None)
+    SEQUENCE.pack_into(writer.map, HEADER_SIZE, 3)
+    assert reader.read(0) is None
+
+    # and the next write finishes it
+    writer.write(snapshot(device(0, ticks=9)), 1001.0)
+    assert reader.read(0)['tick'] == 9
+    assert reader.read(0)['sequence'] == 2
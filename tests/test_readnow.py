@@ -0,0 +1,122 @@
+from threading import Event, Thread
+from time import monotonic
+
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("pydbus")
+
+import pulley
+from pulleysim import SimulatedCpuSensor, SimulatedKraken, ThermalModel
+
+
+class PostedJobs:
+    """
+    Stands in for the KrakenControllerWorker, the jobs are run by the test
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def post(self, job, on_done=None):
+        self.jobs.append((job, on_done))
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for job, on_done in jobs:
+            job()
+            on_done()
+
+
+@pytest.fixture
+def controller():
+    pulley.import_dbus()
+    model = ThermalModel()
+    device = SimulatedKraken(model, latency=0.005, jitter=0)
+    configMgr = pulley.KrakenControllerConfig()
+    controller = pulley.KrakenController(pulley.KrakenControllerDBUS(configMgr), configMgr, device, SimulatedCpuSensor(model))
+    controller.dbus_interface.worker = PostedJobs()
+    controller.update_speed()
+    yield controller
+    controller.close()
+
+
+def read_now(controller):
+    return {name: value.unpack() for name, value in controller.dbus_interface.ReadNow().items()}
+
+
+def make_stale(controller):
+    controller.session.status_time -= controller.STATUS_TTL * 2
+
+
+def test_fresh_read_is_reused(controller):
+    reads = controller.session.device.reads
+    values = read_now(controller)
+    assert values['Age'] <= controller.STATUS_TTL
+    assert {'CPUTemp', 'LiquidTemp', 'FanDuty', 'PumpDuty'} <= set(values)
+    assert controller.session.device.reads == reads
+    assert controller.dbus_interface.worker.jobs == []
+
+
+def test_does_not_block_while_the_worker_holds_the_device(controller):
+    make_stale(controller)
+    held = Event()
+    release = Event()
+
+    def worker():
+        # e.g. the worker in the middle of a set_fixed_speed
+        with controller.session.lock:
+            held.set()
+            release.wait()
+
+    thread = Thread(target=worker)
+    thread.start()
+    held.wait()
+    try:
+        start = monotonic()
+        values = read_now(controller)
+        elapsed = monotonic() - start
+    finally:
+        release.set()
+        thread.join()
+
+    assert elapsed < controller.READ_NOW_WAIT
+    assert values['Age'] > controller.STATUS_TTL
+    assert len(controller.dbus_interface.worker.jobs) == 1
+
+
+def test_callers_share_one_refresh(controller):
+    make_stale(controller)
+    worker = controller.dbus_interface.worker
+    reads = controller.session.device.reads
+    for n in range(10):
+        controller.dbus_interface.ReadNow()
+    assert len(worker.jobs) == 1
+    assert controller.session.device.reads == reads
+
+    worker.run()
+    assert controller.session.device.reads == reads + 1
+    values = read_now(controller)
+    assert values['Age'] <= controller.STATUS_TTL
+    assert worker.jobs == []
+
+
+def test_concurrent_reads_are_merged(controller):
+    controller.session.device.latency = 0.2
+    reads = controller.session.device.reads
+    threads = [Thread(target=controller.session.get_status) for n in range(8)]
+    threads[0].start()
+    while controller.session.status_read is None:
+        pass
+    # everyone else comes while the first read is in flight, and joins it
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert controller.session.device.reads == reads + 1
+
+
+def test_lost_device_is_an_error(controller):
+    controller.lost_since = controller.clock()
+    with pytest.raises(Exception):
+        controller.dbus_interface.ReadNow()
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from pulley import ChipsetTemperatureSensor, CpuTemperatureSensor
+
+
+def hwmon(root, index, name, inputs):
+    directory = root / ("hwmon" + str(index))
+    directory.mkdir()
+    (directory / "name").write_text(name + "\n")
+    for number, (label, millidegrees) in inputs.items():
+        (directory / ("temp" + str(number) + "_input")).write_text(str(millidegrees) + "\n")
+        if label is not None:
+            (directory / ("temp" + str(number) + "_label")).write_text(label + "\n")
+    return directory
+
+
+def sensor(cls, root, fallback=()):
+    result = cls()
+    result.HWMON_PATH = str(root)
+    result.FALLBACK_FILES = [str(name) for name in fallback]
+    return result
+
+
+def test_prefers_the_label(tmp_path):
+    hwmon(tmp_path, 0, 'nvme', {1: ('Composite', 30000)})
+    chip = hwmon(tmp_path, 1, 'k10temp', {1: ('Tccd1', 40000), 2: ('Tdie', 51250), 10: ('Tctl', 52500)})
+    cpu = sensor(CpuTemperatureSensor, tmp_path)
+    assert cpu.read() == 52.5
+    assert cpu.path == str(chip / "temp10_input")
+    cpu.close()
+
+
+def test_first_input_without_labels(tmp_path):
+    chip = hwmon(tmp_path, 0, 'coretemp', {2: (None, 61000), 1: (None, 60000)})
+    cpu = sensor(CpuTemperatureSensor, tmp_path)
+    assert cpu.read() == 60.0
+    assert cpu.path == str(chip / "temp1_input")
+
+    # the file is kept open and read again
+    (chip / "temp1_input").write_text("62000\n")
+    assert cpu.read() == 62.0
+    cpu.close()
+
+
+def test_label_required(tmp_path):
+    hwmon(tmp_path, 0, 'nct6775', {1: ('SYSTIN', 35000), 2: ('CPUTIN', 45000)})
+    with pytest.raises(Exception, match="Unable to find chipset temperature"):
+        sensor(ChipsetTemperatureSensor, tmp_path).resolve()
+
+
+def test_fallback_file(tmp_path):
+    (tmp_path / "hwmon").mkdir()
+    zone = tmp_path / "thermal_zone0_temp"
+    zone.write_text("47000\n")
+    cpu = sensor(CpuTemperatureSensor, tmp_path / "hwmon", [tmp_path / "missing", zone])
+    assert cpu.read() == 47.0
+    cpu.close()
+
+
+def test_resolves_again_when_the_sensor_goes_away(tmp_path):
+    chip = hwmon(tmp_path, 0, 'k10temp', {1: ('Tctl', 50000)})
+    cpu = sensor(CpuTemperatureSensor, tmp_path)
+    assert cpu.read() == 50.0
+
+    # the driver was reloaded under another hwmon index, the open file now reads nothing
+    (chip / "temp1_input").write_text("")
+    os.rename(chip, tmp_path / "gone")
+    moved = hwmon(tmp_path, 3, 'k10temp', {1: ('Tctl', 55000)})
+    assert cpu.read() == 55.0
+    assert cpu.path == str(moved / "temp1_input")
+    cpu.close()
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("pydbus")
+
+import pulley
+
+
+@pytest.fixture
+def interface(tmp_path):
+    pulley.import_dbus()
+    configMgr = pulley.KrakenControllerConfig()
+    configMgr.configFile = str(tmp_path / "pulley.conf")
+    return pulley.KrakenControllerDBUS(configMgr)
+
+
+def snapshot(interface, since):
+    version, values, config = interface.GetSnapshot(since)
+    return version, {name: value.unpack() for name, value in values.items()}, config
+
+
+def test_everything_from_zero(interface):
+    interface.CPUTemp = 45
+    version, values, config = snapshot(interface, 0)
+    assert set(values) == set(interface.SNAPSHOT_TYPES)
+    assert values['CPUTemp'] == 45
+    assert json.loads(config)['mode'] == interface.configMgr.config['mode']
+
+
+def test_only_changes_since_the_version(interface):
+    version, values, config = snapshot(interface, 0)
+    assert snapshot(interface, version) == (version, {}, "")
+
+    interface.CPUTemp = 50
+    interface.FanDuty = 40
+    # setting the same value again is not a change
+    interface.PumpDuty = interface.PumpDuty
+    newer, values, config = snapshot(interface, version)
+    assert newer > version
+    assert values == {'CPUTemp': 50, 'FanDuty': 40}
+    assert config == ""
+
+    # CheckInterval is in the snapshot even though it is not signalled
+    interface.CheckInterval = 2.5
+    latest, values, config = snapshot(interface, newer)
+    assert values == {'CheckInterval': 2.5}
+    assert interface._changed == {'CPUTemp': 50, 'FanDuty': 40}
+
+
+def test_config_changes(interface):
+    version, values, config = snapshot(interface, 0)
+    assert interface.configMgr.applyPatch({'fixed_fan_speed': 40})
+    newer, values, config = snapshot(interface, version)
+    assert newer > version and values == {}
+    assert json.loads(config)['fixed_fan_speed'] == 40
+    # the JSON is built once per config
+    assert interface.configMgr.toJSON() is config
+    assert snapshot(interface, newer) == (newer, {}, "")